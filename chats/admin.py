@@ -1,6 +1,7 @@
 from django.contrib import admin
-from chats.models import ChatModel, UserProfileModel, ChatNotification
+from chats.models import ChatModel, UserProfileModel, ChatNotification, ConversationSummary
 # Register your models here.
 admin.site.register(ChatModel)
 admin.site.register(UserProfileModel)
 admin.site.register(ChatNotification)
+admin.site.register(ConversationSummary)
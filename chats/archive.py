@@ -0,0 +1,185 @@
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chats.models import ArchiveSegment, ChatModel, get_group_conversation
+from groups.models import GroupMessage
+
+# Messages older than CHAT_ARCHIVE_AFTER_DAYS leave ChatModel and GroupMessage
+# (their notifications go with them) for append-only segment files, one per
+# conversation in CHAT_ARCHIVE_DIR.  The history views read through to them
+# once a client pages past the oldest hot message.  Archived messages are
+# dropped from the search index.
+
+
+def archive_dir():
+    return getattr(settings, 'CHAT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive'))
+
+
+def archive_cutoff():
+    """Messages sent before this moment are archived"""
+    return timezone.now() - timedelta(days=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 365))
+
+
+def segment_path(conversation):
+    return os.path.join(archive_dir(), f'{conversation}.seg')
+
+
+def personal_record(message):
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'sender': message.sender_username,
+        'message': message.message,
+        'seq': message.seq,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def group_record(message):
+    return {
+        'id': message.id,
+        'sender': {'id': message.sender_id, 'username': message.sender.username},
+        'content': message.content,
+        'file_id': message.file_id,
+        'seq': message.seq,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+# Archived model, conversation of one of its rows and the record kept of it.
+# Personal messages without a Thread have no trustworthy name and stay hot.
+SOURCES = [
+    (ChatModel, lambda message: message.thread_name if message.thread_id else None, personal_record),
+    (GroupMessage, lambda message: get_group_conversation(message.group_id), group_record),
+]
+
+
+def append_segment(conversation, records):
+    """
+    Append ``records`` (id order) to the conversation's segment file as one
+    gzip member, synced to disk.  Returns its unsaved ArchiveSegment.
+    """
+    data = gzip.compress(json.dumps(records, separators=(',', ':')).encode(), mtime=0)
+    path = segment_path(conversation)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        offset = os.fstat(f.fileno()).st_size
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return ArchiveSegment(
+        conversation=conversation, offset=offset, length=len(data), message_count=len(records),
+        first_id=records[0]['id'], last_id=records[-1]['id'],
+        first_timestamp=parse_datetime(records[0]['timestamp']),
+        last_timestamp=parse_datetime(records[-1]['timestamp']),
+    )
+
+
+def read_segment(segment):
+    with open(segment_path(segment.conversation), 'rb') as f:
+        f.seek(segment.offset)
+        return json.loads(gzip.decompress(f.read(segment.length)))
+
+
+def archive_messages(cutoff, batch_size=1000, sleep=0, progress=None):
+    """
+    Move the messages sent before ``cutoff`` to the archive, oldest first,
+    ``batch_size`` rows per transaction with ``sleep`` seconds between
+    batches.  Ids are handed out in commit order, the write-behind batcher
+    included, so they grow with time: a run stops at the first batch
+    reaching the hot window and the next one starts where it stopped.
+
+    A batch's segments are written and synced before its rows are deleted:
+    a crash in between leaves the messages hot and unlisted bytes at the end
+    of a segment file.  Returns the number of messages archived.
+    """
+    total = 0
+    for model, conversation_of, make_record in SOURCES:
+        last_id = 0
+        while True:
+            rows = list(model.objects.filter(id__gt=last_id).select_related('sender').order_by('id')[:batch_size])
+            if not rows:
+                break
+            old = [row for row in rows if row.timestamp < cutoff]
+            by_conversation = {}
+            for row in old:
+                conversation = conversation_of(row)
+                if conversation is not None:
+                    by_conversation.setdefault(conversation, []).append(row)
+
+            if by_conversation:
+                segments = [append_segment(conversation, [make_record(row) for row in conversation_rows])
+                            for conversation, conversation_rows in by_conversation.items()]
+                with transaction.atomic():
+                    ArchiveSegment.objects.bulk_create(segments)
+                    model.objects.filter(id__in=[row.id for conversation_rows in by_conversation.values()
+                                                 for row in conversation_rows]).delete()
+                total += sum(segment.message_count for segment in segments)
+                if progress is not None:
+                    progress(total)
+
+            if len(old) < len(rows):
+                break
+            last_id = rows[-1].id
+            if sleep:
+                time.sleep(sleep)
+    return total
+
+
+def has_archived(conversation):
+    return ArchiveSegment.objects.filter(conversation=conversation).exists()
+
+
+def is_before(record, before_timestamp=None, before_id=None):
+    """Whether ``record`` is older than the cursor, see chats.pagination.keyset_before"""
+    if before_timestamp is not None:
+        timestamp = parse_datetime(record['timestamp'])
+        if before_id is not None:
+            return timestamp < before_timestamp or (timestamp <= before_timestamp and record['id'] < before_id)
+        return timestamp < before_timestamp
+    return before_id is None or record['id'] < before_id
+
+
+def archived_before(conversation, limit, before_timestamp=None, before_id=None):
+    """
+    The newest ``limit`` archived messages of ``conversation`` older than the
+    cursor, in chronological order, and whether older ones exist.  Segments
+    are read newest first until the page is full.
+    """
+    if before_timestamp is not None and timezone.is_naive(before_timestamp):
+        before_timestamp = timezone.make_aware(before_timestamp)
+    segments = ArchiveSegment.objects.filter(conversation=conversation)
+    if before_timestamp is not None:
+        segments = segments.filter(first_timestamp__lte=before_timestamp)
+    elif before_id is not None:
+        segments = segments.filter(first_id__lt=before_id)
+
+    records = []
+    for segment in segments.order_by('-last_id').iterator():
+        records.extend(record for record in reversed(read_segment(segment))
+                       if is_before(record, before_timestamp, before_id))
+        if len(records) > limit:
+            break
+    has_more = len(records) > limit
+    records = records[:limit]
+    records.reverse()
+    return records, has_more
+
+
+def archived_after(conversation, after_id, limit):
+    """Up to ``limit`` archived messages of ``conversation`` after id ``after_id``, in order"""
+    records = []
+    segments = ArchiveSegment.objects.filter(conversation=conversation, last_id__gt=after_id).order_by('last_id')
+    for segment in segments.iterator():
+        records.extend(record for record in read_segment(segment) if record['id'] > after_id)
+        if len(records) >= limit:
+            break
+    return records[:limit]
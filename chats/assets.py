@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.templatetags.static import static
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+
+# A fingerprinted URL never changes content, browsers keep it without asking again
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Unfingerprinted names are revalidated against their ETag on every use
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# With DEBUG on, seconds between two checks for edited files
+DEBUG_REFRESH_INTERVAL = 1
+
+_bundle = None
+_bundle_lock = threading.Lock()
+
+
+class Asset:
+    """
+    A static file held in memory, with its fingerprinted name
+    (``js/chat.js`` -> ``js/chat.3f2a1b9c0d1e.js``) and a gzipped copy when
+    that is smaller
+    """
+
+    def __init__(self, name, content):
+        self.name = name
+        self.content = content
+        self.digest = hashlib.sha256(content).hexdigest()
+        root, extension = os.path.splitext(name)
+        self.hashed_name = f'{root}.{self.digest[:12]}{extension}'
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.gzipped = None
+        if self.content_type.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gzipped) < len(content):
+                self.gzipped = gzipped
+
+
+class AssetBundle:
+    """
+    The files of ``dirs`` (STATICFILES_DIRS), read and fingerprinted once
+    and then served from memory by name and by fingerprinted name.
+
+    With DEBUG on, ``refresh`` reloads the bundle when a file changed so
+    edits show up without a restart.
+    """
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.assets = {}
+        self.mtimes = None
+        self.refreshed_at = 0
+
+    def find_files(self):
+        """Name -> path of the files of the bundle, the first directory wins like the static finders"""
+        files = {}
+        for directory in self.dirs:
+            # Entries can be (prefix, directory) pairs
+            prefix, directory = directory if isinstance(directory, (list, tuple)) else ('', directory)
+            for dirpath, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, directory).replace(os.sep, '/')
+                    files.setdefault(f'{prefix}/{name}' if prefix else name, path)
+        return files
+
+    def refresh(self):
+        self.refreshed_at = time.monotonic()
+        files = self.find_files()
+        mtimes = {name: os.stat(path).st_mtime_ns for name, path in files.items()}
+        if mtimes == self.mtimes:
+            return
+        assets = {}
+        for name, path in files.items():
+            with open(path, 'rb') as f:
+                asset = Asset(name, f.read())
+            assets[name] = assets[asset.hashed_name] = asset
+        self.assets, self.mtimes = assets, mtimes
+
+    def get(self, name):
+        return self.assets.get(name)
+
+
+def get_bundle():
+    global _bundle
+    with _bundle_lock:
+        dirs = list(settings.STATICFILES_DIRS)
+        if _bundle is None or _bundle.dirs != dirs:
+            _bundle = AssetBundle(dirs)
+            _bundle.refresh()
+        elif settings.DEBUG and time.monotonic() - _bundle.refreshed_at >= DEBUG_REFRESH_INTERVAL:
+            _bundle.refresh()
+        return _bundle
+
+
+def asset_url(name):
+    """URL of the fingerprinted copy of static file ``name``, its plain static URL if it is not in the bundle"""
+    asset = get_bundle().get(name)
+    if asset is None:
+        return static(name)
+    return getattr(settings, 'CHAT_ASSET_URL', '/assets/') + asset.hashed_name
+
+
+def asset_response(request, asset, immutable):
+    """
+    Answer a GET of ``asset`` from memory: gzipped when the client accepts
+    it, a 304 when the client's copy has the same ETag
+    """
+    gzipped = asset.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', '')
+    # Each encoding is its own representation and needs its own strong ETag
+    etag = quote_etag(f'{asset.digest}-gz' if gzipped else asset.digest)
+    cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(asset.gzipped if gzipped else asset.content, content_type=asset.content_type)
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    if asset.gzipped is not None:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
@@ -1,14 +1,43 @@
-import json
+import re
+from functools import partial
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
 from django.utils import timezone
-from chats.models import ChatModel, UserProfileModel, ChatNotification, ChatFile
+from chats.models import (ChatModel, ChatNotification, ChatFile, ConversationSummary, MessageSequence, Thread,
+                          UnreadCounter, get_group_conversation, get_message_preview)
+from chats import presence, typing_indicators, writebehind
+from django.conf import settings
 from django.db import transaction
-from groups.models import Group,GroupNotification,GroupMessage
+from chats.fanout import run_in_background, send_to_groups
+from chats.pagination import messages_after_seq, parse_int
+from chats.protocol import NegotiatedProtocolMixin, prepare_frames
+from chats.storage import guess_content_type, reference_file
+from groups.models import Group,GroupNotification,GroupMessage,GroupFile
+
+# Text the consumers save for a file message
+FILE_MESSAGE_PATTERN = re.compile(r'^Sent a file: .* \[file_id:(\d+)\]$', re.DOTALL)
+
+
+def message_file_id(text):
+    """Id of the file a file message was saved with, None for a text message"""
+    match = FILE_MESSAGE_PATTERN.match(text)
+    return int(match.group(1)) if match else None
+
 
+def replayed_file_data(file_obj):
+    """The ``file_data`` the sender broadcast with a file message, for a replay"""
+    return {
+        'file_id': file_obj.id,
+        'filename': file_obj.filename,
+        'file_url': file_obj.file.url,
+        'file_type': file_obj.file_type,
+        'file_size': getattr(file_obj, 'size', None) or 0
+    }
 
-class PersonalChatConsumer(AsyncWebsocketConsumer):
+
+class PersonalChatConsumer(NegotiatedProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         my_id = self.scope['user'].id
         other_user_id = self.scope['url_route']['kwargs']['id']
@@ -20,6 +49,7 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
             self.room_name = f'{other_user_id}-{my_id}'
 
         self.room_group_name = f'chat_{self.room_name}'
+        self.thread_id = await self.get_thread_id()
 
         # Join room group
         await self.channel_layer.group_add(
@@ -27,10 +57,10 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        # Set user as online
-        await self.set_online_status(self.scope['user'].username, True)
+        await self.accept_negotiated()
 
-        await self.accept()
+        # Every open socket holds the user online, see chats.presence
+        presence.user_connected(self.channel_layer, self.scope['user'], self.channel_name)
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -39,12 +69,22 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        # Set user as offline
-        await self.set_online_status(self.scope['user'].username, False)
+        presence.user_disconnected(self.scope['user'], self.channel_name)
 
     # Receive message from WebSocket
     async def receive(self, text_data=None, bytes_data=None):
-        data = json.loads(text_data)
+        # Any frame from the client counts as a heartbeat
+        presence.user_heartbeat(self.scope['user'], self.channel_name)
+
+        data = self.decode_frame(text_data, bytes_data)
+        if data.get('type') == 'typing':
+            typing_indicators.user_typing(self.channel_layer, self.room_group_name, self.scope['user'],
+                                          bool(data.get('is_typing')))
+            return
+        if data.get('type') == 'resume':
+            await self.resume(data.get('last_seq'))
+            return
+
         message = data.get('message', '')
         username = data.get('username', '')
         receiver = data.get('receiver', '')
@@ -60,76 +100,106 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
         # Save message to database and create notification
         if message_type == 'text':
             # For regular text messages
-            chat_obj = await self.save_message(username, self.room_group_name, message, receiver)
+            chat_obj = await self.store_message(username, self.room_group_name, message, receiver)
         elif message_type == 'file' and file_data:
             # For file messages - save file info to ChatFile model and reference in message
             file_id = await self.save_file(username, self.room_group_name, file_data)
 
             # Include file_id in the message for later retrieval
             file_message = f"Sent a file: {file_data.get('filename', 'unknown')} [file_id:{file_id}]"
-            chat_obj = await self.save_message(username, self.room_group_name, file_message, receiver, file_id)
+            chat_obj = await self.store_message(username, self.room_group_name, file_message, receiver)
 
-        # Send message to room group
+        # Send message to room group, serialized once for every socket in it
         message_data = {
-            'type': 'chat_message',
             'message': message if message_type == 'text' else chat_obj.message if chat_obj else "File message",
             'username': username,
             'message_type': message_type,
             'file_data': file_data,
             'message_id': chat_obj.id if chat_obj else None,
+            'seq': chat_obj.seq if chat_obj else None,
             'timestamp': timezone.now().isoformat()
         }
 
         await self.channel_layer.group_send(
             self.room_group_name,
-            message_data
+            {
+                'type': 'chat_message',
+                'frames': prepare_frames(message_data)
+            }
         )
+
+        await self.notify_receiver(receiver, message_data)
+
+    async def store_message(self, username, thread_name, message, receiver):
+        """
+        Save the message now, or queue it when CHAT_WRITE_BEHIND is on and
+        wait for its batch.  Returns the saved message either way.
+        """
+        if not writebehind.is_enabled():
+            return await self.save_message(username, thread_name, message, receiver)
+
+        chat_obj = ChatModel(sender=self.scope['user'], message=message, thread_id=self.thread_id,
+                             thread_name=thread_name, timestamp=timezone.now())
+        other_user_id = int(self.scope['url_route']['kwargs']['id'])
+        await (await writebehind.personal_messages.submit(chat_obj, self.scope['user'], other_user_id, receiver))
+        return chat_obj
+
+    async def notify_receiver(self, receiver, message_data):
         other_user_id = self.scope['url_route']['kwargs']['id']
-        user = await self.get_user(other_user_id)
-        if user and user.username == receiver:
-            other_user = await self.get_user(other_user_id)
+        other_user = await self.get_user(other_user_id)
         if other_user and other_user.username == receiver:
-            unseen_notifications = await self.get_unseen_notifications(other_user_id)
+            # O(1) push: the receiver's unread total plus the preview of this message,
+            # the full unseen list is fetched page by page from the notifications view
             await self.channel_layer.group_send(
                 f'{other_user_id}',
                 {
                     'type': 'send_notification',
-                    'value': json.dumps({
-                        'unseen_notifications': unseen_notifications,
-                        'unseen_count': len(unseen_notifications)
+                    'frames': prepare_frames({
+                        'unseen_count': await self.get_unread_count(other_user_id),
+                        'notification': {
+                            'sender_username': message_data['username'],
+                            'timestamp': message_data['timestamp'],
+                            'message_preview': get_message_preview(message_data['message'])
+                        }
                     })
                 }
             )
-            await self.channel_layer.group_send(
-                f'{other_user_id}',
-                {
-                    'type': 'send_single_notification',
-                    'notification': {
-                        'sender_username': username,
-                        'message_preview': message[:50] + '...' if len(message) > 50 else message
-                    }
-                }
-            )
+
+    async def resume(self, last_seq):
+        """
+        Replay the messages sent after ``last_seq``, the last sequence number
+        the reconnecting client saw, or tell it to reload the history when it
+        missed more than CHAT_RESUME_MAX_GAP
+        """
+        try:
+            last_seq = int(last_seq)
+        except (TypeError, ValueError):
+            return
+        messages = await self.get_messages_after(last_seq)
+        if messages is None:
+            await self.send_event({'type': 'resync'})
+            return
+        for chat_obj, file_data in messages:
+            await self.send_event({
+                'message': chat_obj.message,
+                'username': chat_obj.sender_username,
+                'message_type': 'file' if file_data else 'text',
+                'file_data': file_data,
+                'message_id': chat_obj.id,
+                'seq': chat_obj.seq,
+                'timestamp': chat_obj.timestamp.isoformat()
+            })
+
     # Receive message from room group
     async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': event.get('message', ''),
-            'username': event.get('username', ''),
-            'message_type': event.get('message_type', 'text'),
-            'file_data': event.get('file_data', None),
-            'timestamp': event.get('timestamp', timezone.now().isoformat())
-        }))
+        # Forward the frame serialized by the sender to WebSocket
+        await self.send_frames(event)
 
     async def typing_status(self, event):
         """
-        Send typing status to WebSocket
+        Send who is typing in the room to WebSocket, see chats.typing_indicators
         """
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': event['username'],
-            'is_typing': event['is_typing']
-        }))
+        await self.send_frames(event)
 
     async def mark_read(self, event):
         """
@@ -142,32 +212,39 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
         await self.mark_messages_read(thread_name, username)
 
         # Send read status to both users
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'read_status',
             'thread_name': thread_name,
             'read_by': username
-        }))
+        })
 
     @database_sync_to_async
     def save_message(self, username, thread_name, message, receiver, file_id=None):
         """
         Save message to database and create notification
         """
-        # Create chat message
-        chat_obj = ChatModel.objects.create(
-            sender=username,
-            message=message,
-            thread_name=thread_name
-        )
-
-        # Create notification if the receiver exists
         other_user_id = self.scope['url_route']['kwargs']['id']
-        try:
-            user = User.objects.get(id=other_user_id)
+
+        # Message, notification and sidebar summaries are committed together
+        with transaction.atomic():
+            # Create chat message
+            chat_obj = ChatModel.objects.create(
+                sender=self.scope['user'],
+                message=message,
+                thread_id=self.thread_id,
+                thread_name=thread_name,
+                seq=MessageSequence.reserve(thread_name)
+            )
+
+            # Create notification if the receiver exists
+            try:
+                user = User.objects.get(id=other_user_id)
+            except User.DoesNotExist:
+                return chat_obj
+
             if receiver == user.username:
-                ChatNotification.objects.create(chat=chat_obj, user=user)
-        except User.DoesNotExist:
-            pass
+                ChatNotification.objects.create(chat=chat_obj, user=user, thread_id=self.thread_id)
+            ConversationSummary.record_personal_message(chat_obj, self.scope['user'], user)
 
         return chat_obj
 
@@ -177,18 +254,33 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
         Save file information to ChatFile model
         """
         user = self.scope['user']
+        filename = file_data.get('filename', 'unknown')
+        file, size = reference_file(file_data.get('file_url', ''), user)  # The uploaded file, shared
 
         # Create a new file entry
         chat_file = ChatFile.objects.create(
-            file=file_data.get('file_url', ''),  # URL to the uploaded file
-            filename=file_data.get('filename', 'unknown'),
+            file=file,
+            filename=filename,
             file_type=file_data.get('file_type', 'application/octet-stream'),
+            size=size,
+            content_type=guess_content_type(filename),
             uploader=user,
+            thread_id=self.thread_id,
             thread_name=thread_name
         )
 
         return chat_file.id
 
+    @database_sync_to_async
+    def get_thread_id(self):
+        """
+        Id of the thread of the room, None when the other user does not exist
+        """
+        other_user_id = int(self.scope['url_route']['kwargs']['id'])
+        if not User.objects.filter(id=other_user_id).exists():
+            return None
+        return Thread.between(self.scope['user'].id, other_user_id).id
+
     @database_sync_to_async
     def get_user(self, user_id):
         """
@@ -200,55 +292,28 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
             return None
 
     @database_sync_to_async
-    def get_unseen_notifications(self, user_id):
-        """
-        Get unseen notifications for a user
-        """
-        notifications = ChatNotification.objects.filter(
-            user_id=user_id, is_seen=False
-        ).select_related('chat')
-
-        unseen_list = []
-        for notification in notifications:
-            # Extract sender username
-            sender = notification.chat.sender
-            if isinstance(sender, str):
-                # If it's already a string, use it directly
-                sender_username = sender
-            else:
-                # If it's a User object, get the username
-                sender_username = sender.username if hasattr(sender, 'username') else str(sender)
-
-            timestamp = notification.chat.timestamp.isoformat() if hasattr(notification.chat, 'timestamp') else ''
-
-            unseen_list.append({
-                'sender_username': sender_username,
-                'timestamp': timestamp,
-                'message_preview': notification.chat.message[:50] + '...' if len(
-                    notification.chat.message) > 50 else notification.chat.message
-            })
-
-        return unseen_list
+    def get_messages_after(self, last_seq):
+        """``(message, file data or None)`` pairs after ``last_seq``, None when too far behind"""
+        messages = messages_after_seq(
+            ChatModel.objects.filter(thread_id=self.thread_id).select_related('sender'), last_seq
+        )
+        if messages is None:
+            return None
+        file_ids = {chat_obj.id: message_file_id(chat_obj.message) for chat_obj in messages}
+        files = ChatFile.objects.filter(thread_id=self.thread_id).in_bulk(
+            [file_id for file_id in file_ids.values() if file_id]
+        )
+        return [
+            (chat_obj, replayed_file_data(files[file_ids[chat_obj.id]]) if file_ids[chat_obj.id] in files else None)
+            for chat_obj in messages
+        ]
 
     @database_sync_to_async
-    def set_online_status(self, username, is_online):
+    def get_unread_count(self, user_id):
         """
-        Set user's online status
+        Get the total of unread messages of a user
         """
-        try:
-            with transaction.atomic():
-                user = User.objects.select_for_update().get(username=username)
-                userprofile, created = UserProfileModel.objects.select_for_update().get_or_create(
-                    user=user,
-                    defaults={'online_status': is_online}
-                )
-                userprofile.online_status = is_online
-                userprofile.save(update_fields=['online_status'])
-
-                # Broadcast online status change to all users
-                # This will be handled by the channel layer in the actual implementation
-        except Exception as e:
-            print(f"Error updating online status: {str(e)}")
+        return UnreadCounter.get_count(user_id)
 
     @database_sync_to_async
     def mark_messages_read(self, thread_name, reader_username):
@@ -258,23 +323,15 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
         try:
             user = User.objects.get(username=reader_username)
 
-            # Find all notifications for this user in this thread and mark them as seen
-            notifications = ChatNotification.objects.filter(
-                user=user,
-                is_seen=False,
-                chat__thread_name=thread_name
-            )
-
-            for notification in notifications:
-                notification.is_seen = True
-                notification.save(update_fields=['is_seen'])
+            # Moving the read watermark marks the whole thread at once
+            ConversationSummary.mark_read(user, thread_name=thread_name)
 
             return True
         except User.DoesNotExist:
             return False
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(NegotiatedProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Get user ID from WebSocket scope
         my_id = self.scope['user'].id
@@ -287,14 +344,12 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         )
 
         # Accept the WebSocket connection
-        await self.accept()
+        await self.accept_negotiated()
 
-        # Send initial notifications upon connection
-        unseen_notifications = await self.get_unseen_notifications(my_id)
-        await self.send(text_data=json.dumps({
-            'unseen_notifications': unseen_notifications,
-            'unseen_count': len(unseen_notifications)
-        }))
+        # Send the unread total upon connection, the list itself is fetched on demand
+        await self.send_event({
+            'unseen_count': await self.get_unread_count(my_id)
+        })
 
     async def disconnect(self, code):
         # Remove the user from the group when disconnecting
@@ -304,99 +359,59 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         )
 
     async def send_notification(self, event):
-        # Get unseen notifications data from the event
-        data = json.loads(event.get('value'))
-        unseen_notifications = data.get('unseen_notifications', [])
-        unseen_count = len(unseen_notifications)  # Count of unseen notifications
-
-        # Send both the unseen notifications and the count to the user
-        await self.send(text_data=json.dumps({
-            'unseen_notifications': unseen_notifications,
-            'unseen_count': unseen_count  # Include the count of unseen messages
-        }))
-
-    async def send_single_notification(self, event):
-        await self.send(text_data=json.dumps({
-            'notification': event['notification']
-        }))
-
-    # Function to fetch unseen notifications
+        # Unread total, plus the preview of the message that changed it if any,
+        # already serialized by the sender
+        await self.send_frames(event)
+
     @database_sync_to_async
-    def get_unseen_notifications(self, user_id):
-        notifications = ChatNotification.objects.filter(
-            user_id=user_id, is_seen=False
-        ).select_related('chat')
-
-        unseen_list = []
-        for notification in notifications:
-            # Extract sender username
-            sender_username = notification.chat.sender
-            if isinstance(sender_username, str):
-                # If it's already a string, use it directly
-                sender = sender_username
-            else:
-                # If it's a User object, get the username
-                sender = sender_username.username if hasattr(sender_username, 'username') else str(sender_username)
-
-            timestamp = notification.chat.timestamp.isoformat() if hasattr(notification.chat, 'timestamp') else ''
-
-            unseen_list.append({
-                'sender_username': sender,
-                'timestamp': timestamp,
-                'message_preview': notification.chat.message[:50] + '...' if len(
-                    notification.chat.message) > 50 else notification.chat.message
-            })
+    def get_unread_count(self, user_id):
+        return UnreadCounter.get_count(user_id)
 
-        return unseen_list
 
+class OnlineStatusConsumer(NegotiatedProtocolMixin, AsyncWebsocketConsumer):
+    """
+    Presence of the user and of the users they watch.
 
-class OnlineStatusConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.room_group_name = 'user'
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+    The client subscribes to the users on screen (sidebar contacts and open
+    thread) with ``{'type': 'subscribe', 'user_ids': [...]}`` and gets their
+    current state, then batched ``{'type': 'presence', 'online': {id: bool}}``
+    diffs for those users only.
+    """
 
-        await self.accept()
+    async def connect(self):
+        await self.accept_negotiated()
+        presence.user_connected(self.channel_layer, self.scope['user'], self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
-        data = json.loads(text_data)
-        username = data['username']
-        connection_type = data['type']
-        await self.change_online_status(username, connection_type)
-
-    async def send_onlineStatus(self, event):
-        data = json.loads(event.get('value'))
-        username = data['username']
-        online_status = data['status']
-        await self.send(text_data=json.dumps({
-            'username': username,
-            'online_status': online_status
-        }))
+        # 'open' and 'heartbeat' keep this connection alive, 'close' ends it.
+        # Presence is always the one of the authenticated user of the socket
+        data = self.decode_frame(text_data, bytes_data)
+        connection_type = data.get('type')
+        if connection_type == 'close':
+            presence.user_disconnected(self.scope['user'], self.channel_name)
+            return
 
-    async def disconnect(self, message):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        presence.user_heartbeat(self.scope['user'], self.channel_name)
+        if connection_type == 'subscribe':
+            # Ids that are not integers are dropped, they cannot be anyone's
+            user_ids = data.get('user_ids')
+            user_ids = [parse_int(user_id) for user_id in user_ids] if isinstance(user_ids, list) else []
+            user_ids = [user_id for user_id in user_ids if user_id is not None]
+            limit = getattr(settings, 'CHAT_PRESENCE_MAX_SUBSCRIPTIONS', 500)
+            online = presence.registry.subscribe(self.channel_name, user_ids[:limit])
+            await self.send_event({
+                'type': 'presence',
+                'online': {str(user_id): is_online for user_id, is_online in online.items()}
+            })
 
-    @database_sync_to_async
-    def change_online_status(self, username, c_type):
-        try:
-            with transaction.atomic():
-                user = User.objects.select_for_update().get(username=username)
-                userprofile, created = UserProfileModel.objects.select_for_update().get_or_create(
-                    user=user,
-                    defaults={'online_status': False}  # Set default if creating new
-                )
-                userprofile.online_status = (c_type == 'open')
-                userprofile.save(update_fields=['online_status'])
-        except Exception as e:
-            print(f"Error updating online status: {str(e)}")
+    async def presence_diff(self, event):
+        await self.send_frames(event)
+
+    async def disconnect(self, message):
+        presence.user_disconnected(self.scope['user'], self.channel_name)
 
 
-class GroupChatConsumer(AsyncWebsocketConsumer):
+class GroupChatConsumer(NegotiatedProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.group_id = self.scope['url_route']['kwargs']['group_id']
         self.user = self.scope['user']
@@ -413,7 +428,7 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        await self.accept_negotiated()
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -422,9 +437,17 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = self.decode_frame(text_data, bytes_data)
+            if data.get('type') == 'typing':
+                typing_indicators.user_typing(self.channel_layer, self.room_group_name, self.user,
+                                              bool(data.get('is_typing')))
+                return
+            if data.get('type') == 'resume':
+                await self.resume(data.get('last_seq'))
+                return
+
             message = data.get('message', '').strip()
             sender_id = data.get('sender')
             message_type = data.get('type', 'text')  # Default is text
@@ -440,62 +463,80 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
             # Handle different message types
             if message_type == 'text':
                 # Save regular text message
-                message_obj = await self.save_group_message(message, sender_id)
+                message_obj = await self.store_group_message(message, sender_id)
             elif message_type == 'file' and file_data:
                 # Save file info and create a message about it
                 file_id = await self.save_group_file(file_data, sender_id)
                 file_message = f"Sent a file: {file_data.get('filename', 'unknown')} [file_id:{file_id}]"
-                message_obj = await self.save_group_message(file_message, sender_id, file_id)
+                message_obj = await self.store_group_message(file_message, sender_id, file_id)
 
             if not message_obj:
                 return
 
-            # Create notifications for all group members except sender
-            await self.create_notifications(message_obj)
-
-            # Send notifications to all group members who are online
-            await self.send_notifications_to_members(message_obj)
-
-            # Broadcast message to all group members in the room
+            # Broadcast message to all group members in the room, serialized once
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
-                    'message': message_obj.content,
-                    'sender': {
-                        'id': self.user.id,
-                        'username': self.user.username
-                    },
-                    'message_type': message_type,
-                    'file_data': file_data,
-                    'message_id': message_obj.id,
-                    'timestamp': message_obj.timestamp.isoformat()
+                    'frames': prepare_frames({
+                        'message': message_obj.content,
+                        'sender': {
+                            'id': self.user.id,
+                            'username': self.user.username
+                        },
+                        'message_type': message_type,
+                        'file_data': file_data,
+                        'message_id': message_obj.id,
+                        'seq': message_obj.seq,
+                        'timestamp': message_obj.timestamp.isoformat()
+                    })
                 }
             )
 
+            # Notifications fan out in the background, so a large group does not
+            # hold up the sender's next message
+            run_in_background(self.notify_members(message_obj))
+
         except Exception as e:
             print(f"Error processing message: {str(e)}")
 
+    async def resume(self, last_seq):
+        """
+        Replay the messages sent after ``last_seq``, the last sequence number
+        the reconnecting client saw, or tell it to reload the history when it
+        missed more than CHAT_RESUME_MAX_GAP
+        """
+        try:
+            last_seq = int(last_seq)
+        except (TypeError, ValueError):
+            return
+        messages = await self.get_messages_after(last_seq)
+        if messages is None:
+            await self.send_event({'type': 'resync'})
+            return
+        for message_obj, file_data in messages:
+            await self.send_event({
+                'message': message_obj.content,
+                'sender': {
+                    'id': message_obj.sender.id,
+                    'username': message_obj.sender.username
+                },
+                'message_type': 'file' if file_data else 'text',
+                'file_data': file_data,
+                'message_id': message_obj.id,
+                'seq': message_obj.seq,
+                'timestamp': message_obj.timestamp.isoformat()
+            })
+
     async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': event['message'],
-            'sender': event['sender'],
-            'message_type': event.get('message_type', 'text'),
-            'file_data': event.get('file_data', None),
-            'message_id': event.get('message_id'),
-            'timestamp': event['timestamp']
-        }))
+        # Forward the frame serialized by the sender to WebSocket
+        await self.send_frames(event)
 
     async def typing_status(self, event):
         """
-        Send typing status to WebSocket
+        Send who is typing in the room to WebSocket, see chats.typing_indicators
         """
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': event['username'],
-            'is_typing': event['is_typing']
-        }))
+        await self.send_frames(event)
 
     async def mark_read(self, event):
         """
@@ -508,11 +549,11 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
         await self.mark_messages_read(group_id, username)
 
         # Send read status to all group members
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'read_status',
             'group_id': group_id,
             'read_by': username
-        }))
+        })
 
     @database_sync_to_async
     def is_group_member(self):
@@ -522,15 +563,49 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
             members=self.user
         ).exists()
 
+    async def store_group_message(self, message, sender_id, file_id=None):
+        """
+        Save the message now, or queue it when CHAT_WRITE_BEHIND is on and
+        wait for its batch.  Returns the saved message either way.
+        """
+        if not writebehind.is_enabled():
+            return await self.save_group_message(message, sender_id, file_id)
+
+        message_obj = GroupMessage(group_id=self.group_id, sender_id=sender_id, content=message,
+                                   file_id=file_id, timestamp=timezone.now())
+        await (await writebehind.group_messages.submit(message_obj, self.user))
+        return message_obj
+
     @database_sync_to_async
     def save_group_message(self, message, sender_id, file_id=None):
-        """Save message to database"""
-        return GroupMessage.objects.create(
-            group_id=self.group_id,
-            sender_id=sender_id,
-            content=message,
-            file_id=file_id
+        """Save message to database and update the members' sidebar summaries"""
+        with transaction.atomic():
+            message_obj = GroupMessage.objects.create(
+                group_id=self.group_id,
+                sender_id=sender_id,
+                content=message,
+                file_id=file_id,
+                seq=MessageSequence.reserve(get_group_conversation(self.group_id))
+            )
+            ConversationSummary.record_group_message(message_obj, self.user)
+        return message_obj
+
+    @database_sync_to_async
+    def get_messages_after(self, last_seq):
+        """``(message, file data or None)`` pairs after ``last_seq``, None when too far behind"""
+        messages = GroupMessage.objects.filter(group_id=self.group_id).select_related('sender')
+        messages = messages_after_seq(messages, last_seq)
+        if messages is None:
+            return None
+        file_ids = {message_obj.id: message_file_id(message_obj.content) for message_obj in messages}
+        files = GroupFile.objects.filter(group_id=self.group_id).in_bulk(
+            [file_id for file_id in file_ids.values() if file_id]
         )
+        return [
+            (message_obj, replayed_file_data(files[file_ids[message_obj.id]])
+             if file_ids[message_obj.id] in files else None)
+            for message_obj in messages
+        ]
 
     @database_sync_to_async
     def save_group_file(self, file_data, sender_id):
@@ -539,7 +614,7 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
         """
         # Assuming we have a GroupFile model similar to ChatFile
         group_file = GroupFile.objects.create(
-            file=file_data.get('file_url', ''),
+            file=reference_file(file_data.get('file_url', ''), self.user)[0],
             filename=file_data.get('filename', 'unknown'),
             file_type=file_data.get('file_type', 'application/octet-stream'),
             uploader_id=sender_id,
@@ -547,27 +622,27 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
         )
         return group_file.id
 
-    @database_sync_to_async
+    # Not thread sensitive: run on a worker thread of its own, a large group's
+    # inserts would otherwise hold the thread the sender's next message is saved on
+    @partial(database_sync_to_async, thread_sensitive=False)
     def create_notifications(self, message_obj):
-        """Create notifications for all group members except sender"""
+        """
+        Create notifications for all group members except sender.
+
+        Returns the group name and ``(member id, unread total)`` pairs, all in
+        a constant number of queries whatever the size of the group.
+        """
         group = Group.objects.get(id=self.group_id)
-        members = group.members.exclude(id=self.user.id)
-
-        notifications = []
-        for member in members:
-            notifications.append(
-                GroupNotification(
-                    group=group,
-                    user=member,
-                    message=message_obj,
-                    is_seen=False
-                )
-            )
+        member_ids = list(group.members.exclude(id=self.user.id).values_list('id', flat=True))
 
-        if notifications:
-            GroupNotification.objects.bulk_create(notifications)
+        GroupNotification.objects.bulk_create([
+            GroupNotification(group=group, user_id=member_id, message=message_obj, is_seen=False)
+            for member_id in member_ids
+        ])
 
-        return members.values_list('id', flat=True)
+        # The counters were already incremented with the message, read them all at once
+        counts = dict(UnreadCounter.objects.filter(user_id__in=member_ids).values_list('user_id', 'count'))
+        return group.name, [(member_id, counts.get(member_id, 0)) for member_id in member_ids]
 
     @database_sync_to_async
     def mark_messages_read(self, group_id, username):
@@ -587,95 +662,37 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
             for notification in notifications:
                 notification.is_seen = True
                 notification.save(update_fields=['is_seen'])
+            ConversationSummary.mark_read(user, group_id=group_id)
 
             return True
         except User.DoesNotExist:
             return False
 
-    @database_sync_to_async
-    def get_unseen_group_notifications(self, user_id):
+    async def notify_members(self, message_obj):
         """
-        Get unseen group notifications for a user
+        Create the members' notifications and push each member the unread
+        total plus the preview, with the layer sends running concurrently.
+        Members with the same unread total share one serialized frame.
         """
-        notifications = GroupNotification.objects.filter(
-            user_id=user_id, is_seen=False
-        ).select_related('message')
-
-        unseen_list = []
-        for notification in notifications:
-            # Get sender information
-            sender = notification.message.sender
-            sender_username = sender.username if hasattr(sender, 'username') else str(sender)
-
-            group_name = notification.group.name if hasattr(notification.group,
-                                                            'name') else f"Group {notification.group.id}"
-
-            timestamp = notification.message.timestamp.isoformat() if hasattr(notification.message, 'timestamp') else ''
-
-            unseen_list.append({
-                'sender_username': sender_username,
-                'group_id': notification.group.id,
-                'group_name': group_name,
-                'timestamp': timestamp,
-                'message_preview': notification.message.content[:50] + '...' if len(
-                    notification.message.content) > 50 else notification.message.content
+        group_name, recipients = await self.create_notifications(message_obj)
+
+        notification = {
+            'sender_username': self.user.username,
+            'group_id': int(self.group_id),
+            'group_name': group_name,
+            'timestamp': message_obj.timestamp.isoformat(),
+            'message_preview': get_message_preview(message_obj.content)
+        }
+        frames = {}
+        for unseen_count in {unseen_count for _, unseen_count in recipients}:
+            frames[unseen_count] = prepare_frames({
+                'unseen_count': unseen_count,
+                'notification': notification
             })
-
-        return unseen_list
-
-    async def send_notifications_to_members(self, message_obj):
-        """
-        Send notifications to all group members who are online
-        """
-        # Get the group and members (excluding sender)
-        group = await self.get_group()
-        members = await self.get_group_members_except_sender()
-
-        # Create a message preview for notification
-        message_preview = message_obj.content[:50] + '...' if len(message_obj.content) > 50 else message_obj.content
-
-        # Send notification to each member's personal notification channel
-        for member in members:
-            # Send to member's notification channel
-            await self.channel_layer.group_send(
-                f'{member.id}',  # Member's notification channel
-                {
-                    'type': 'send_notification',
-                    'value': json.dumps({
-                        'unseen_notifications': await self.get_unseen_group_notifications(member.id),
-                        'unseen_count': await self.get_unseen_notification_count(member.id)
-                    })
-                }
-            )
-
-            # Also send single notification for real-time popup
-            await self.channel_layer.group_send(
-                f'{member.id}',
-                {
-                    'type': 'send_single_notification',
-                    'notification': {
-                        'sender_username': self.user.username,
-                        'group_id': group.id,
-                        'group_name': group.name,
-                        'message_preview': message_preview
-                    }
-                }
-            )
-
-    @database_sync_to_async
-    def get_group(self):
-        """Get group object"""
-        return Group.objects.get(id=self.group_id)
-
-    @database_sync_to_async
-    def get_group_members_except_sender(self):
-        """Get all group members except the message sender"""
-        group = Group.objects.get(id=self.group_id)
-        return list(group.members.exclude(id=self.user.id))
-
-    @database_sync_to_async
-    def get_unseen_notification_count(self, user_id):
-        """Get count of unseen notifications for a user"""
-        return GroupNotification.objects.filter(
-            user_id=user_id, is_seen=False
-        ).count()
\ No newline at end of file
+        await send_to_groups(self.channel_layer, [
+            (f'{member_id}', {
+                'type': 'send_notification',
+                'frames': frames[unseen_count]
+            })
+            for member_id, unseen_count in recipients
+        ])
@@ -0,0 +1,54 @@
+import asyncio
+
+from django.conf import settings
+
+# Strong references to the running background tasks, the event loop only keeps weak ones
+_background_tasks = set()
+
+
+async def send_to_groups(channel_layer, sends):
+    """
+    Dispatch ``(group_name, event)`` pairs through the channel layer concurrently,
+    with at most CHAT_FANOUT_CONCURRENCY sends in flight at once.
+
+    A failing send is reported and does not stop the others.
+    """
+    await _send_all(channel_layer.group_send, sends)
+
+
+async def send_to_channels(channel_layer, sends):
+    """Same as ``send_to_groups`` for ``(channel_name, event)`` pairs"""
+    await _send_all(channel_layer.send, sends)
+
+
+async def _send_all(send_one, sends):
+    semaphore = asyncio.Semaphore(getattr(settings, 'CHAT_FANOUT_CONCURRENCY', 50))
+
+    async def send(target, event):
+        async with semaphore:
+            await send_one(target, event)
+
+    results = await asyncio.gather(
+        *(send(target, event) for target, event in sends),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Error sending notification: {str(result)}")
+
+
+def run_in_background(coroutine):
+    """
+    Run ``coroutine`` on the current event loop without awaiting it, so the
+    caller (usually a consumer's receive) can go on with the next message.
+    """
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+
+def _task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error in background task: {str(task.exception())}")
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats import archive
+
+
+class Command(BaseCommand):
+    help = ('Move the personal and group messages older than CHAT_ARCHIVE_AFTER_DAYS to the compressed '
+            'per-conversation archive, in batches.  Meant to run regularly, each run picks up where the last stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive the messages older than this many days instead of CHAT_ARCHIVE_AFTER_DAYS')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Messages archived per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05,
+                            help='Seconds to pause between batches so live writers get the database')
+
+    def handle(self, *args, days=None, batch_size=1000, sleep=0.05, **options):
+        cutoff = archive.archive_cutoff() if days is None else timezone.now() - timedelta(days=days)
+
+        def progress(total):
+            self.stdout.write(f'{total} messages archived')
+
+        total = archive.archive_messages(cutoff, batch_size, sleep, progress if options['verbosity'] > 1 else None)
+        self.stdout.write(f'{total} messages sent before {cutoff:%Y-%m-%d %H:%M} archived')
@@ -0,0 +1,54 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Subquery
+
+from chats.models import ChatModel
+
+
+class Command(BaseCommand):
+    help = ('Point the personal messages written before ChatModel.sender existed at their sender, '
+            'one short transaction per id range')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Ids covered per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05,
+                            help='Seconds to pause between batches so live writers get the database')
+        parser.add_argument('--start-id', type=int, default=None,
+                            help='Resume after this id, by default at the first message without a sender')
+
+    def handle(self, *args, batch_size=1000, sleep=0.05, start_id=None, **options):
+        if start_id is None:
+            # Walks the sender_id index, so stopping and restarting costs nothing
+            first = ChatModel.objects.filter(sender__isnull=True, sender_name__isnull=False) \
+                .order_by('id').values_list('id', flat=True).first()
+            if first is None:
+                self.stdout.write('Every message has its sender')
+                return
+            start_id = first - 1
+
+        users_of_name = User.objects.filter(username=OuterRef('sender_name'))
+        last_id, resolved = start_id, 0
+        while True:
+            ids = list(ChatModel.objects.filter(id__gt=last_id).order_by('id')
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            batch = ChatModel.objects.filter(id__gte=ids[0], id__lte=ids[-1])
+            with transaction.atomic():
+                resolved += batch.filter(Exists(users_of_name), sender__isnull=True).update(
+                    sender_id=Subquery(users_of_name.values('id')[:1])
+                )
+                # The username is read through the foreign key from now on, users can be renamed
+                batch.filter(sender__isnull=False, sender_name__isnull=False).update(sender_name=None)
+            last_id = ids[-1]
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{resolved} senders resolved, up to id {last_id}')
+            if sleep:
+                time.sleep(sleep)
+
+        unresolved = ChatModel.objects.filter(sender__isnull=True, sender_name__isnull=False).count()
+        self.stdout.write(f'{resolved} senders resolved, {unresolved} messages of unknown users left as they are')
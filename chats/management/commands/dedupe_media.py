@@ -0,0 +1,82 @@
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.models import Blob, ChatFile
+from chats.storage import BLOB_DIR, file_sha256, media_name
+from chats.thumbnails import delete_thumbnails
+from groups.models import GroupFile
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the files of ChatFile and GroupFile rows into the content-addressed blob store, '
+        'keeping one copy per distinct content and pointing the rows at it'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be moved and how much space it would free')
+        parser.add_argument('--gc', action='store_true',
+                            help='Also delete the blobs no file references any more')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, dry_run=False, gc=False, batch_size=500, **options):
+        # legacy storage name -> (sha256, blob name, size), for rows sharing a file
+        moved = {}
+        seen_hashes = set(Blob.objects.values_list('sha256', flat=True))
+        rows = duplicates = freed = missing = 0
+
+        for model in (ChatFile, GroupFile):
+            legacy = model.objects.exclude(file__startswith=f'{BLOB_DIR}/').exclude(file='')
+            for file_obj in legacy.only('id', 'file').iterator(chunk_size=batch_size):
+                name = media_name(file_obj.file.name)
+                if name is None:
+                    continue
+
+                if name in moved:
+                    sha256, blob, size = moved[name]
+                else:
+                    path = default_storage.path(name)
+                    if not os.path.isfile(path):
+                        missing += 1
+                        continue
+                    sha256, size = file_sha256(path), os.path.getsize(path)
+                    if sha256 in seen_hashes:
+                        duplicates += 1
+                        freed += size
+                    seen_hashes.add(sha256)
+                    blob = name if dry_run else None
+
+                if not dry_run:
+                    # The reference is counted with the row pointing at the blob
+                    with transaction.atomic():
+                        if blob is None:
+                            blob = default_storage.save_local_file(path, name, sha256)
+                        else:
+                            Blob.add_reference(sha256, blob, size)
+                        model.objects.filter(pk=file_obj.pk).update(file=blob)
+                moved[name] = (sha256, blob, size)
+                rows += 1
+
+        prefix = '[dry run] ' if dry_run else ''
+        self.stdout.write(
+            f'{prefix}{rows} rows moved to {len(seen_hashes)} blobs, {duplicates} duplicate files '
+            f'({freed} bytes) removed, {missing} rows point at a missing file'
+        )
+
+        if gc:
+            self.collect_garbage(dry_run, prefix)
+
+    def collect_garbage(self, dry_run, prefix):
+        unreferenced = list(Blob.objects.filter(refcount=0))
+        if not dry_run:
+            # A blob referenced again in the meantime is kept
+            unreferenced = [blob for blob in unreferenced if default_storage.purge(blob.name)]
+            for blob in unreferenced:
+                delete_thumbnails(blob.name)
+        self.stdout.write(
+            f'{prefix}{len(unreferenced)} unreferenced blobs ({sum(blob.size for blob in unreferenced)} bytes) deleted'
+        )
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats import uploads
+
+
+class Command(BaseCommand):
+    help = ('Drop the chunked uploads that received no chunk for CHAT_UPLOAD_EXPIRE_AFTER_HOURS, '
+            'with their partial files.  Meant to run regularly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=None,
+                            help='Drop the uploads idle for this many hours instead of CHAT_UPLOAD_EXPIRE_AFTER_HOURS')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Uploads dropped per batch')
+        parser.add_argument('--sleep', type=float, default=0.05,
+                            help='Seconds to pause between batches so live writers get the database')
+
+    def handle(self, *args, hours=None, batch_size=500, sleep=0.05, **options):
+        cutoff = uploads.expiry_cutoff() if hours is None else timezone.now() - timedelta(hours=hours)
+        total = uploads.expire_uploads(cutoff, batch_size, sleep)
+        self.stdout.write(f'{total} uploads idle since {cutoff:%Y-%m-%d %H:%M} dropped')
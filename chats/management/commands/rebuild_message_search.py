@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chats import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text index of the personal and group messages from scratch, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Messages indexed per transaction')
+
+    def handle(self, *args, batch_size=1000, **options):
+        if not search.is_available():
+            raise CommandError('Message search needs SQLite with FTS5')
+
+        def progress(total):
+            self.stdout.write(f'{total} messages indexed')
+
+        total = search.rebuild_index(batch_size, progress if options['verbosity'] > 1 else None)
+        self.stdout.write(f'Search index rebuilt with {total} messages')
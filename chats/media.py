@@ -0,0 +1,185 @@
+import hashlib
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, quote_etag
+
+from chats.models import Blob, ChatFile
+from chats.storage import BLOB_DIR
+from chats.thumbnails import THUMBNAIL_DIR
+from groups.models import GroupFile
+
+# Bytes read from the disk at once when Python streams a file itself
+STREAM_BLOCK_SIZE = 64 * 1024
+# Blobs and thumbnails never change under their name, they can be cached for good
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# Other media files may be replaced, browsers revalidate them with the ETag
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+_thumbnail_re = re.compile(rf'^{THUMBNAIL_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})_\d+\.webp$')
+_blob_re = re.compile(rf'^{BLOB_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})(\.\w+)?$')
+
+
+def thread_participant(user):
+    """Filter of the ChatFile rows of the personal threads of ``user``"""
+    return Q(thread__participants=user)
+
+
+def shared_file(user, name):
+    """
+    The ChatFile or GroupFile through which ``user`` may see the media file
+    ``name``, None when no file of their threads or groups is stored there.
+    The thumbnails of a blob are visible to whoever may see the blob.
+    """
+    match = _thumbnail_re.match(name)
+    if match:
+        name = Blob.objects.filter(sha256=match.group(1)).values_list('name', flat=True).first()
+        if name is None:
+            return None
+
+    chat_file = ChatFile.objects.filter(thread_participant(user), file=name).only('filename').first()
+    if chat_file is not None:
+        return chat_file
+    return GroupFile.objects.filter(file=name, group__members=user).only('filename').first()
+
+
+def shared_filename(user, name):
+    """
+    Filename of the media file ``name`` for ``user``, None when they may not
+    see it.  Granted accesses are cached for CHAT_MEDIA_PERMISSION_TTL
+    seconds, so a chat full of attachments costs one check per file and
+    not one per request; someone removed from a group keeps seeing its
+    files that long.  Refusals are not cached, the file may be shared with
+    them the next second.
+    """
+    key = f'chat-media-access:{user.id}:{hashlib.sha256(name.encode()).hexdigest()}'
+    filename = cache.get(key)
+    if filename is None:
+        file_obj = shared_file(user, name)
+        if file_obj is None:
+            return None
+        filename = file_obj.filename
+        cache.set(key, filename, getattr(settings, 'CHAT_MEDIA_PERMISSION_TTL', 300))
+    return filename
+
+
+def is_content_addressed(name):
+    """Whether ``name`` is a blob or a thumbnail, named after the hash of what it holds"""
+    return bool(_blob_re.match(name) or _thumbnail_re.match(name))
+
+
+def media_etag(name, stat):
+    """The hash of content-addressed files, the modification time and size of the others"""
+    if is_content_addressed(name):
+        return quote_etag(os.path.splitext(os.path.basename(name))[0])
+    return quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` of the single byte range asked by a Range header, end
+    included.  None means the whole file: no header, several ranges or a
+    malformed one, all of which the RFC lets us answer with a 200.  Raises
+    ValueError when the range lies past the end of the file.
+    """
+    match = _range_re.match(header.replace(' ', '')) if header else None
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last ``last`` bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(STREAM_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def media_response(request, name, filename):
+    """
+    Answer a GET or HEAD of media file ``name``: a 304 when the client's copy
+    is current, the requested byte range or the whole file otherwise.
+
+    With CHAT_MEDIA_ACCEL set, only the headers are built here and the
+    front proxy sends the bytes (ranges included): ``'x-accel-redirect'``
+    for nginx, redirected to the internal location CHAT_MEDIA_ACCEL_PREFIX,
+    ``'x-sendfile'`` for Apache and lighttpd.
+    """
+    try:
+        path = default_storage.path(name)
+        stat = os.stat(path)
+    except (SuspiciousFileOperation, OSError):
+        return JsonResponse({'error': 'File not found'}, status=404)
+
+    etag = media_etag(name, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if is_content_addressed(name) else REVALIDATE_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+        'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        'Content-Disposition': content_disposition_header(False, filename),
+    }
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if not_modified is not None:
+        for header in ('ETag', 'Last-Modified', 'Cache-Control'):
+            not_modified.headers[header] = headers[header]
+        return not_modified
+
+    accel = getattr(settings, 'CHAT_MEDIA_ACCEL', None)
+    if accel == 'x-accel-redirect':
+        response = HttpResponse(headers=headers)
+        response['X-Accel-Redirect'] = getattr(settings, 'CHAT_MEDIA_ACCEL_PREFIX', '/protected_chat_files/') + quote(name)
+        return response
+    if accel == 'x-sendfile':
+        response = HttpResponse(headers=headers)
+        response['X-Sendfile'] = path
+        return response
+
+    byte_range = None
+    # A range of an outdated copy is no use to the client, it gets the whole file
+    if request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416, headers=headers)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+
+    start, end = byte_range or (0, stat.st_size - 1)
+    length = end - start + 1
+    if request.method == 'HEAD':
+        response = HttpResponse(headers=headers)
+    else:
+        response = StreamingHttpResponse(read_range(path, start, length), headers=headers)
+    response['Content-Length'] = str(length)
+    if byte_range is not None:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    return response
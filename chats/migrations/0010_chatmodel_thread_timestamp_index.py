@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 01:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0009_delete_chinmoy'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmodel',
+            index=models.Index(fields=['thread_name', 'timestamp'], name='chat_thread_timestamp_idx'),
+        ),
+    ]
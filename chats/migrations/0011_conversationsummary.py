@@ -0,0 +1,97 @@
+# Generated by Django 5.2 on 2026-10-18 01:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def preview(message):
+    message = message or ''
+    return message[:50] + '...' if len(message) > 50 else message
+
+
+def backfill_summaries(apps, schema_editor):
+    ChatModel = apps.get_model('chats', 'ChatModel')
+    ChatNotification = apps.get_model('chats', 'ChatNotification')
+    ConversationSummary = apps.get_model('chats', 'ConversationSummary')
+    Group = apps.get_model('groups', 'Group')
+    GroupMessage = apps.get_model('groups', 'GroupMessage')
+    GroupNotification = apps.get_model('groups', 'GroupNotification')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+
+    usernames = dict(User.objects.values_list('id', 'username'))
+    summaries = []
+
+    unread_by_thread = {
+        (row['user_id'], row['chat__thread_name']): row['unread']
+        for row in ChatNotification.objects.filter(is_seen=False)
+        .values('user_id', 'chat__thread_name').annotate(unread=Count('id'))
+    }
+    thread_names = ChatModel.objects.exclude(thread_name=None).values_list('thread_name', flat=True).distinct()
+    for thread_name in thread_names:
+        try:
+            user_ids = [int(uid) for uid in thread_name.replace('chat_', '').split('-')]
+        except ValueError:
+            continue
+        if len(user_ids) != 2 or not all(uid in usernames for uid in user_ids):
+            continue
+        last = ChatModel.objects.filter(thread_name=thread_name).order_by('-timestamp', '-id').first()
+        for user_id, other_user_id in (user_ids, user_ids[::-1]):
+            summaries.append(ConversationSummary(
+                user_id=user_id, other_user_id=other_user_id, thread_name=thread_name,
+                last_message_id=last.id, last_message_preview=preview(last.message),
+                last_sender=last.sender or '', last_message_at=last.timestamp,
+                unread_count=unread_by_thread.get((user_id, thread_name), 0),
+            ))
+
+    unread_by_group = {
+        (row['user_id'], row['group_id']): row['unread']
+        for row in GroupNotification.objects.filter(is_seen=False)
+        .values('user_id', 'group_id').annotate(unread=Count('id'))
+    }
+    for group in Group.objects.all():
+        last = GroupMessage.objects.filter(group=group).order_by('-id').first()
+        for member_id in group.members.values_list('id', flat=True):
+            summaries.append(ConversationSummary(
+                user_id=member_id, group_id=group.id,
+                last_message_id=last.id if last else None,
+                last_message_preview=preview(last.content) if last else '',
+                last_sender=usernames.get(last.sender_id, '') if last else '',
+                last_message_at=last.timestamp if last else None,
+                unread_count=unread_by_group.get((member_id, group.id), 0),
+            ))
+
+    ConversationSummary.objects.bulk_create(summaries, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0010_chatmodel_thread_timestamp_index'),
+        ('groups', '0002_groupfile'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('thread_name', models.CharField(blank=True, max_length=50, null=True)),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=60)),
+                ('last_sender', models.CharField(blank=True, default='', max_length=150)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='groups.group')),
+                ('other_user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_message_at'], name='summary_user_activity_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'thread_name'), name='summary_user_thread_uniq'), models.UniqueConstraint(fields=('user', 'group'), name='summary_user_group_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
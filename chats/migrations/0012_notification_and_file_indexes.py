@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 01:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0011_conversationsummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatfile',
+            index=models.Index(fields=['thread_name'], name='chatfile_thread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatnotification',
+            index=models.Index(fields=['user', 'is_seen'], name='chatnotif_user_seen_idx'),
+        ),
+    ]
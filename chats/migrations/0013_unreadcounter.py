@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 01:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_counters(apps, schema_editor):
+    ConversationSummary = apps.get_model('chats', 'ConversationSummary')
+    UnreadCounter = apps.get_model('chats', 'UnreadCounter')
+
+    totals = ConversationSummary.objects.values('user_id').annotate(total=Sum('unread_count'))
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(user_id=row['user_id'], count=row['total']) for row in totals],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0012_notification_and_file_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counter', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2 on 2026-10-18 01:50
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Min, OuterRef, Subquery
+
+
+def backfill_watermarks(apps, schema_editor):
+    """
+    The watermark of a conversation sits just below its oldest unseen
+    notification, or on its last message when everything was seen.
+    """
+    ConversationSummary = apps.get_model('chats', 'ConversationSummary')
+    ChatNotification = apps.get_model('chats', 'ChatNotification')
+    GroupNotification = apps.get_model('groups', 'GroupNotification')
+
+    ConversationSummary.objects.filter(last_message_id__isnull=False).update(
+        last_read_message_id=F('last_message_id')
+    )
+
+    oldest_unseen = {}
+    for row in ChatNotification.objects.filter(is_seen=False).values(
+            'user_id', 'chat__thread_name').annotate(oldest=Min('chat_id')):
+        oldest_unseen[(row['user_id'], row['chat__thread_name'], None)] = row['oldest']
+    for row in GroupNotification.objects.filter(is_seen=False).values(
+            'user_id', 'group_id').annotate(oldest=Min('message_id')):
+        oldest_unseen[(row['user_id'], None, row['group_id'])] = row['oldest']
+
+    summaries = []
+    for summary in ConversationSummary.objects.filter(unread_count__gt=0).iterator():
+        oldest = oldest_unseen.get((summary.user_id, summary.thread_name, summary.group_id))
+        if oldest is not None:
+            summary.last_read_message_id = oldest - 1
+            summaries.append(summary)
+    ConversationSummary.objects.bulk_update(summaries, ['last_read_message_id'], batch_size=500)
+
+
+def restore_seen_flags(apps, schema_editor):
+    ConversationSummary = apps.get_model('chats', 'ConversationSummary')
+    ChatNotification = apps.get_model('chats', 'ChatNotification')
+
+    watermark = ConversationSummary.objects.filter(
+        user_id=OuterRef('user_id'), thread_name=OuterRef('chat__thread_name')
+    ).values('last_read_message_id')
+    ChatNotification.objects.annotate(watermark=Subquery(watermark)).filter(
+        chat_id__lte=F('watermark')
+    ).update(is_seen=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0013_unreadcounter'),
+        ('groups', '0003_groupnotification_user_seen_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_watermarks, restore_seen_flags),
+        migrations.RemoveIndex(
+            model_name='chatnotification',
+            name='chatnotif_user_seen_idx',
+        ),
+        migrations.RemoveField(
+            model_name='chatnotification',
+            name='is_seen',
+        ),
+        migrations.AddIndex(
+            model_name='chatnotification',
+            index=models.Index(fields=['user', 'chat'], name='chatnotif_user_chat_idx'),
+        ),
+    ]
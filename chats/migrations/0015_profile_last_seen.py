@@ -0,0 +1,22 @@
+# Generated by Django 5.2 on 2026-10-18 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0014_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='userprofilemodel',
+            name='online_status',
+        ),
+        migrations.AddField(
+            model_name='userprofilemodel',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2 on 2026-10-18 02:09
+
+from django.db import migrations, models
+
+
+def backfill_sequences(apps, schema_editor):
+    """Number the messages of every thread in id order"""
+    ChatModel = apps.get_model('chats', 'ChatModel')
+    MessageSequence = apps.get_model('chats', 'MessageSequence')
+
+    last_seqs = {}
+    threads = ChatModel.objects.exclude(thread_name=None).order_by().values_list('thread_name', flat=True).distinct()
+    for thread_name in threads:
+        messages = list(ChatModel.objects.filter(thread_name=thread_name).order_by('id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        ChatModel.objects.bulk_update(messages, ['seq'], batch_size=500)
+        last_seqs[thread_name] = len(messages)
+
+    MessageSequence.objects.bulk_create(
+        [MessageSequence(conversation=thread_name, last_seq=last_seq) for thread_name, last_seq in last_seqs.items()],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0015_profile_last_seen'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation', models.CharField(max_length=50, unique=True)),
+                ('last_seq', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatmodel',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatmodel',
+            constraint=models.UniqueConstraint(fields=('thread_name', 'seq'), name='chat_thread_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 02:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0018_blob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatfile',
+            index=models.Index(fields=['file'], name='chatfile_file_idx'),
+        ),
+    ]
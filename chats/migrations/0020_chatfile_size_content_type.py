@@ -0,0 +1,63 @@
+# Generated by Django 5.2 on 2026-10-18 02:27
+
+import mimetypes
+from urllib.parse import unquote, urlparse
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+# Copies of chats.storage.guess_content_type and media_name as of this migration
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def media_name(value):
+    path = urlparse(value).path if '://' in value else value
+    if path.startswith(settings.MEDIA_URL):
+        return unquote(path[len(settings.MEDIA_URL):])
+    if '://' in value or path.startswith('/'):
+        return None
+    return path
+
+
+def backfill_file_metadata(apps, schema_editor):
+    """Stat every file once now instead of on every details request"""
+    ChatFile = apps.get_model('chats', 'ChatFile')
+
+    batch = []
+    for chat_file in ChatFile.objects.only('id', 'file', 'filename').iterator(chunk_size=500):
+        name = media_name(chat_file.file.name or '')
+        try:
+            chat_file.size = default_storage.size(name) if name else None
+        except OSError:
+            # Missing file, its details keep reporting a size of 0
+            chat_file.size = None
+        chat_file.content_type = guess_content_type(chat_file.filename)
+        batch.append(chat_file)
+        if len(batch) == 500:
+            ChatFile.objects.bulk_update(batch, ['size', 'content_type'])
+            batch = []
+    ChatFile.objects.bulk_update(batch, ['size', 'content_type'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0019_chatfile_file_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatfile',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatfile',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_file_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations
+
+# The index and its triggers as chats.search used them when this migration
+# was written, frozen here so later changes to the app do not alter it
+CREATE_INDEX = [
+    "CREATE VIRTUAL TABLE chat_message_search USING fts5("
+    "body, conversation UNINDEXED, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+
+    "CREATE TRIGGER chatmodel_search_insert AFTER INSERT ON chats_chatmodel BEGIN "
+    "INSERT INTO chat_message_search (rowid, body, conversation) VALUES (new.id * 2, new.message, new.thread_name); END",
+    "CREATE TRIGGER chatmodel_search_update AFTER UPDATE OF message, thread_name ON chats_chatmodel BEGIN "
+    "INSERT OR REPLACE INTO chat_message_search (rowid, body, conversation) "
+    "VALUES (new.id * 2, new.message, new.thread_name); END",
+    "CREATE TRIGGER chatmodel_search_delete AFTER DELETE ON chats_chatmodel BEGIN "
+    "DELETE FROM chat_message_search WHERE rowid = old.id * 2; END",
+    "INSERT INTO chat_message_search (rowid, body, conversation) "
+    "SELECT chats_chatmodel.id * 2, chats_chatmodel.message, chats_chatmodel.thread_name FROM chats_chatmodel",
+
+    "CREATE TRIGGER groupmessage_search_insert AFTER INSERT ON groups_groupmessage BEGIN "
+    "INSERT INTO chat_message_search (rowid, body, conversation) "
+    "VALUES (new.id * 2 + 1, new.content, 'group_' || new.group_id); END",
+    "CREATE TRIGGER groupmessage_search_update AFTER UPDATE OF content, group_id ON groups_groupmessage BEGIN "
+    "INSERT OR REPLACE INTO chat_message_search (rowid, body, conversation) "
+    "VALUES (new.id * 2 + 1, new.content, 'group_' || new.group_id); END",
+    "CREATE TRIGGER groupmessage_search_delete AFTER DELETE ON groups_groupmessage BEGIN "
+    "DELETE FROM chat_message_search WHERE rowid = old.id * 2 + 1; END",
+    "INSERT INTO chat_message_search (rowid, body, conversation) "
+    "SELECT groups_groupmessage.id * 2 + 1, groups_groupmessage.content, 'group_' || groups_groupmessage.group_id "
+    "FROM groups_groupmessage",
+]
+
+DROP_INDEX = [
+    'DROP TRIGGER IF EXISTS chatmodel_search_insert',
+    'DROP TRIGGER IF EXISTS chatmodel_search_update',
+    'DROP TRIGGER IF EXISTS chatmodel_search_delete',
+    'DROP TRIGGER IF EXISTS groupmessage_search_insert',
+    'DROP TRIGGER IF EXISTS groupmessage_search_update',
+    'DROP TRIGGER IF EXISTS groupmessage_search_delete',
+    'DROP TABLE IF EXISTS chat_message_search',
+]
+
+
+def create_search_index(apps, schema_editor):
+    """FTS5 index of the personal and group messages, see chats.search"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_INDEX:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_INDEX:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0020_chatfile_size_content_type'),
+        ('groups', '0005_groupfile_file_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
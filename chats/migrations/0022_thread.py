@@ -0,0 +1,170 @@
+# Generated by Django 5.2 on 2026-10-18 02:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+# The chats_chatmodel triggers of migration 0021, frozen like there
+SEARCH_TRIGGERS = [
+    'DROP TRIGGER IF EXISTS chatmodel_search_insert',
+    'DROP TRIGGER IF EXISTS chatmodel_search_update',
+    'DROP TRIGGER IF EXISTS chatmodel_search_delete',
+    "CREATE TRIGGER chatmodel_search_insert AFTER INSERT ON chats_chatmodel BEGIN "
+    "INSERT INTO chat_message_search (rowid, body, conversation) VALUES (new.id * 2, new.message, new.thread_name); END",
+    "CREATE TRIGGER chatmodel_search_update AFTER UPDATE OF message, thread_name ON chats_chatmodel BEGIN "
+    "INSERT OR REPLACE INTO chat_message_search (rowid, body, conversation) "
+    "VALUES (new.id * 2, new.message, new.thread_name); END",
+    "CREATE TRIGGER chatmodel_search_delete AFTER DELETE ON chats_chatmodel BEGIN "
+    "DELETE FROM chat_message_search WHERE rowid = old.id * 2; END",
+]
+
+
+def parse_thread_name(thread_name):
+    """The two user ids of a ``chat_<id>-<id>`` thread name, None when it is not one"""
+    try:
+        first, second = thread_name.removeprefix('chat_').split('-')
+        user_ids = int(first), int(second)
+    except (AttributeError, ValueError):
+        return None
+    # The canonical name has the bigger id first and no padding
+    if thread_name != f'chat_{max(user_ids)}-{min(user_ids)}':
+        return None
+    return user_ids
+
+
+def in_batches(iterable, size=BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def update_in_batches(model, **values):
+    """Run ``update(**values)`` over ``model`` one id range at a time, each its own short statement"""
+    last_id = 0
+    while True:
+        ids = list(model.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+        if not ids:
+            return
+        model.objects.filter(id__gte=ids[0], id__lte=ids[-1]).update(**values)
+        last_id = ids[-1]
+
+
+def create_threads(apps, schema_editor):
+    """
+    Create a Thread for every thread name in use and point the messages,
+    notifications and files at it.  Names that are not ``chat_<id>-<id>``
+    of two existing users are left without a thread.
+    """
+    Thread = apps.get_model('chats', 'Thread')
+    ChatModel = apps.get_model('chats', 'ChatModel')
+    ChatNotification = apps.get_model('chats', 'ChatNotification')
+    ChatFile = apps.get_model('chats', 'ChatFile')
+    ChunkedUpload = apps.get_model('chats', 'ChunkedUpload')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    Participant = Thread.participants.through
+
+    user_ids = set(User.objects.values_list('id', flat=True))
+    names = set()
+    for model in (ChatModel, ChatFile, ChunkedUpload):
+        names.update(model.objects.exclude(thread_name=None).order_by().values_list('thread_name', flat=True).distinct())
+    valid = {}
+    for name in names:
+        participants = parse_thread_name(name)
+        if participants is not None and set(participants) <= user_ids:
+            valid[name] = participants
+
+    for batch in in_batches(sorted(valid)):
+        threads = Thread.objects.bulk_create([Thread(name=name) for name in batch])
+        Participant.objects.bulk_create([
+            Participant(thread_id=thread.id, user_id=user_id) for thread in threads for user_id in valid[thread.name]
+        ])
+
+    thread_of_name = Subquery(Thread.objects.filter(name=OuterRef('thread_name')).values('id')[:1])
+    update_in_batches(ChatModel, thread_id=thread_of_name)
+    update_in_batches(ChatFile, thread_id=thread_of_name)
+    ChunkedUpload.objects.update(thread_id=thread_of_name)
+    update_in_batches(ChatNotification, thread_id=Subquery(
+        ChatModel.objects.filter(id=OuterRef('chat_id')).values('thread_id')[:1]
+    ))
+
+
+def restore_search_triggers(apps, schema_editor):
+    # SQLite drops the triggers of chats_chatmodel whenever the table is rebuilt
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in SEARCH_TRIGGERS:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0021_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.CreateModel(
+            name='Thread',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='chatmodel',
+            name='chat_thread_seq_uniq',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatfile',
+            name='chatfile_thread_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatmodel',
+            name='chat_thread_timestamp_idx',
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='participants',
+            field=models.ManyToManyField(related_name='chat_threads', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatfile',
+            name='thread',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='files', to='chats.thread'),
+        ),
+        migrations.AddField(
+            model_name='chatmodel',
+            name='thread',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chats.thread'),
+        ),
+        migrations.AddField(
+            model_name='chatnotification',
+            name='thread',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='chats.thread'),
+        ),
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='thread',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chats.thread'),
+        ),
+        migrations.RunPython(create_threads, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatmodel',
+            index=models.Index(fields=['thread', 'timestamp'], name='chat_thread_ts_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmodel',
+            constraint=models.UniqueConstraint(fields=('thread', 'seq'), name='chat_thread_id_seq_uniq'),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2 on 2026-10-18 02:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+# The chats_chatmodel triggers of migration 0021, frozen like there
+SEARCH_TRIGGERS = [
+    'DROP TRIGGER IF EXISTS chatmodel_search_insert',
+    'DROP TRIGGER IF EXISTS chatmodel_search_update',
+    'DROP TRIGGER IF EXISTS chatmodel_search_delete',
+    "CREATE TRIGGER chatmodel_search_insert AFTER INSERT ON chats_chatmodel BEGIN "
+    "INSERT INTO chat_message_search (rowid, body, conversation) VALUES (new.id * 2, new.message, new.thread_name); END",
+    "CREATE TRIGGER chatmodel_search_update AFTER UPDATE OF message, thread_name ON chats_chatmodel BEGIN "
+    "INSERT OR REPLACE INTO chat_message_search (rowid, body, conversation) "
+    "VALUES (new.id * 2, new.message, new.thread_name); END",
+    "CREATE TRIGGER chatmodel_search_delete AFTER DELETE ON chats_chatmodel BEGIN "
+    "DELETE FROM chat_message_search WHERE rowid = old.id * 2; END",
+]
+
+
+def restore_search_triggers(apps, schema_editor):
+    # SQLite drops the triggers of chats_chatmodel whenever the table is rebuilt
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in SEARCH_TRIGGERS:
+            schema_editor.execute(statement)
+
+
+def restore_sender_names(apps, schema_editor):
+    """Write back the usernames the backfill replaced by the foreign key"""
+    ChatModel = apps.get_model('chats', 'ChatModel')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    ChatModel.objects.filter(sender__isnull=False).update(
+        sender_name=Subquery(User.objects.filter(id=OuterRef('sender_id')).values('username')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+    """
+    The username column becomes ``sender_name`` and ``sender`` a foreign key,
+    filled afterwards by the backfill_chat_senders command
+    """
+
+    dependencies = [
+        ('chats', '0022_thread'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.RenameField(
+            model_name='chatmodel',
+            old_name='sender',
+            new_name='sender_name',
+        ),
+        migrations.AlterField(
+            model_name='chatmodel',
+            name='sender_name',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmodel',
+            name='sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore_sender_names),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
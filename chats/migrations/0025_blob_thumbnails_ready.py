@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 03:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0024_archive_segment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='thumbnails_ready',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-18 03:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0025_blob_thumbnails_ready'),
+        ('groups', '0005_groupfile_file_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='chunkedupload',
+            index=models.Index(fields=['updated_at'], name='chunkedupload_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-18 04:10
+
+from urllib.parse import unquote, urlparse
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import migrations
+
+
+# Copy of chats.storage.media_name as of this migration
+def media_name(value):
+    path = urlparse(value).path if '://' in value else value
+    if path.startswith(settings.MEDIA_URL):
+        return unquote(path[len(settings.MEDIA_URL):])
+    if '://' in value or path.startswith('/'):
+        return None
+    return path
+
+
+def store_media_names(apps, schema_editor):
+    """
+    The rows file messages name were saved with the URL of their upload,
+    store its media name instead so they can be served like any upload
+    """
+    ChatFile = apps.get_model('chats', 'ChatFile')
+    Blob = apps.get_model('chats', 'Blob')
+
+    batch = []
+    for chat_file in ChatFile.objects.filter(file__contains='/').only('id', 'file', 'size').iterator(chunk_size=500):
+        name = media_name(chat_file.file.name)
+        if not name or name == chat_file.file.name:
+            continue
+        chat_file.file = name
+        if chat_file.size is None:
+            blob_size = Blob.objects.filter(name=name).values_list('size', flat=True).first()
+            try:
+                chat_file.size = blob_size if blob_size is not None else default_storage.size(name)
+            except OSError:
+                pass
+        batch.append(chat_file)
+        if len(batch) == 500:
+            ChatFile.objects.bulk_update(batch, ['file', 'size'])
+            batch = []
+    ChatFile.objects.bulk_update(batch, ['file', 'size'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0026_chunkedupload_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(store_media_names, migrations.RunPython.noop),
+    ]
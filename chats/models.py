@@ -1,37 +1,244 @@
-from django.db import models
+import uuid
+from collections import Counter
+
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 # Create your models here.
 
+def get_thread_name(user_id, other_user_id):
+    """
+    Build the personal thread name for two users, e.g. ``chat_12-7``.
+    The bigger id always comes first so both sides agree on the name.
+    """
+    if int(user_id) > int(other_user_id):
+        return f'chat_{user_id}-{other_user_id}'
+    return f'chat_{other_user_id}-{user_id}'
+
+
+def parse_thread_name(thread_name):
+    """The two user ids of a ``chat_<id>-<id>`` thread name, None when it is not one"""
+    try:
+        first, second = thread_name.removeprefix('chat_').split('-')
+        user_ids = int(first), int(second)
+    except (AttributeError, ValueError):
+        return None
+    if not thread_name.startswith('chat_') or get_thread_name(*user_ids) != thread_name:
+        return None
+    return user_ids
+
+
+def get_group_conversation(group_id):
+    """Name of a group's conversation, the same as its channel layer group"""
+    return f'group_{group_id}'
+
+
+def get_message_preview(message):
+    """Shorten a message to the preview shown in the sidebar and notifications"""
+    message = message or ''
+    return message[:50] + '...' if len(message) > 50 else message
+
+
 class UserProfileModel(models.Model):
     objects = models.Manager()
     user = models.OneToOneField(to=User, on_delete=models.CASCADE)
     name = models.CharField(blank=True, null=True, max_length=100)
-    online_status = models.BooleanField(default=False)
+    # Written in batches by chats.presence, live presence is only kept in memory
+    last_seen = models.DateTimeField(null=True, blank=True)
 
     def __str__(self) -> str:
         return self.user.username
 
 
+class Thread(models.Model):
+    """
+    A personal conversation between two users.
+
+    Messages, notifications and files reference it by id.  ``name`` is its
+    ``chat_<id>-<id>`` key, which stays the name of its channel layer group
+    and message sequence.
+    """
+    objects = models.Manager()
+    name = models.CharField(max_length=50, unique=True)
+    participants = models.ManyToManyField(User, related_name='chat_threads')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def between(cls, user_id, other_user_id):
+        """The thread of two users, created on first use"""
+        name = get_thread_name(user_id, other_user_id)
+        thread = cls.objects.filter(name=name).first()
+        if thread is None:
+            with transaction.atomic():
+                thread, created = cls.objects.get_or_create(name=name)
+                if created:
+                    thread.participants.add(user_id, other_user_id)
+        return thread
+
+    @classmethod
+    def for_participant(cls, user, thread_name):
+        """
+        The thread named ``thread_name`` as sent by a client, None unless it
+        is a well-formed name of a thread of ``user`` with an existing user
+        """
+        user_ids = parse_thread_name(thread_name)
+        if user_ids is None or user.id not in user_ids:
+            return None
+        thread = cls.objects.filter(name=thread_name, participants=user).first()
+        if thread is None:
+            other_user_id = user_ids[1] if user_ids[0] == user.id else user_ids[0]
+            if User.objects.filter(id=other_user_id).exists():
+                thread = cls.between(user.id, other_user_id)
+        return thread
+
+    @classmethod
+    def has_participant(cls, thread_id, user):
+        return cls.participants.through.objects.filter(thread_id=thread_id, user_id=user.id).exists()
+
+
 class ChatModel(models.Model):
     objects = models.Manager()
-    sender = models.CharField(max_length=100, default=None)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='chat_messages')
+    # Username of the rows written before ``sender`` existed, until backfill_chat_senders resolves it
+    sender_name = models.CharField(max_length=100, null=True, blank=True)
     message = models.TextField(null=True, blank=True)
+    # Indexed by chat_thread_ts_idx, whose first column it is
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, null=True, blank=True, related_name='messages',
+                               db_index=False)
+    # The thread's name, kept for the channel layer events and the search index
     thread_name = models.CharField(null=True, blank=True, max_length=50)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Position in the thread, see MessageSequence
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # History pages are read newest first within one thread
+            models.Index(fields=['thread', 'timestamp'], name='chat_thread_ts_idx'),
+        ]
+        constraints = [
+            # Also the index of the resume range query
+            models.UniqueConstraint(fields=['thread', 'seq'], name='chat_thread_id_seq_uniq'),
+        ]
 
     def __str__(self) -> str:
         return self.message
+
+    @property
+    def sender_username(self):
+        """Username of the sender, load ``sender`` with select_related"""
+        return self.sender.username if self.sender_id else self.sender_name
     
+class MessageSequence(models.Model):
+    """
+    Last sequence number handed out in each conversation: a personal thread
+    (``chat_<id>-<id>``) or a group (``group_<id>``).
+
+    Every message gets the next number of its conversation, so a client
+    reconnecting with the last number it saw is sent just the messages
+    after it.
+    """
+    objects = models.Manager()
+    conversation = models.CharField(max_length=50, unique=True)
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"{self.conversation}: {self.last_seq}"
+
+    @classmethod
+    def reserve(cls, conversation, count=1):
+        """
+        Reserve ``count`` consecutive sequence numbers of ``conversation`` and
+        return the first one, in a single upsert.  Called in the transaction
+        saving the messages, SQLite's write lock then keeps the numbers in
+        commit order.
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (conversation, last_seq) VALUES (%s, %s) '
+                f'ON CONFLICT (conversation) DO UPDATE SET last_seq = last_seq + excluded.last_seq '
+                f'RETURNING last_seq',
+                [conversation, count]
+            )
+            return cursor.fetchone()[0] - count + 1
+
+
 class ChatNotification(models.Model):
     chat = models.ForeignKey(to=ChatModel, on_delete=models.CASCADE)
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
-    is_seen = models.BooleanField(default=False)
+    thread = models.ForeignKey(to=Thread, on_delete=models.CASCADE, null=True, blank=True)
     objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            # Notifications of one user newer than a read watermark
+            models.Index(fields=['user', 'chat'], name='chatnotif_user_chat_idx'),
+        ]
+
     def __str__(self) -> str:
         return self.user.username
 
 
+class Blob(models.Model):
+    """
+    One distinct file content, stored once under its SHA-256 by
+    chats.storage.ContentAddressedStorage.
+
+    ``refcount`` is the number of ChatFile and GroupFile rows using it.  A
+    blob nobody references any more is only removed from disk by
+    ``manage.py dedupe_media --gc``.
+    """
+    objects = models.Manager()
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Every thumbnail is on disk, see chats.thumbnails.thumbnail_urls
+    thumbnails_ready = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
+
+    @classmethod
+    def add_reference(cls, sha256, name, size):
+        """
+        Count one more reference to the blob of ``sha256``, creating its row
+        as ``name`` if it is new, and return the name it is stored under
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (sha256, name, size, refcount, created_at, thumbnails_ready) '
+                f'VALUES (%s, %s, %s, 1, %s, FALSE) '
+                f'ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1 '
+                f'RETURNING name',
+                [sha256, name, size, connection.ops.adapt_datetimefield_value(timezone.now())]
+            )
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def retain(cls, name):
+        """Count one more reference to the blob stored as ``name``, return its size, None if there is none"""
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {table} SET refcount = refcount + 1 WHERE name = %s RETURNING size', [name])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def release(cls, name):
+        """Drop one reference to the blob stored as ``name``, if it is one"""
+        cls.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1)
+
+
 class ChatFile(models.Model):
     objects = models.Manager()
     file = models.FileField(upload_to='chat_files/')
@@ -39,8 +246,277 @@ class ChatFile(models.Model):
     file_type = models.CharField(max_length=100)
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploaded_files')
     upload_date = models.DateTimeField(auto_now_add=True)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, null=True, blank=True, related_name='files')
     thread_name = models.CharField(max_length=255)
+    # Known at upload, so the file details need no stat of the file
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        indexes = [
+            # Permission check of the media view, see chats.media.shared_file
+            models.Index(fields=['file'], name='chatfile_file_idx'),
+        ]
 
     def __str__(self):
         return f"{self.filename} ({self.file_type})"
 
+
+class ChunkedUpload(models.Model):
+    """
+    A file being uploaded chunk by chunk, see chats.uploads.
+
+    ``received`` bytes are already on disk in the partial file, a client
+    resuming after a dropped connection continues from there.  Once complete
+    the file becomes a ChatFile of ``thread`` or a GroupFile of ``group``.
+    Uploads idle for CHAT_UPLOAD_EXPIRE_AFTER_HOURS are dropped by
+    ``manage.py expire_uploads``.
+    """
+    objects = models.Manager()
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+    filename = models.CharField(max_length=255)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    thread_name = models.CharField(max_length=255, null=True, blank=True)
+    group = models.ForeignKey(to='groups.Group', on_delete=models.CASCADE, null=True, blank=True,
+                              related_name='+')
+    size = models.PositiveBigIntegerField()
+    # Hex SHA-256 of the whole file announced by the client, checked at completion
+    checksum = models.CharField(max_length=64, blank=True, default='')
+    received = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Time of the last chunk received
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Sweep of the abandoned uploads, see chats.uploads.expire_uploads
+            models.Index(fields=['updated_at'], name='chunkedupload_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
+
+class ConversationSummary(models.Model):
+    """
+    One sidebar entry: a participant's view of a personal thread or a group.
+
+    Rows are updated in the same transaction that saves a message, so the
+    sidebar is a single indexed query instead of one query per conversation.
+    Exactly one of ``thread_name`` and ``group`` is set.
+
+    ``last_read_message_id`` is the user's read watermark: every message of
+    the conversation up to and including that id has been read.
+    """
+    objects = models.Manager()
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='conversation_summaries')
+    thread_name = models.CharField(null=True, blank=True, max_length=50)
+    other_user = models.ForeignKey(to=User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    group = models.ForeignKey(to='groups.Group', on_delete=models.CASCADE, null=True, blank=True,
+                              related_name='summaries')
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=60, blank=True, default='')
+    last_sender = models.CharField(max_length=150, blank=True, default='')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'thread_name'], name='summary_user_thread_uniq'),
+            models.UniqueConstraint(fields=['user', 'group'], name='summary_user_group_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at'], name='summary_user_activity_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.user.username}: {self.thread_name or self.group_id}"
+
+    @classmethod
+    def record_personal_message(cls, chat, sender, receiver):
+        """
+        Update both participants' entries for a new personal message.
+        Must be called inside the transaction that saved ``chat``.
+        """
+        cls.record_personal_messages([(chat, sender, receiver)])
+
+    @classmethod
+    def record_personal_messages(cls, entries):
+        """
+        Same as ``record_personal_message`` for ``(chat, sender, receiver)``
+        entries in the order they were sent, with each thread's entries
+        updated once whatever the number of its messages.
+        """
+        by_thread = {}
+        for entry in entries:
+            by_thread.setdefault(entry[0].thread_name, []).append(entry)
+
+        unread_counts = {}
+        for thread_name, thread_entries in by_thread.items():
+            last_chat, last_sender, _ = thread_entries[-1]
+            values = {
+                'last_message_id': last_chat.id,
+                'last_message_preview': get_message_preview(last_chat.message),
+                'last_sender': last_sender.username,
+                'last_message_at': last_chat.timestamp,
+            }
+            # user id -> [user, other user, new unread messages, own last message id]
+            participants = {}
+            for chat, sender, receiver in thread_entries:
+                # The sender has read everything up to their own message
+                participants.setdefault(sender.id, [sender, receiver, 0, None])[3] = chat.id
+                participants.setdefault(receiver.id, [receiver, sender, 0, None])[2] += 1
+
+            for user, other_user, unread, last_read_message_id in participants.values():
+                read_values = {} if last_read_message_id is None else {'last_read_message_id': last_read_message_id}
+                updated = cls.objects.filter(user=user, thread_name=thread_name).update(
+                    unread_count=F('unread_count') + unread, **values, **read_values
+                )
+                if not updated:
+                    cls.objects.create(user=user, thread_name=thread_name, other_user=other_user,
+                                       unread_count=unread, **values, **read_values)
+                unread_counts[user.id] = unread_counts.get(user.id, 0) + unread
+        UnreadCounter.add(unread_counts)
+
+    @classmethod
+    def record_group_message(cls, message, sender):
+        """
+        Update every member's entry for a new group message in a constant number
+        of queries.  Must be called inside the transaction that saved ``message``.
+        """
+        cls.record_group_messages([(message, sender)])
+
+    @classmethod
+    def record_group_messages(cls, entries):
+        """
+        Same as ``record_group_message`` for ``(message, sender)`` entries in
+        the order they were sent, in a constant number of queries per group.
+        """
+        by_group = {}
+        for entry in entries:
+            by_group.setdefault(entry[0].group_id, []).append(entry)
+
+        unread_counts = {}
+        for group_id, group_entries in by_group.items():
+            last_message, last_sender = group_entries[-1]
+            sent_counts = Counter(sender.id for _, sender in group_entries)
+            # The senders have read everything up to their own last message
+            last_sent = {sender.id: message.id for message, sender in group_entries}
+
+            member_ids = list(last_message.group.members.values_list('id', flat=True))
+            cls.objects.bulk_create(
+                [cls(user_id=member_id, group_id=group_id) for member_id in member_ids],
+                ignore_conflicts=True
+            )
+            summaries = cls.objects.filter(group_id=group_id)
+            summaries.update(
+                last_message_id=last_message.id,
+                last_message_preview=get_message_preview(last_message.content),
+                last_sender=last_sender.username,
+                last_message_at=last_message.timestamp,
+                last_read_message_id=Case(
+                    *[When(user_id=user_id, then=Value(message_id)) for user_id, message_id in last_sent.items()],
+                    default=F('last_read_message_id'),
+                    output_field=models.BigIntegerField()
+                ),
+            )
+            # Everyone gets the messages they did not send themselves
+            summaries.update(unread_count=F('unread_count') + Case(
+                *[When(user_id=user_id, then=Value(len(group_entries) - sent)) for user_id, sent in sent_counts.items()],
+                default=Value(len(group_entries)),
+                output_field=models.PositiveIntegerField()
+            ))
+            for member_id in member_ids:
+                unread = len(group_entries) - sent_counts.get(member_id, 0)
+                unread_counts[member_id] = unread_counts.get(member_id, 0) + unread
+        UnreadCounter.add(unread_counts)
+
+    @classmethod
+    def mark_read(cls, user, thread_name=None, group_id=None):
+        """
+        Move the read watermark of one conversation, or of every conversation
+        of ``user`` when neither ``thread_name`` nor ``group_id`` is given, up
+        to its last message and take its unread messages off the user's total.
+
+        Two UPDATE statements however many messages were unread.
+        """
+        summaries = cls.objects.filter(user=user, unread_count__gt=0)
+        if thread_name is not None:
+            summaries = summaries.filter(thread_name=thread_name)
+        elif group_id is not None:
+            summaries = summaries.filter(group_id=group_id)
+
+        unread = summaries.order_by().values('user').annotate(total=Sum('unread_count')).values('total')
+        with transaction.atomic():
+            UnreadCounter.objects.filter(user=user).update(
+                count=Greatest(F('count') - Coalesce(Subquery(unread), 0), 0)
+            )
+            summaries.update(unread_count=0, last_read_message_id=F('last_message_id'))
+
+
+class UnreadCounter(models.Model):
+    """
+    Total unread messages of a user over all personal threads and groups.
+
+    Always equal to the sum of the user's ``ConversationSummary.unread_count``,
+    it is only changed through ConversationSummary so notification pushes can
+    read it with a single primary key probe.
+    """
+    objects = models.Manager()
+    user = models.OneToOneField(to=User, on_delete=models.CASCADE, related_name='unread_counter')
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"{self.user.username}: {self.count}"
+
+    @classmethod
+    def add(cls, counts):
+        """
+        Add ``{user_id: unread messages}`` to the counters, with one UPDATE
+        per distinct amount
+        """
+        counts = {user_id: count for user_id, count in counts.items() if count}
+        if not counts:
+            return
+        cls.objects.bulk_create([cls(user_id=user_id) for user_id in counts], ignore_conflicts=True)
+        by_amount = {}
+        for user_id, count in counts.items():
+            by_amount.setdefault(count, []).append(user_id)
+        for count, user_ids in by_amount.items():
+            cls.objects.filter(user_id__in=user_ids).update(count=F('count') + count)
+
+    @classmethod
+    def get_count(cls, user_id):
+        return cls.objects.filter(user_id=user_id).values_list('count', flat=True).first() or 0
+
+
+class ArchiveSegment(models.Model):
+    """
+    Messages of one conversation moved out of the hot tables by
+    chats.archive: one gzipped JSON member appended to the conversation's
+    segment file, ``length`` bytes at ``offset``.  Only segments listed here
+    exist, bytes a crashed run appended without its row are never read.
+    """
+    objects = models.Manager()
+    # chat_<id>-<id> or group_<id>, also the name of the segment file
+    conversation = models.CharField(max_length=60)
+    offset = models.PositiveBigIntegerField()
+    length = models.PositiveIntegerField()
+    message_count = models.PositiveIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # History pages walk the segments of one conversation by id
+            models.Index(fields=['conversation', 'last_id'], name='archive_conversation_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.conversation}: {self.first_id}-{self.last_id}"
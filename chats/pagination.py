@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def get_page_size(request):
+    """
+    Read ``?limit=`` from the request, falling back to the default page size
+    and never going above the configured maximum
+    """
+    default = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+    try:
+        limit = int(request.GET.get('limit', default))
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def parse_int(value):
+    """Parse an optional integer query parameter, returning None when missing or invalid"""
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_float(value):
+    """Parse an optional float query parameter, returning None when missing or invalid"""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_timestamp(value):
+    """Parse an optional ISO-8601 query parameter, returning None when missing or invalid"""
+    if not value:
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return None
+
+
+def keyset_before(queryset, before_timestamp=None, before_id=None):
+    """
+    Restrict ``queryset`` to rows strictly older than the (timestamp, id) cursor.
+
+    The id breaks ties between messages saved within the same timestamp, so a
+    page boundary never skips or repeats a row.  The redundant ``timestamp <=``
+    bound lets the database seek straight to the cursor on the index instead of
+    walking down from the newest row.
+    """
+    if before_timestamp is not None and before_id is not None:
+        return queryset.filter(
+            Q(timestamp__lt=before_timestamp) | Q(id__lt=before_id),
+            timestamp__lte=before_timestamp
+        )
+    if before_timestamp is not None:
+        return queryset.filter(timestamp__lt=before_timestamp)
+    if before_id is not None:
+        return queryset.filter(id__lt=before_id)
+    return queryset
+
+
+def newest_page(queryset, limit):
+    """
+    Fetch the newest ``limit`` rows of an already filtered queryset.
+
+    Returns ``(rows, has_more)`` with rows in chronological order, ready to be
+    rendered top to bottom.  One extra row is fetched to tell whether an older
+    page exists, instead of running a separate COUNT query.
+    """
+    rows = list(queryset.order_by('-timestamp', '-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+def messages_after_seq(queryset, last_seq):
+    """
+    Messages of one conversation after sequence number ``last_seq``, in order,
+    read with a range scan of the (conversation, seq) index.
+
+    Returns None when more than CHAT_RESUME_MAX_GAP were missed: the client
+    is then better off reloading the newest history page.
+    """
+    max_gap = getattr(settings, 'CHAT_RESUME_MAX_GAP', 200)
+    messages = list(queryset.filter(seq__gt=last_seq).order_by('seq')[:max_gap + 1])
+    if len(messages) > max_gap:
+        return None
+    return messages
@@ -0,0 +1,214 @@
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from chats.fanout import run_in_background, send_to_channels
+from chats.models import UserProfileModel
+from chats.protocol import prepare_frames
+
+
+class PresenceRegistry:
+    """
+    Live presence of the users connected to this process.
+
+    Every open websocket of a user is one reference, so a user with several
+    tabs stays online until the last of them closes or stops sending
+    heartbeats for CHAT_PRESENCE_TTL seconds.  Only the event loop thread
+    writes to the registry, so it needs no lock and never touches the
+    database; "last seen" times are collected and written in batches by
+    ``flush_last_seen``.
+
+    Connections subscribe to the users they display.  Changes are not sent
+    as they happen but collected and handed out by ``pop_diffs`` as one
+    diff per subscribed connection.
+    """
+
+    def __init__(self):
+        # user id -> {channel name: time of the last heartbeat}
+        self._connections = {}
+        # user id -> when the user went offline, waiting to be persisted
+        self._last_seen = {}
+        # channel name -> watched user ids, and the reverse
+        self._subscriptions = {}
+        self._subscribers = {}
+        # user id -> whether the user was online before the first change since the last diff
+        self._changed = {}
+
+    def connect(self, user, channel_name, now=None):
+        """Add a connection, return True when the user just came online"""
+        connections = self._connections.setdefault(user.id, {})
+        came_online = not connections
+        connections[channel_name] = time.monotonic() if now is None else now
+        if came_online:
+            self._changed.setdefault(user.id, False)
+        return came_online
+
+    def heartbeat(self, user, channel_name, now=None):
+        """Refresh a connection, return True when the user just came online"""
+        return self.connect(user, channel_name, now)
+
+    def disconnect(self, user, channel_name):
+        """Drop a connection, return True when the user just went offline"""
+        self.unsubscribe(channel_name)
+        connections = self._connections.get(user.id)
+        if not connections or connections.pop(channel_name, None) is None:
+            return False
+        if connections:
+            return False
+        self._went_offline(user.id)
+        return True
+
+    def expire(self, now=None):
+        """
+        Drop the connections silent for longer than CHAT_PRESENCE_TTL and
+        return the ids of the users that went offline.
+        """
+        now = time.monotonic() if now is None else now
+        deadline = now - getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+        offline = []
+        for user_id, connections in list(self._connections.items()):
+            for channel_name, last_heartbeat in list(connections.items()):
+                if last_heartbeat < deadline:
+                    del connections[channel_name]
+                    self.unsubscribe(channel_name)
+            if not connections:
+                offline.append(user_id)
+                self._went_offline(user_id)
+        return offline
+
+    def is_online(self, user_id):
+        return bool(self._connections.get(user_id))
+
+    def subscribe(self, channel_name, user_ids):
+        """
+        Replace the users watched by a connection and return their current
+        state as ``{user_id: is_online}``.
+        """
+        self.unsubscribe(channel_name)
+        user_ids = set(user_ids)
+        self._subscriptions[channel_name] = user_ids
+        for user_id in user_ids:
+            self._subscribers.setdefault(user_id, set()).add(channel_name)
+        return {user_id: self.is_online(user_id) for user_id in user_ids}
+
+    def unsubscribe(self, channel_name):
+        for user_id in self._subscriptions.pop(channel_name, ()):
+            subscribers = self._subscribers[user_id]
+            subscribers.discard(channel_name)
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    def pop_diffs(self):
+        """
+        Coalesce the changes since the last call into ``{channel_name:
+        {user_id: is_online}}``, one diff per connection watching a changed
+        user.  A user who went offline and came back in between is left out.
+        """
+        changed, self._changed = self._changed, {}
+        diffs = {}
+        for user_id, was_online in changed.items():
+            is_online = self.is_online(user_id)
+            if is_online == was_online:
+                continue
+            for channel_name in self._subscribers.get(user_id, ()):
+                diffs.setdefault(channel_name, {})[user_id] = is_online
+        return diffs
+
+    def pop_last_seen(self):
+        """Take the pending "last seen" times, to be written by the caller"""
+        last_seen, self._last_seen = self._last_seen, {}
+        return last_seen
+
+    def requeue_last_seen(self, last_seen):
+        """Put back times that could not be written, newer ones win"""
+        for user_id, seen in last_seen.items():
+            self._last_seen.setdefault(user_id, seen)
+
+    def _went_offline(self, user_id):
+        del self._connections[user_id]
+        self._last_seen[user_id] = timezone.now()
+        self._changed.setdefault(user_id, True)
+
+
+registry = PresenceRegistry()
+_runner = None
+
+
+def save_last_seen(last_seen):
+    """Persist ``{user_id: datetime}`` in one upsert, without firing signals"""
+    if not last_seen:
+        return
+    UserProfileModel.objects.bulk_create(
+        [UserProfileModel(user_id=user_id, last_seen=seen) for user_id, seen in last_seen.items()],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['last_seen']
+    )
+
+
+async def flush_last_seen():
+    last_seen = registry.pop_last_seen()
+    try:
+        await database_sync_to_async(save_last_seen)(last_seen)
+    except Exception as e:
+        registry.requeue_last_seen(last_seen)
+        print(f"Error saving last seen: {str(e)}")
+
+
+async def publish(channel_layer):
+    """
+    Send every subscribed connection its pending presence diff.  Connections
+    watching the same changed users get the same diff, serialized once.
+    """
+    frames = {}
+    sends = []
+    for channel_name, diff in registry.pop_diffs().items():
+        key = frozenset(diff.items())
+        if key not in frames:
+            # Keys are strings like in JSON whatever the subprotocol
+            frames[key] = prepare_frames({
+                'type': 'presence',
+                'online': {str(user_id): online for user_id, online in diff.items()}
+            })
+        sends.append((channel_name, {'type': 'presence_diff', 'frames': frames[key]}))
+    await send_to_channels(channel_layer, sends)
+
+
+def user_connected(channel_layer, user, channel_name):
+    if user.is_authenticated:
+        _ensure_runner(channel_layer)
+        registry.connect(user, channel_name)
+
+
+def user_heartbeat(user, channel_name):
+    if user.is_authenticated:
+        registry.heartbeat(user, channel_name)
+
+
+def user_disconnected(user, channel_name):
+    if user.is_authenticated:
+        registry.disconnect(user, channel_name)
+
+
+async def _run_forever(channel_layer):
+    """
+    Publish the diffs every CHAT_PRESENCE_BATCH_INTERVAL seconds, expire silent
+    connections and write "last seen" every CHAT_PRESENCE_SWEEP_INTERVAL seconds
+    """
+    next_sweep = time.monotonic()
+    while True:
+        await asyncio.sleep(getattr(settings, 'CHAT_PRESENCE_BATCH_INTERVAL', 1))
+        if time.monotonic() >= next_sweep:
+            next_sweep = time.monotonic() + getattr(settings, 'CHAT_PRESENCE_SWEEP_INTERVAL', 15)
+            registry.expire()
+            await flush_last_seen()
+        await publish(channel_layer)
+
+
+def _ensure_runner(channel_layer):
+    global _runner
+    if _runner is None or _runner.done() or _runner.get_loop() is not asyncio.get_running_loop():
+        _runner = run_in_background(_run_forever(channel_layer))
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import struct
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+
+from chats.fanout import run_in_background
+
+try:
+    import msgpack
+except ImportError:  # The binary subprotocol is only offered when msgpack is installed
+    msgpack = None
+
+JSON_V1 = 'chat.json.v1'
+MSGPACK_V1 = 'chat.msgpack.v1'
+# Same encodings, with the frames of a burst coalesced into one array frame
+JSON_BATCH_V1 = 'chat.json.batch.v1'
+MSGPACK_BATCH_V1 = 'chat.msgpack.batch.v1'
+BATCHED = {JSON_BATCH_V1: JSON_V1, MSGPACK_BATCH_V1: MSGPACK_V1}
+
+# Keys of the events and their short form in the binary encoding
+COMPACT_KEYS = {
+    'type': 't',
+    'message': 'm',
+    'message_id': 'id',
+    'message_type': 'k',
+    'username': 'u',
+    'receiver': 'r',
+    'sender': 's',
+    'id': 'i',
+    'file_data': 'f',
+    'file_id': 'fi',
+    'filename': 'fn',
+    'file_url': 'fu',
+    'file_type': 'ft',
+    'file_size': 'fs',
+    'timestamp': 'ts',
+    'unseen_count': 'n',
+    'notification': 'no',
+    'sender_username': 'su',
+    'group_id': 'g',
+    'group_name': 'gn',
+    'message_preview': 'p',
+    'thread_name': 'th',
+    'read_by': 'rb',
+    'is_typing': 'it',
+    'usernames': 'us',
+    'online': 'o',
+    'status': 'st',
+    'seq': 'q',
+    'last_seq': 'lq',
+}
+LONG_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+# Sent as milliseconds since the epoch instead of ISO strings
+TIMESTAMP_KEYS = {'timestamp'}
+
+
+def supported_subprotocols():
+    """Subprotocols the server speaks, most preferred first"""
+    if msgpack is None:
+        return [JSON_BATCH_V1, JSON_V1]
+    return [MSGPACK_BATCH_V1, MSGPACK_V1, JSON_BATCH_V1, JSON_V1]
+
+
+def encoding_of(subprotocol):
+    """The frame encoding of a subprotocol, JSON_V1 or MSGPACK_V1"""
+    subprotocol = BATCHED.get(subprotocol, subprotocol)
+    return MSGPACK_V1 if subprotocol == MSGPACK_V1 else JSON_V1
+
+
+def negotiate(requested):
+    """
+    Pick the subprotocol for a connection out of the ones the client asked
+    for.  None means the client asked for none we know and gets the plain
+    JSON frames it always did.
+    """
+    for subprotocol in supported_subprotocols():
+        if subprotocol in requested:
+            return subprotocol
+    return None
+
+
+def compact(value):
+    """Shorten the keys of an event and turn its timestamps into integers"""
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    compacted = {}
+    for key, item in value.items():
+        if isinstance(item, (dict, list)):
+            item = compact(item)
+        elif key in TIMESTAMP_KEYS and isinstance(item, str):
+            item = _iso_to_milliseconds(item)
+        compacted[COMPACT_KEYS.get(key, key)] = item
+    return compacted
+
+
+def expand(value):
+    """Reverse of ``compact``"""
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    expanded = {}
+    for key, item in value.items():
+        key = LONG_KEYS.get(key, key)
+        if isinstance(item, (dict, list)):
+            item = expand(item)
+        elif key in TIMESTAMP_KEYS and isinstance(item, int):
+            item = datetime.fromtimestamp(item / 1000, tz=dt_timezone.utc).isoformat()
+        expanded[key] = item
+    return expanded
+
+
+def _iso_to_milliseconds(value):
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        return value
+
+
+def serialize(event, encoding):
+    if encoding == MSGPACK_V1:
+        return msgpack.packb(compact(event))
+    return json.dumps(event)
+
+
+def frame_kwargs(frame):
+    """The ``send`` keyword arguments carrying a serialized frame"""
+    return {'bytes_data': frame} if isinstance(frame, bytes) else {'text_data': frame}
+
+
+def encode(event, subprotocol):
+    """Return the ``send`` keyword arguments carrying ``event`` in ``subprotocol``"""
+    return frame_kwargs(serialize(event, encoding_of(subprotocol)))
+
+
+def join_frames(frames):
+    """
+    Merge serialized frames of one encoding into a single array frame,
+    without decoding them: the JSON texts are joined inside brackets and
+    the msgpack objects follow an array header.
+    """
+    if isinstance(frames[0], bytes):
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = struct.pack('>BH', 0xdc, count)
+        else:
+            header = struct.pack('>BI', 0xdd, count)
+        return header + b''.join(frames)
+    return '[' + ','.join(frames) + ']'
+
+
+def prepare_frames(event):
+    """
+    Serialize ``event`` once for every subprotocol.  The result goes in a
+    channel layer event as ``frames`` and each recipient forwards its frame
+    verbatim with ``send_frames``, so a broadcast is encoded once instead of
+    once per socket.
+    """
+    frames = {JSON_V1: serialize(event, JSON_V1)}
+    if msgpack is not None:
+        frames[MSGPACK_V1] = serialize(event, MSGPACK_V1)
+    return frames
+
+
+def decode(text_data, bytes_data, subprotocol):
+    if bytes_data is not None and encoding_of(subprotocol) == MSGPACK_V1:
+        return expand(msgpack.unpackb(bytes_data))
+    return json.loads(text_data)
+
+
+class NegotiatedProtocolMixin:
+    """
+    Websocket consumer side of the subprotocol negotiation: accept with the
+    negotiated subprotocol, then use ``send_event`` and ``decode_frame``
+    instead of ``json.dumps``/``json.loads``.  Channel layer handlers of
+    broadcast events use ``send_frames``.
+
+    A client that negotiated a batch subprotocol has its outbound frames
+    buffered and sent as one array frame once no frame came for
+    CHAT_COALESCE_WINDOW seconds, CHAT_COALESCE_MAX_DELAY seconds after the
+    first buffered one at the latest, or as soon as CHAT_COALESCE_MAX_FRAMES
+    are waiting.  Every frame of such a connection goes through the buffer
+    so none overtakes another.
+    """
+    subprotocol = None
+    encoding = JSON_V1
+    batching = False
+
+    async def accept_negotiated(self):
+        self.subprotocol = negotiate(self.scope.get('subprotocols', []))
+        self.encoding = encoding_of(self.subprotocol)
+        self.batching = self.subprotocol in BATCHED
+        self._outbox = []
+        self._outbox_deadline = None
+        self._outbox_timer = None
+        self._outbox_lock = asyncio.Lock()
+        await self.accept(subprotocol=self.subprotocol)
+
+    async def send_event(self, event):
+        await self.send_frame(serialize(event, self.encoding))
+
+    async def send_frames(self, event):
+        """Forward the frame ``prepare_frames`` made for our encoding"""
+        await self.send_frame(event['frames'][self.encoding])
+
+    async def send_frame(self, frame):
+        if not self.batching:
+            await self.send(**frame_kwargs(frame))
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if not self._outbox:
+            self._outbox_deadline = now + getattr(settings, 'CHAT_COALESCE_MAX_DELAY', 0.02)
+        self._outbox.append(frame)
+        if self._outbox_timer is not None:
+            self._outbox_timer.cancel()
+            self._outbox_timer = None
+
+        if len(self._outbox) >= getattr(settings, 'CHAT_COALESCE_MAX_FRAMES', 50):
+            await self.flush_outbox()
+        else:
+            flush_at = min(now + getattr(settings, 'CHAT_COALESCE_WINDOW', 0.005), self._outbox_deadline)
+            self._outbox_timer = loop.call_at(flush_at, lambda: run_in_background(self.flush_outbox()))
+
+    async def flush_outbox(self):
+        # The batch is taken under the lock, so batches go out in order
+        async with self._outbox_lock:
+            if self._outbox_timer is not None:
+                self._outbox_timer.cancel()
+                self._outbox_timer = None
+            frames, self._outbox = self._outbox, []
+            if frames:
+                await self.send(**frame_kwargs(join_frames(frames)))
+
+    async def websocket_disconnect(self, message):
+        # Frames still buffered have nowhere to go
+        if self.batching and self._outbox_timer is not None:
+            self._outbox_timer.cancel()
+            self._outbox_timer = None
+        await super().websocket_disconnect(message)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return decode(text_data, bytes_data, self.subprotocol)
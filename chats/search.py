@@ -0,0 +1,162 @@
+import html
+import re
+
+from django.db import connection, transaction
+
+from chats.models import ChatModel
+from groups.models import Group, GroupMessage
+
+# FTS5 index of the personal and group messages, kept in sync by the triggers
+# of migration chats 0021.  Its rowid tells both kinds apart: twice the id of
+# a ChatModel, twice the id plus one of a GroupMessage.
+SEARCH_TABLE = 'chat_message_search'
+# Marks around the matched terms in the snippets, replaced once the text is escaped
+_MATCH_START, _MATCH_END = '\x02', '\x03'
+_token_re = re.compile(r'\w+')
+
+# Source table, prefix of its triggers, the columns whose edits are reindexed
+# and the rowid, body and conversation of its index rows, ``{row}`` being the
+# source row (new, old or the table itself).  The migrations creating the
+# triggers hold their own frozen copy of this.
+INDEXED_TABLES = [
+    ('chats_chatmodel', 'chatmodel_search', 'message, thread_name',
+     '{row}.id * 2', '{row}.message', '{row}.thread_name'),
+    ('groups_groupmessage', 'groupmessage_search', 'content, group_id',
+     '{row}.id * 2 + 1', '{row}.content', "'group_' || {row}.group_id"),
+]
+
+
+def is_available():
+    return connection.vendor == 'sqlite'
+
+
+def match_expression(query):
+    """
+    FTS5 query matching every word of ``query``, the last one as a prefix so
+    results come while typing.  Each word is quoted, the user never writes
+    FTS5 syntax.  Empty when ``query`` has no word.
+    """
+    tokens = _token_re.findall(query)
+    if not tokens:
+        return ''
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def render_snippet(snippet):
+    """HTML of a snippet: the message escaped, the matches in <mark>"""
+    return html.escape(snippet or '').replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
+
+
+def search_messages(user, query, limit, after_rank=None, after_id=None):
+    """
+    Messages of the threads and groups of ``user`` matching ``query``, best
+    first by bm25, ``limit`` at most.  A page continues after the
+    ``(after_rank, after_id)`` of the last result of the previous one.
+
+    Returns ``(results, has_more)``, each result a dict with the message,
+    its conversation and an HTML snippet of the match.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return [], False
+
+    # Only the caller's conversations: personal threads are chat_<low>-<high>
+    scope = ["conversation LIKE %s ESCAPE '\\'", "conversation LIKE %s ESCAPE '\\'"]
+    params = [expression, f'chat\\_{user.id}-%', f'chat\\_%-{user.id}']
+    group_names = [f'group_{group_id}' for group_id in Group.objects.filter(members=user).values_list('id', flat=True)]
+    if group_names:
+        scope.append(f'conversation IN ({", ".join(["%s"] * len(group_names))})')
+        params.extend(group_names)
+
+    keyset = ''
+    if after_rank is not None and after_id is not None:
+        keyset = 'AND (rank > %s OR (rank = %s AND rowid > %s))'
+        params.extend([after_rank, after_rank, after_id])
+    params.append(limit + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid, rank, snippet({SEARCH_TABLE}, 0, char(2), char(3), '…', 16) "
+            f'FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+            f"AND ({' OR '.join(scope)}) "
+            f'{keyset} ORDER BY rank, rowid LIMIT %s',
+            params
+        )
+        rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    personal = ChatModel.objects.select_related('sender').in_bulk([rowid // 2 for rowid, _, _ in rows if rowid % 2 == 0])
+    group = GroupMessage.objects.select_related('sender').in_bulk([rowid // 2 for rowid, _, _ in rows if rowid % 2])
+
+    results = []
+    for rowid, rank, snippet in rows:
+        result = {'rank': rank, 'search_id': rowid, 'snippet': render_snippet(snippet)}
+        if rowid % 2 == 0:
+            message = personal.get(rowid // 2)
+            if message is None:
+                continue
+            result.update({
+                'kind': 'personal',
+                'message_id': message.id,
+                'thread_name': message.thread_name,
+                'sender': message.sender_username,
+                'timestamp': message.timestamp.isoformat(),
+                'seq': message.seq,
+            })
+        else:
+            message = group.get(rowid // 2)
+            if message is None:
+                continue
+            result.update({
+                'kind': 'group',
+                'message_id': message.id,
+                'group_id': message.group_id,
+                'sender': message.sender.username,
+                'timestamp': message.timestamp.isoformat(),
+                'seq': message.seq,
+            })
+        results.append(result)
+    return results, has_more
+
+
+def rebuild_index(batch_size=1000, progress=None):
+    """
+    Fill the search index from scratch, ``batch_size`` messages per
+    transaction so writers are only held up briefly; searches miss the
+    messages not reindexed yet until it is done.  Messages sent meanwhile
+    are indexed by the triggers, re-inserting them is harmless.  Returns
+    the number of messages indexed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+
+    total = 0
+    for table, _, _, rowid, body, conversation in INDEXED_TABLES:
+        columns = ', '.join(column.format(row=table) for column in (rowid, body, conversation))
+        last_id = 0
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f'SELECT max(id), count(*) FROM (SELECT id FROM {table} WHERE id > %s ORDER BY id LIMIT %s)',
+                    [last_id, batch_size]
+                )
+                batch_last_id, count = cursor.fetchone()
+                if not count:
+                    break
+                cursor.execute(
+                    f'INSERT OR REPLACE INTO {SEARCH_TABLE} (rowid, body, conversation) '
+                    f'SELECT {columns} FROM {table} WHERE id > %s AND id <= %s',
+                    [last_id, batch_last_id]
+                )
+            last_id = batch_last_id
+            total += count
+            if progress is not None:
+                progress(total)
+
+    with connection.cursor() as cursor:
+        # Merge the b-trees the batches left behind
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+    return total
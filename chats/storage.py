@@ -0,0 +1,147 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+from urllib.parse import unquote, urlparse
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+# Directory of the blobs inside the media root
+BLOB_DIR = 'blobs'
+
+
+def blob_name(sha256, filename=''):
+    """
+    Storage name of a blob, fanned out over two directory levels so no
+    directory grows past 65536 entries: ``blobs/ab/cd/abcd...ef.pdf``.
+    The extension of the first upload is kept for the web server's sake.
+    """
+    extension = os.path.splitext(filename)[1].lower()[:16]
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+def file_sha256(path, block_size=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def media_name(value):
+    """
+    Storage name of a media file given by name or by URL (``/chat_files/x``
+    or ``http://host/chat_files/x``), None when the URL is not a media one
+    """
+    path = urlparse(value).path if '://' in value else value
+    if path.startswith(settings.MEDIA_URL):
+        return unquote(path[len(settings.MEDIA_URL):])
+    if '://' in value or path.startswith('/'):
+        return None
+    return path
+
+
+def reference_file(url, user):
+    """
+    ``(file, size)`` of a row ``user`` creates pointing at an already uploaded
+    file: its media name, a blob being counted as one more reference, or
+    ``url`` unchanged when it is not a media file.  The size is the blob's,
+    None for anything else.  A media file ``user`` may not see already is
+    refused with an empty value, the row would grant them access.
+    """
+    from chats.media import shared_file
+    from chats.models import Blob
+
+    name = media_name(url or '')
+    if not name:
+        return url, None
+    if shared_file(user, name) is None:
+        return '', None
+    return name, Blob.retain(name) if name.startswith(f'{BLOB_DIR}/') else None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage keeping every distinct content once, named after its SHA-256.
+
+    Saving streams the content to a temporary file while hashing it, then
+    either moves it under its blob name or drops it when that content is
+    already stored.  Every save counts as one reference to the blob (see
+    chats.models.Blob) and ``delete`` only drops a reference, so a file
+    shared by several messages survives the deletion of one of them.
+    """
+
+    def _save(self, name, content):
+        temp_dir = self.path(BLOB_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return self._store(temp_path, digest.hexdigest(), size, name)
+
+    def save_local_file(self, path, filename, sha256=None):
+        """
+        Store the file at ``path`` under its hash by moving it, not copying
+        it, and return its storage name.  ``path`` is gone afterwards.
+        """
+        return self._store(path, sha256 or file_sha256(path), os.path.getsize(path), filename)
+
+    def _store(self, path, sha256, size, filename):
+        from chats.models import Blob
+
+        name = Blob.add_reference(sha256, blob_name(sha256, filename), size)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(path, full_path)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+    def delete(self, name):
+        from chats.models import Blob
+
+        Blob.release(name)
+
+    def purge(self, name):
+        """
+        Really remove the blob stored as ``name``, row and file, unless it is
+        referenced again.  Returns whether it was removed.
+
+        The file is moved aside before the row is deleted: an upload of the
+        same content in between finds no file and stores its own copy, and the
+        moved file is put back if the row turns out to be referenced.
+        """
+        from chats.models import Blob
+
+        path = self.path(name)
+        moved_path = f'{path}.purge'
+        try:
+            os.replace(path, moved_path)
+        except FileNotFoundError:
+            moved_path = None
+        removed = Blob.objects.filter(name=name, refcount=0).delete()[0] > 0
+        if moved_path is not None:
+            if removed:
+                os.remove(moved_path)
+            else:
+                os.replace(moved_path, path)
+        return removed
@@ -0,0 +1,11 @@
+from django import template
+
+from chats.assets import asset_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def asset(name):
+    """Fingerprinted URL of a static file, cached by browsers for good, see chats.assets"""
+    return asset_url(name)
@@ -1,3 +1,2029 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from chats.consumers import GroupChatConsumer, NotificationConsumer, OnlineStatusConsumer, PersonalChatConsumer
+from chats.fanout import run_in_background
+from chats.models import (ArchiveSegment, Blob, ChatFile, ChatModel, ChatNotification, ChunkedUpload,
+                          ConversationSummary, MessageSequence, Thread, UnreadCounter, UserProfileModel,
+                          get_thread_name)
+from chats import assets, presence, protocol, search, thumbnails, typing_indicators, uploads
+from chats.presence import PresenceRegistry, save_last_seen
+from chats.typing_indicators import TypingAggregator
+from chats.writebehind import WriteBehindBatcher, write_group_messages, write_personal_messages
+from chats.pagination import messages_after_seq
+from chats.views import unread_chat_notifications
+from groups.models import Group, GroupFile, GroupMessage, GroupNotification
+
+
+def explain(sql, params=None):
+    """Return the SQLite query plan of a statement as one string"""
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return ' | '.join(str(row[-1]) for row in cursor.fetchall())
+
+
+def benchmark(test):
+    """Timing benchmarks are too noisy for a shared CI box, they only run with CHAT_BENCHMARKS=1"""
+    return tag('benchmark')(skipUnless(os.environ.get('CHAT_BENCHMARKS'), 'CHAT_BENCHMARKS is not set')(test))
+
+
+class ThreadHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+        start = timezone.now() - timedelta(days=1)
+        messages = ChatModel.objects.bulk_create(
+            ChatModel(sender=cls.alice if i % 2 else cls.bob, message=f'message {i}',
+                      thread=cls.thread, thread_name=cls.thread_name)
+            for i in range(120)
+        )
+        # auto_now_add ignores explicit values, so spread the timestamps afterwards
+        for i, message in enumerate(messages):
+            message.timestamp = start + timedelta(seconds=i)
+        ChatModel.objects.bulk_update(messages, ['timestamp'])
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.url = reverse('chat_messages', kwargs={'username': 'bob'})
+
+    def test_thread_name_is_symmetric(self):
+        self.assertEqual(get_thread_name(12, 7), 'chat_12-7')
+        self.assertEqual(get_thread_name(7, 12), 'chat_12-7')
+
+    def test_first_page_is_newest_messages_in_order(self):
+        data = self.client.get(self.url, {'limit': 20}).json()
+
+        self.assertEqual([m['message'] for m in data['messages']], [f'message {i}' for i in range(100, 120)])
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['next_cursor']['before_id'], data['messages'][0]['id'])
+
+    def test_paging_walks_the_whole_thread_once(self):
+        seen = []
+        params = {'limit': 50}
+        while True:
+            data = self.client.get(self.url, params).json()
+            seen = [m['id'] for m in data['messages']] + seen
+            if not data['has_more']:
+                break
+            params = {'limit': 50, **data['next_cursor']}
+
+        expected = list(ChatModel.objects.filter(thread=self.thread).order_by('timestamp', 'id')
+                        .values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_before_id_alone_is_a_valid_cursor(self):
+        newest = self.client.get(self.url, {'limit': 10}).json()
+        older = self.client.get(self.url, {'limit': 10, 'before_id': newest['messages'][0]['id']}).json()
+
+        self.assertEqual([m['message'] for m in older['messages']], [f'message {i}' for i in range(100, 110)])
+
+    @override_settings(CHAT_HISTORY_MAX_PAGE_SIZE=30)
+    def test_page_size_is_capped(self):
+        data = self.client.get(self.url, {'limit': 10000}).json()
+        self.assertEqual(len(data['messages']), 30)
+
+    def test_chat_page_renders_only_the_newest_page(self):
+        with self.settings(CHAT_HISTORY_PAGE_SIZE=25):
+            response = self.client.get(reverse('chat', kwargs={'username': 'bob'}))
+
+        self.assertEqual(len(response.context['messages']), 25)
+        self.assertTrue(response.context['has_older_messages'])
+        self.assertContains(response, 'load-older-btn')
+
+    def test_history_query_uses_thread_timestamp_index(self):
+        before = timezone.now()
+        queryset = ChatModel.objects.filter(thread=self.thread, timestamp__lt=before) \
+            .order_by('-timestamp', '-id')[:51]
+        sql, params = queryset.query.sql_with_params()
+
+        plan = explain(sql, params)
+        self.assertIn('chat_thread_ts_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_every_page_reads_a_range_of_the_index(self):
+        """Page cost depends on the page size only, whatever the age of the thread"""
+        newest = self.client.get(self.url, {'limit': 10}).json()
+        oldest_id = ChatModel.objects.filter(thread=self.thread).order_by('timestamp', 'id') \
+            .values_list('id', flat=True)[10]
+
+        for params in ({'limit': 10}, {'limit': 10, **newest['next_cursor']}, {'limit': 10, 'before_id': oldest_id}):
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(self.url, params)
+            pages = [query['sql'] for query in context.captured_queries
+                     if 'FROM "chats_chatmodel"' in query['sql'] and 'LIMIT 11' in query['sql']]
+            self.assertEqual(len(pages), 1, params)
+            plan = explain(pages[0])
+            self.assertIn('chat_thread_ts_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+@benchmark
+class ThreadHistoryLatencyTests(TestCase):
+    """
+    Benchmark: page latency must not depend on the age of the thread.
+    Rows are generated in SQL, a million ORM objects would take minutes to build.
+    """
+    message_count = 1_000_000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s)
+                INSERT INTO {ChatModel._meta.db_table} (sender_id, message, thread_id, thread_name, timestamp)
+                SELECT CASE n % 2 WHEN 0 THEN %s ELSE %s END,
+                       'message ' || n, %s, %s,
+                       datetime('2020-01-01', '+' || n || ' seconds')
+                FROM seq
+                ''',
+                [cls.message_count, cls.alice.id, cls.bob.id, cls.thread.id, cls.thread_name]
+            )
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.url = reverse('chat_messages', kwargs={'username': 'bob'})
+
+    def test_pages_stay_fast_on_a_million_message_thread(self):
+        newest = self.client.get(self.url).json()
+        self.assertEqual(newest['messages'][-1]['message'], f'message {self.message_count}')
+
+        # The deepest page is the worst case for OFFSET pagination, keyset has no such case
+        oldest_cursor = {'before_id': ChatModel.objects.filter(thread=self.thread)
+                         .order_by('timestamp', 'id').values_list('id', flat=True)[60]}
+
+        for params in ({}, newest['next_cursor'], oldest_cursor):
+            started = time.perf_counter()
+            response = self.client.get(self.url, params)
+            elapsed = time.perf_counter() - started
+
+            self.assertEqual(response.status_code, 200)
+            self.assertLess(elapsed, 0.1, f'history page took {elapsed:.3f}s for {params}')
+
+
+class ThreadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+
+    def test_one_thread_per_pair_of_users(self):
+        thread = Thread.between(self.alice.id, self.bob.id)
+        self.assertEqual(Thread.between(self.bob.id, self.alice.id), thread)
+        self.assertEqual(thread.name, get_thread_name(self.alice.id, self.bob.id))
+        self.assertEqual(set(thread.participants.all()), {self.alice, self.bob})
+        self.assertTrue(Thread.has_participant(thread.id, self.bob))
+        self.assertFalse(Thread.has_participant(thread.id, self.carol))
+
+    def test_client_sent_names_are_checked(self):
+        name = get_thread_name(self.alice.id, self.bob.id)
+        self.assertEqual(Thread.for_participant(self.alice, name).name, name)
+        self.assertIsNone(Thread.for_participant(self.carol, name))
+        self.assertIsNone(Thread.for_participant(self.alice, get_thread_name(self.alice.id, self.carol.id + 100)))
+        for malformed in (None, '', 'group_1', f'chat_{self.bob.id}-{self.alice.id}-1', f'chat_{self.alice.id}-x'):
+            self.assertIsNone(Thread.for_participant(self.alice, malformed))
+        self.assertEqual(Thread.objects.count(), 1)
+
+
+class SenderBackfillTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+
+    def legacy_messages(self, *usernames):
+        return ChatModel.objects.bulk_create(
+            ChatModel(sender_name=username, message='hi', thread=self.thread, thread_name=self.thread.name)
+            for username in usernames
+        )
+
+    def backfill(self, *args):
+        out = io.StringIO()
+        call_command('backfill_chat_senders', '--batch-size', '2', '--sleep', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def test_usernames_become_foreign_keys(self):
+        messages = self.legacy_messages('alice', 'bob', 'gone', 'bob', 'alice')
+        ChatModel.objects.create(sender=self.alice, message='new', thread=self.thread, thread_name=self.thread.name)
+
+        self.assertIn('4 senders resolved, 1 messages of unknown users', self.backfill())
+
+        rows = ChatModel.objects.select_related('sender').filter(id__in=[m.id for m in messages]).order_by('id')
+        self.assertEqual([(m.sender_id, m.sender_name) for m in rows], [
+            (self.alice.id, None), (self.bob.id, None), (None, 'gone'), (self.bob.id, None), (self.alice.id, None)
+        ])
+        self.assertEqual([m.sender_username for m in rows], ['alice', 'bob', 'gone', 'bob', 'alice'])
+
+        # Renaming a user renames their history
+        User.objects.filter(id=self.bob.id).update(username='robert')
+        self.assertEqual(ChatModel.objects.select_related('sender').get(id=messages[1].id).sender_username, 'robert')
+
+    def test_resumes_where_it_stopped(self):
+        messages = self.legacy_messages('alice', 'bob', 'alice')
+        self.assertIn('1 senders resolved', self.backfill('--start-id', str(messages[1].id)))
+        self.assertIn('2 senders resolved', self.backfill())
+        self.assertIn('Every message has its sender', self.backfill())
+
+
+class ConversationSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+    def send(self, sender, receiver, text):
+        chat = ChatModel.objects.create(sender=sender, message=text,
+                                        thread=self.thread, thread_name=self.thread_name)
+        ConversationSummary.record_personal_message(chat, sender, receiver)
+        return chat
+
+    def test_personal_message_updates_both_participants(self):
+        self.send(self.alice, self.bob, 'hi')
+        last = self.send(self.alice, self.bob, 'are you there?')
+
+        bob_summary = ConversationSummary.objects.get(user=self.bob, thread_name=self.thread_name)
+        alice_summary = ConversationSummary.objects.get(user=self.alice, thread_name=self.thread_name)
+        self.assertEqual(bob_summary.last_message_id, last.id)
+        self.assertEqual(bob_summary.other_user, self.alice)
+        self.assertEqual(bob_summary.unread_count, 2)
+        self.assertEqual(alice_summary.unread_count, 0)
+
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 2)
+        self.assertEqual(UnreadCounter.get_count(self.alice.id), 0)
+
+        ConversationSummary.mark_read(self.bob, thread_name=self.thread_name)
+        self.assertEqual(ConversationSummary.objects.get(pk=bob_summary.pk).unread_count, 0)
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 0)
+
+    def test_group_message_updates_every_member_in_constant_queries(self):
+        group = Group.objects.create(name='friends', created_by=self.alice)
+        group.members.add(self.alice, self.bob, self.carol)
+        message = GroupMessage.objects.create(group=group, sender=self.alice, content='x' * 80)
+
+        with self.assertNumQueries(6):
+            ConversationSummary.record_group_message(message, self.alice)
+
+        summaries = {s.user_id: s for s in ConversationSummary.objects.filter(group=group)}
+        self.assertEqual(len(summaries), 3)
+        self.assertEqual(summaries[self.alice.id].unread_count, 0)
+        self.assertEqual(summaries[self.bob.id].unread_count, 1)
+        self.assertEqual(summaries[self.bob.id].last_message_preview, 'x' * 50 + '...')
+        self.assertEqual(UnreadCounter.get_count(self.carol.id), 1)
+        self.assertEqual(UnreadCounter.get_count(self.alice.id), 0)
+
+    def test_counter_matches_summaries_after_partial_read(self):
+        group = Group.objects.create(name='friends', created_by=self.alice)
+        group.members.add(self.alice, self.bob)
+        for text in ('one', 'two'):
+            message = GroupMessage.objects.create(group=group, sender=self.alice, content=text)
+            ConversationSummary.record_group_message(message, self.alice)
+        self.send(self.alice, self.bob, 'hi')
+
+        ConversationSummary.mark_read(self.bob, group_id=group.id)
+
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 1)
+
+    def test_read_watermark_drives_unread_notifications(self):
+        first = self.send(self.alice, self.bob, 'one')
+        ChatNotification.objects.create(chat=first, user=self.bob, thread=self.thread)
+        second = self.send(self.alice, self.bob, 'two')
+        ChatNotification.objects.create(chat=second, user=self.bob, thread=self.thread)
+
+        alice_summary = ConversationSummary.objects.get(user=self.alice, thread_name=self.thread_name)
+        self.assertEqual(alice_summary.last_read_message_id, second.id)
+        self.assertEqual([n.chat_id for n in unread_chat_notifications(self.bob).order_by('chat_id')], [first.id, second.id])
+
+        ConversationSummary.mark_read(self.bob, thread_name=self.thread_name)
+        third = self.send(self.alice, self.bob, 'three')
+        ChatNotification.objects.create(chat=third, user=self.bob, thread=self.thread)
+
+        self.assertEqual([n.chat_id for n in unread_chat_notifications(self.bob).order_by('chat_id')], [third.id])
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 1)
+
+    def test_sidebar_query_count_does_not_grow_with_contacts(self):
+        self.client.force_login(self.alice)
+        self.send(self.bob, self.alice, 'hello')
+        url = reverse('chat', kwargs={'username': 'bob'})
+
+        with self.assertNumQueries(8) as few_users:
+            self.client.get(url)
+        for i in range(20):
+            User.objects.create_user(f'user{i}')
+        with self.assertNumQueries(len(few_users.captured_queries)):
+            response = self.client.get(url)
+
+        self.assertEqual(response.context['users'][0], self.bob)
+        self.assertEqual(response.context['users'][0].summary.last_message_preview, 'hello')
+
+
+def db_method(consumer_class, name):
+    """The plain function behind a ``@database_sync_to_async`` consumer method"""
+    return vars(consumer_class)[name].func
+
+
+# Tables that grow with traffic and must never be read with a full scan
+HOT_TABLES = (
+    ChatModel._meta.db_table,
+    ChatNotification._meta.db_table,
+    ChatFile._meta.db_table,
+    ConversationSummary._meta.db_table,
+    GroupMessage._meta.db_table,
+    GroupNotification._meta.db_table,
+)
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, MEDIA_ROOT=tempfile.mkdtemp())
+class QueryBudgetTests(TestCase):
+    """
+    Runs every view and consumer database method against a seeded database and
+    checks two things: the number of queries stays within a fixed budget, and
+    no query reads one of the hot tables with a full scan.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+        chats = ChatModel.objects.bulk_create(
+            ChatModel(sender=cls.bob, message=f'message {i}',
+                      thread=cls.thread, thread_name=cls.thread_name) for i in range(40)
+        )
+        ChatNotification.objects.bulk_create(ChatNotification(chat=chat, user=cls.alice, thread=cls.thread) for chat in chats)
+        ConversationSummary.record_personal_message(chats[-1], cls.bob, cls.alice)
+
+        cls.group = Group.objects.create(name='friends', created_by=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob, cls.carol)
+        group_messages = GroupMessage.objects.bulk_create(
+            GroupMessage(group=cls.group, sender=cls.bob, content=f'group message {i}') for i in range(30)
+        )
+        GroupNotification.objects.bulk_create(
+            GroupNotification(group=cls.group, user=member, message=message)
+            for message in group_messages for member in (cls.alice, cls.carol)
+        )
+        ConversationSummary.record_group_message(group_messages[-1], cls.bob)
+
+        cls.chat_file = ChatFile.objects.create(
+            file=SimpleUploadedFile('report.pdf', b'%PDF-1.4'), filename='report.pdf', file_type='.pdf',
+            uploader=cls.bob, thread=cls.thread, thread_name=cls.thread_name, size=8, content_type='application/pdf'
+        )
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def assertIndexedPlan(self, sql):
+        if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            return
+        plan = explain(sql)
+        for table in HOT_TABLES:
+            self.assertIsNone(
+                re.search(rf'\bSCAN {table}\b', plan),
+                f'full scan of {table}:\n{sql}\n{plan}'
+            )
+
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args, **kwargs)
+        queries = [query['sql'] for query in context.captured_queries]
+        self.assertLessEqual(len(queries), budget, '\n'.join(queries))
+        for sql in queries:
+            self.assertIndexedPlan(sql)
+        return result
+
+    def personal_consumer(self, user, other_user):
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': user, 'url_route': {'kwargs': {'id': other_user.id}}}
+        consumer.thread_id = Thread.between(user.id, other_user.id).id
+        return consumer
+
+    def group_consumer(self, user):
+        consumer = GroupChatConsumer()
+        consumer.scope = {'user': user, 'url_route': {'kwargs': {'group_id': self.group.id}}}
+        consumer.group_id = self.group.id
+        consumer.user = user
+        return consumer
+
+    # Views
+
+    def test_chat_page(self):
+        # The 40 messages fit in one page, the archive is asked whether older ones exist
+        response = self.assertQueryBudget(8, self.client.get, reverse('chat', kwargs={'username': 'bob'}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_thread_messages(self):
+        newest = self.assertQueryBudget(
+            4, self.client.get, reverse('chat_messages', kwargs={'username': 'bob'}), {'limit': 10}
+        ).json()
+        # The last hot page reads through to the archive
+        self.assertQueryBudget(
+            5, self.client.get, reverse('chat_messages', kwargs={'username': 'bob'}), newest['next_cursor']
+        )
+
+    def test_group_messages(self):
+        url = reverse('get_group_messages', kwargs={'group_id': self.group.id})
+        self.assertQueryBudget(11, self.client.get, url)
+        self.assertQueryBudget(11, self.client.get, url, {'after': GroupMessage.objects.last().id - 5})
+
+    def test_create_group(self):
+        response = self.assertQueryBudget(
+            15, self.client.post, reverse('create_group'),
+            json.dumps({'name': 'new group', 'members': [self.bob.id, self.carol.id]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_notifications(self):
+        url = reverse('notifications')
+        chat_page = self.assertQueryBudget(4, self.client.get, url, {'limit': 25}).json()
+        self.assertEqual(len(chat_page['notifications']), 25)
+        self.assertTrue(chat_page['has_more'])
+        rest = self.assertQueryBudget(
+            4, self.client.get, url, {'limit': 25, 'before': chat_page['next_before']}
+        ).json()
+        self.assertEqual(len(rest['notifications']), 15)
+        self.assertFalse(rest['has_more'])
+
+        group_page = self.assertQueryBudget(3, self.client.get, url, {'kind': 'group'}).json()
+        self.assertEqual(len(group_page['notifications']), 30)
+        self.assertEqual(group_page['notifications'][0]['group_name'], 'friends')
+
+    def test_mark_notifications_seen(self):
+        self.assertQueryBudget(9, self.client.post, reverse('mark_notifications_seen'))
+        self.assertFalse(unread_chat_notifications(self.alice).exists())
+        self.assertEqual(UnreadCounter.get_count(self.alice.id), 0)
+
+    def test_upload_file(self):
+        upload = SimpleUploadedFile('notes.txt', b'hello', content_type='text/plain')
+        # The thread named by the client is looked up among the caller's
+        response = self.assertQueryBudget(
+            5, self.client.post, reverse('upload_file'), {'file': upload, 'thread_name': self.thread_name}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_file_details(self):
+        url = reverse('get_file_details', kwargs={'file_id': self.chat_file.id})
+        # The file, then whether the caller is a participant of its thread
+        response = self.assertQueryBudget(4, self.client.get, url)
+        self.assertEqual(response.json()['filename'], 'report.pdf')
+
+    def test_get_files_details(self):
+        bob_and_carol = Thread.between(self.bob.id, self.carol.id)
+        other_thread = ChatFile.objects.create(
+            file=SimpleUploadedFile('secret.pdf', b'%PDF-1.4 secret'), filename='secret.pdf', file_type='.pdf',
+            uploader=self.bob, thread=bob_and_carol, thread_name=bob_and_carol.name
+        )
+        ids = [self.chat_file.id, other_thread.id, other_thread.id + 100]
+        response = self.assertQueryBudget(
+            3, self.client.get, reverse('get_files_details'), {'ids': ','.join(map(str, ids))}
+        ).json()
+
+        self.assertEqual(list(response['files']), [str(self.chat_file.id)])
+        details = response['files'][str(self.chat_file.id)]
+        self.assertEqual((details['file_size'], details['content_type']), (8, 'application/pdf'))
+
+        with override_settings(CHAT_FILE_DETAILS_MAX_IDS=2):
+            self.assertEqual(self.client.get(reverse('get_files_details'), {'ids': '1,2,3'}).status_code, 400)
+
+    def test_serve_media_caches_the_permission(self):
+        cache.clear()
+        url = self.chat_file.file.url
+        self.assertEqual(self.assertQueryBudget(3, self.client.get, url).status_code, 200)
+        # Only the session and the user are loaded once the access is cached
+        self.assertEqual(self.assertQueryBudget(2, self.client.get, url).status_code, 200)
+
+    def test_service_worker(self):
+        self.assertQueryBudget(0, self.client.get, reverse('sw_file'))
+
+    # PersonalChatConsumer
+
+    def test_save_message(self):
+        consumer = self.personal_consumer(self.bob, self.alice)
+        self.assertQueryBudget(
+            10, db_method(PersonalChatConsumer, 'save_message'), consumer, 'bob', self.thread_name, 'hi', 'alice'
+        )
+
+    def test_save_file(self):
+        consumer = self.personal_consumer(self.bob, self.alice)
+        # The sender's access to the file is checked in the thread files, then the group files
+        self.assertQueryBudget(3, db_method(PersonalChatConsumer, 'save_file'), consumer, 'bob', self.thread_name,
+                               {'file_url': 'chat_files/a.txt', 'filename': 'a.txt'})
+
+    def test_get_user(self):
+        consumer = self.personal_consumer(self.bob, self.alice)
+        self.assertQueryBudget(1, db_method(PersonalChatConsumer, 'get_user'), consumer, self.alice.id)
+
+    def test_personal_unread_count(self):
+        consumer = self.personal_consumer(self.bob, self.alice)
+        count = self.assertQueryBudget(1, db_method(PersonalChatConsumer, 'get_unread_count'), consumer, self.alice.id)
+        # The seed records one message per conversation through the summaries
+        self.assertEqual(count, 2)
+
+    def test_personal_mark_messages_read(self):
+        consumer = self.personal_consumer(self.alice, self.bob)
+        # Moving the watermark costs the same however many of the 40 seeded messages are unread
+        self.assertQueryBudget(
+            5, db_method(PersonalChatConsumer, 'mark_messages_read'), consumer, self.thread_name, 'alice'
+        )
+        summary = ConversationSummary.objects.get(user=self.alice, thread_name=self.thread_name)
+        self.assertEqual(summary.last_read_message_id, summary.last_message_id)
+        self.assertFalse(unread_chat_notifications(self.alice).exists())
+
+    # NotificationConsumer and OnlineStatusConsumer
+
+    def test_notification_unread_count(self):
+        consumer = NotificationConsumer()
+        self.assertQueryBudget(1, db_method(NotificationConsumer, 'get_unread_count'), consumer, self.alice.id)
+
+    def test_save_last_seen(self):
+        now = timezone.now()
+        self.assertQueryBudget(1, save_last_seen, {self.alice.id: now, self.bob.id: now})
+        self.assertEqual(UserProfileModel.objects.get(user=self.bob).last_seen, now)
+
+    # GroupChatConsumer
+
+    def test_is_group_member(self):
+        self.assertTrue(self.assertQueryBudget(
+            1, db_method(GroupChatConsumer, 'is_group_member'), self.group_consumer(self.alice)
+        ))
+
+    def test_save_group_message(self):
+        self.assertQueryBudget(
+            11, db_method(GroupChatConsumer, 'save_group_message'), self.group_consumer(self.bob), 'hello', self.bob.id
+        )
+
+    def test_save_group_file(self):
+        self.assertQueryBudget(3, db_method(GroupChatConsumer, 'save_group_file'), self.group_consumer(self.bob),
+                               {'file_url': 'group_files/a.txt', 'filename': 'a.txt'}, self.bob.id)
+
+    def test_create_notifications(self):
+        message = GroupMessage.objects.create(group=self.group, sender=self.bob, content='hello')
+        group_name, recipients = self.assertQueryBudget(
+            4, db_method(GroupChatConsumer, 'create_notifications'), self.group_consumer(self.bob), message
+        )
+        self.assertEqual(group_name, 'friends')
+        self.assertEqual(sorted(member_id for member_id, _ in recipients), [self.alice.id, self.carol.id])
+
+    def test_group_mark_messages_read(self):
+        # One UPDATE per unseen notification, 30 are seeded
+        self.assertQueryBudget(
+            37, db_method(GroupChatConsumer, 'mark_messages_read'), self.group_consumer(self.alice), self.group.id, 'alice'
+        )
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class GroupFanoutTests(TransactionTestCase):
+    """
+    The fan-out's database work runs through database_sync_to_async, on
+    another thread that does not see the wrapping transaction of a plain
+    TestCase.  QueryBudgetTests counts its queries.
+    """
+
+    def setUp(self):
+        self.sender = User.objects.create_user('sender')
+        self.members = [User.objects.create_user(f'member{i}') for i in range(40)]
+        self.group = Group.objects.create(name='big group', created_by=self.sender)
+        self.group.members.add(self.sender, *self.members)
+
+    def test_every_member_gets_one_notification(self):
+        consumer = GroupChatConsumer()
+        consumer.group_id = self.group.id
+        consumer.user = self.sender
+        consumer.channel_layer = get_channel_layer()
+        channels = [async_to_sync(consumer.channel_layer.new_channel)() for _ in range(3)]
+        for member, channel in zip(self.members, channels):
+            async_to_sync(consumer.channel_layer.group_add)(f'{member.id}', channel)
+
+        message = GroupMessage.objects.create(group=self.group, sender=self.sender, content='hello')
+        ConversationSummary.record_group_message(message, self.sender)
+
+        async_to_sync(consumer.notify_members)(message)
+
+        self.assertEqual(GroupNotification.objects.filter(group=self.group).count(), 40)
+        for channel in channels:
+            data = json.loads(async_to_sync(consumer.channel_layer.receive)(channel)['frames'][protocol.JSON_V1])
+            self.assertEqual(data['unseen_count'], 1)
+            self.assertEqual(data['notification']['group_name'], 'big group')
+
+    def test_members_with_the_same_unread_total_share_one_frame(self):
+        consumer = GroupChatConsumer()
+        consumer.group_id = self.group.id
+        consumer.user = self.sender
+        consumer.channel_layer = get_channel_layer()
+        message = GroupMessage.objects.create(group=self.group, sender=self.sender, content='hello')
+        ConversationSummary.record_group_message(message, self.sender)
+
+        with patch('chats.consumers.prepare_frames', wraps=protocol.prepare_frames) as prepare_frames:
+            async_to_sync(consumer.notify_members)(message)
+        self.assertEqual(prepare_frames.call_count, 1)
+
+    def test_a_large_fan_out_does_not_hold_up_the_next_message(self):
+        large_group = User.objects.bulk_create([User(username=f'reader{i}') for i in range(500)])
+        self.group.members.add(*large_group)
+        consumer = GroupChatConsumer()
+        consumer.group_id = self.group.id
+        consumer.user = self.sender
+        consumer.channel_layer = get_channel_layer()
+
+        # The notifications' insert only goes on once the second message is saved
+        fan_out_started, release_fan_out = threading.Event(), threading.Event()
+        bulk_create = GroupNotification.objects.bulk_create
+
+        def slow_bulk_create(*args, **kwargs):
+            fan_out_started.set()
+            release_fan_out.wait(5)
+            return bulk_create(*args, **kwargs)
+
+        async def send_two_messages():
+            first = await consumer.store_group_message('first', self.sender.id)
+            fan_out = run_in_background(consumer.notify_members(first))
+            await asyncio.get_running_loop().run_in_executor(None, fan_out_started.wait, 5)
+            started = time.monotonic()
+            await consumer.store_group_message('second', self.sender.id)
+            elapsed, fan_out_pending = time.monotonic() - started, not fan_out.done()
+            release_fan_out.set()
+            await fan_out
+            return elapsed, fan_out_pending
+
+        with patch.object(GroupNotification.objects, 'bulk_create', slow_bulk_create):
+            elapsed, fan_out_pending = async_to_sync(send_two_messages)()
+
+        self.assertTrue(fan_out_pending)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(GroupNotification.objects.filter(group=self.group).count(), 540)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_PRESENCE_TTL=60)
+class PresenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+
+    def setUp(self):
+        self.registry = PresenceRegistry()
+
+    def test_user_stays_online_until_last_tab_closes(self):
+        self.assertTrue(self.registry.connect(self.alice, 'tab-1', now=0))
+        self.assertFalse(self.registry.connect(self.alice, 'tab-2', now=0))
+
+        self.assertFalse(self.registry.disconnect(self.alice, 'tab-1'))
+        self.assertTrue(self.registry.is_online(self.alice.id))
+        self.assertTrue(self.registry.disconnect(self.alice, 'tab-2'))
+        self.assertFalse(self.registry.is_online(self.alice.id))
+        # A repeated close is not a second transition
+        self.assertFalse(self.registry.disconnect(self.alice, 'tab-2'))
+
+    def test_silent_connections_expire(self):
+        self.registry.connect(self.alice, 'tab-1', now=0)
+        self.registry.connect(self.alice, 'tab-2', now=0)
+        self.registry.heartbeat(self.alice, 'tab-2', now=50)
+
+        self.assertEqual(self.registry.expire(now=90), [])
+        self.assertTrue(self.registry.is_online(self.alice.id))
+        self.assertEqual(self.registry.expire(now=120), [self.alice.id])
+        self.assertFalse(self.registry.is_online(self.alice.id))
+
+    def test_last_seen_is_collected_until_flushed(self):
+        self.registry.connect(self.alice, 'tab-1', now=0)
+        self.registry.disconnect(self.alice, 'tab-1')
+
+        last_seen = self.registry.pop_last_seen()
+        self.assertEqual(list(last_seen), [self.alice.id])
+        self.assertEqual(self.registry.pop_last_seen(), {})
+
+        with self.assertNumQueries(1):
+            save_last_seen(last_seen)
+        self.assertEqual(UserProfileModel.objects.get(user=self.alice).last_seen, last_seen[self.alice.id])
+
+    def test_diffs_are_coalesced_per_subscriber(self):
+        self.registry.subscribe('watcher-1', [self.alice.id, self.bob.id])
+        self.registry.subscribe('watcher-2', [self.alice.id])
+
+        self.registry.connect(self.alice, 'tab-1', now=0)
+        self.registry.connect(self.alice, 'tab-2', now=0)
+        # Bob coming and going within one batch is no change at all
+        self.registry.connect(self.bob, 'tab-1', now=0)
+        self.registry.disconnect(self.bob, 'tab-1')
+
+        self.assertEqual(self.registry.pop_diffs(), {
+            'watcher-1': {self.alice.id: True},
+            'watcher-2': {self.alice.id: True},
+        })
+        self.assertEqual(self.registry.pop_diffs(), {})
+
+    def test_unsubscribed_connections_get_nothing(self):
+        self.registry.subscribe('watcher', [self.alice.id])
+        self.assertEqual(self.registry.subscribe('watcher', [self.bob.id]), {self.bob.id: False})
+        self.registry.connect(self.alice, 'tab-1', now=0)
+        self.assertEqual(self.registry.pop_diffs(), {})
+
+        self.registry.subscribe('watcher', [self.alice.id])
+        self.registry.disconnect(self.alice, 'tab-1')
+        # Closing the watching socket drops its subscriptions
+        self.registry.disconnect(self.bob, 'watcher')
+        self.assertEqual(self.registry.pop_diffs(), {})
+
+    def test_publish_sends_one_diff_without_queries(self):
+        channel_layer = get_channel_layer()
+        watcher = async_to_sync(channel_layer.new_channel)()
+        self.registry.subscribe(watcher, [self.alice.id, self.bob.id])
+        self.registry.connect(self.alice, 'tab-1', now=0)
+        self.registry.connect(self.bob, 'tab-1', now=0)
+
+        with patch('chats.presence.registry', self.registry), self.assertNumQueries(0):
+            async_to_sync(presence.publish)(channel_layer)
+
+        event = async_to_sync(channel_layer.receive)(watcher)
+        self.assertEqual(event['type'], 'presence_diff')
+        self.assertEqual(json.loads(event['frames'][protocol.JSON_V1]), {
+            'type': 'presence', 'online': {str(self.alice.id): True, str(self.bob.id): True}
+        })
+
+    def test_malformed_frames_and_ids_are_ignored(self):
+        consumer = OnlineStatusConsumer()
+        consumer.scope = {'user': self.alice}
+        consumer.channel_name = 'watcher'
+        sent = []
+
+        async def send_event(event):
+            sent.append(event)
+
+        consumer.send_event = send_event
+        with patch('chats.presence.registry', self.registry):
+            async_to_sync(consumer.receive)(text_data=json.dumps({'user_ids': [self.bob.id]}))
+            async_to_sync(consumer.receive)(text_data=json.dumps({
+                'type': 'subscribe', 'user_ids': [self.bob.id, 'bob', None, [1], str(self.alice.id)]
+            }))
+            async_to_sync(consumer.receive)(text_data=json.dumps({'type': 'subscribe', 'user_ids': 'bob'}))
+
+        self.assertEqual(sent, [
+            # The frames count as heartbeats of the watching user
+            {'type': 'presence', 'online': {str(self.bob.id): False, str(self.alice.id): True}},
+            {'type': 'presence', 'online': {}}
+        ])
+
+
+@override_settings(CHAT_WRITE_BEHIND_INTERVAL=0.001, CHAT_WRITE_BEHIND_BATCH_SIZE=50)
+class WriteBehindTests(TransactionTestCase):
+    """
+    Batches are written through database_sync_to_async, which does not see
+    the wrapping transaction of a plain TestCase
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='password')
+        self.bob = User.objects.create_user('bob', password='password')
+        self.thread = Thread.between(self.alice.id, self.bob.id)
+        self.thread_name = self.thread.name
+
+    @override_settings(CHAT_WRITE_BEHIND_INTERVAL=10)
+    def test_ids_follow_the_commit_order(self):
+        batcher = WriteBehindBatcher(write_personal_messages)
+        queued = ChatModel(sender=self.alice, message='queued', thread=self.thread, thread_name=self.thread_name)
+
+        async def run():
+            committed = await batcher.submit(queued, self.alice, self.bob.id, 'bob')
+            # Saved while the batch waits for its timer
+            direct = await database_sync_to_async(ChatModel.objects.create)(
+                sender=self.alice, message='direct', thread=self.thread, thread_name=self.thread_name
+            )
+            await batcher.flush()
+            await committed
+            return direct
+
+        direct = async_to_sync(run)()
+        self.assertGreater(queued.id, direct.id)
+        self.assertEqual(list(ChatModel.objects.order_by('id').values_list('message', flat=True)), ['direct', 'queued'])
+
+    def test_batched_messages_keep_their_ids_and_update_the_summaries(self):
+        batcher = WriteBehindBatcher(write_personal_messages)
+
+        async def send_all():
+            chats, commits = [], []
+            for i, (sender, receiver) in enumerate([(self.alice, self.bob)] * 3 + [(self.bob, self.alice)]):
+                chat = ChatModel(sender=sender, message=f'message {i}',
+                                 thread=self.thread, thread_name=self.thread_name)
+                commits.append(await batcher.submit(chat, sender, receiver.id, receiver.username))
+                chats.append(chat)
+            await asyncio.gather(*commits)
+            return chats
+
+        chats = async_to_sync(send_all)()
+
+        self.assertEqual(
+            list(ChatModel.objects.order_by('id').values_list('id', 'message', 'seq')),
+            [(chat.id, chat.message, seq) for seq, chat in enumerate(chats, 1)]
+        )
+        self.assertEqual(ChatNotification.objects.filter(user=self.bob).count(), 3)
+        bob_summary = ConversationSummary.objects.get(user=self.bob, thread_name=self.thread_name)
+        alice_summary = ConversationSummary.objects.get(user=self.alice, thread_name=self.thread_name)
+        self.assertEqual((bob_summary.unread_count, bob_summary.last_read_message_id), (3, chats[3].id))
+        self.assertEqual((alice_summary.unread_count, alice_summary.last_read_message_id), (1, chats[2].id))
+        self.assertEqual(alice_summary.last_message_id, chats[3].id)
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 3)
+        self.assertEqual(UnreadCounter.get_count(self.alice.id), 1)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_WRITE_BEHIND=True)
+    def test_concurrent_messages_are_written_in_full_batches(self):
+        batches = []
+
+        def write_batch(entries):
+            batches.append(len(entries))
+            write_personal_messages(entries)
+
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': self.alice, 'url_route': {'kwargs': {'id': self.bob.id}}}
+        consumer.thread_id = self.thread.id
+
+        async def send_all():
+            await asyncio.gather(*[consumer.store_message('alice', self.thread_name, f'message {i}', 'bob')
+                                   for i in range(120)])
+
+        with patch('chats.writebehind.personal_messages', WriteBehindBatcher(write_batch)):
+            async_to_sync(send_all)()
+
+        # The other 70 are queued while the first batch is written
+        self.assertEqual(batches, [50, 70])
+        self.assertEqual(sorted(ChatModel.objects.values_list('seq', flat=True)), list(range(1, 121)))
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 120)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_WRITE_BEHIND=True)
+    def test_broadcast_carries_the_id_of_the_saved_message(self):
+        async def run():
+            communicator = WebsocketCommunicator(PersonalChatConsumer.as_asgi(), f'/ws/{self.bob.id}/')
+            communicator.scope['user'] = self.alice
+            communicator.scope['url_route'] = {'kwargs': {'id': self.bob.id}}
+            await communicator.connect()
+            await communicator.send_json_to({'message': 'hello', 'username': 'alice', 'receiver': 'bob'})
+            frame = await communicator.receive_json_from(timeout=5)
+            while 'message' not in frame:
+                frame = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(run)()
+        chat = ChatModel.objects.get()
+        self.assertEqual((frame['message_id'], frame['seq']), (chat.id, chat.seq))
+
+    def test_batched_group_messages_match_one_by_one_writes(self):
+        group = Group.objects.create(name='friends', created_by=self.alice)
+        group.members.add(self.alice, self.bob)
+        batcher = WriteBehindBatcher(write_group_messages)
+
+        async def send_all():
+            commits = []
+            for sender in (self.alice, self.bob, self.bob):
+                message = GroupMessage(group_id=group.id, sender=sender, content='hello')
+                commits.append(await batcher.submit(message, sender))
+            await asyncio.gather(*commits)
+
+        async_to_sync(send_all)()
+
+        summaries = {s.user_id: s.unread_count for s in ConversationSummary.objects.filter(group=group)}
+        self.assertEqual(summaries, {self.alice.id: 2, self.bob.id: 1})
+        self.assertEqual(UnreadCounter.get_count(self.alice.id), 2)
+
+
+@benchmark
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_WRITE_BEHIND_BATCH_SIZE=100)
+class WriteBehindThroughputTests(TransactionTestCase):
+    """
+    Benchmark: the same messages saved through PersonalChatConsumer.store_message,
+    one transaction each and with CHAT_WRITE_BEHIND on
+    """
+    MESSAGES = 2000
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='password')
+        self.bob = User.objects.create_user('bob', password='password')
+        self.thread = Thread.between(self.alice.id, self.bob.id)
+        self.thread_name = self.thread.name
+
+    def test_batched_writes_are_faster_than_per_row_writes(self):
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': self.alice, 'url_route': {'kwargs': {'id': self.bob.id}}}
+        consumer.thread_id = self.thread.id
+
+        async def send_one_by_one():
+            for i in range(self.MESSAGES):
+                await consumer.store_message('alice', self.thread_name, f'message {i}', 'bob')
+
+        async def send_at_once():
+            # Sockets of many users write concurrently
+            await asyncio.gather(*[consumer.store_message('alice', self.thread_name, f'message {i}', 'bob')
+                                   for i in range(self.MESSAGES)])
+
+        start = time.perf_counter()
+        async_to_sync(send_one_by_one)()
+        per_row = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with override_settings(CHAT_WRITE_BEHIND=True):
+            async_to_sync(send_at_once)()
+        batched = time.perf_counter() - start
+
+        self.assertEqual(ChatModel.objects.count(), 2 * self.MESSAGES)
+        self.assertEqual(sorted(ChatModel.objects.values_list('seq', flat=True)), list(range(1, 2 * self.MESSAGES + 1)))
+        self.assertEqual(UnreadCounter.get_count(self.bob.id), 2 * self.MESSAGES)
+        summary = (f'{self.MESSAGES} messages: per-row {self.MESSAGES / per_row:.0f} msg/s, '
+                   f'batched {self.MESSAGES / batched:.0f} msg/s')
+        self.assertLess(batched * 3, per_row, summary)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_TYPING_MIN_INTERVAL=1, CHAT_TYPING_TTL=5)
+class TypingAggregatorTests(SimpleTestCase):
+    def setUp(self):
+        self.aggregator = TypingAggregator()
+
+    def test_reports_are_rate_limited_per_sender(self):
+        self.assertTrue(self.aggregator.report('room', 'alice', True, now=0))
+        self.assertFalse(self.aggregator.report('room', 'alice', True, now=0.5))
+        self.assertTrue(self.aggregator.report('room', 'bob', True, now=0.5))
+        self.assertTrue(self.aggregator.report('room', 'alice', True, now=1))
+        # Stopping is never rate-limited
+        self.assertTrue(self.aggregator.report('room', 'alice', False, now=1.1))
+
+    def test_typists_of_a_room_are_merged_into_one_change(self):
+        self.aggregator.report('room', 'bob', True, now=0)
+        self.aggregator.report('room', 'alice', True, now=0)
+        self.aggregator.report('other', 'carol', True, now=0)
+        self.assertEqual(self.aggregator.pop_changes(), {'room': ['alice', 'bob'], 'other': ['carol']})
+
+        # Still typing is not a change
+        self.aggregator.report('room', 'alice', True, now=2)
+        self.assertEqual(self.aggregator.pop_changes(), {})
+
+        self.aggregator.report('room', 'alice', False, now=3)
+        self.assertEqual(self.aggregator.pop_changes(), {'room': ['bob']})
+
+    def test_silent_typists_expire(self):
+        self.aggregator.report('room', 'alice', True, now=0)
+        self.aggregator.report('room', 'bob', True, now=3)
+        self.aggregator.pop_changes()
+
+        self.aggregator.expire(now=6)
+        self.assertEqual(self.aggregator.pop_changes(), {'room': ['bob']})
+        self.aggregator.expire(now=9)
+        self.assertEqual(self.aggregator.pop_changes(), {'room': []})
+
+    def test_layer_messages_per_second_with_100_typists(self):
+        """
+        Benchmark: 100 members of one group typing 10 keystrokes a second for
+        10 seconds, with the room published every CHAT_TYPING_BATCH_INTERVAL
+        """
+        channel_layer = get_channel_layer()
+        sent = []
+        original_group_send = channel_layer.group_send
+
+        async def counting_group_send(group, message):
+            sent.append(message)
+            await original_group_send(group, message)
+
+        typists = [f'member{i}' for i in range(100)]
+        keystrokes = 0
+        with patch('chats.typing_indicators.aggregator', self.aggregator), \
+                patch.object(channel_layer, 'group_send', counting_group_send):
+            for tick in range(200):
+                now = tick * 0.1
+                if now < 10:
+                    for username in typists:
+                        self.aggregator.report('group_1', username, True, now=now)
+                        keystrokes += 1
+                if tick % 5 == 0:
+                    async_to_sync(typing_indicators.publish)(channel_layer, now)
+
+        duration = 20
+        relayed_rate = keystrokes / duration
+        aggregated_rate = len(sent) / duration
+        summary = (f'100 typists: {relayed_rate:.0f} layer messages/s relayed one by one, '
+                   f'{aggregated_rate:.2f}/s aggregated')
+        self.assertEqual(json.loads(sent[0]['frames'][protocol.JSON_V1])['usernames'], sorted(typists), summary)
+        self.assertEqual(json.loads(sent[-1]['frames'][protocol.JSON_V1])['usernames'], [], summary)
+        self.assertLessEqual(aggregated_rate, 2, summary)
+
+
+class WireProtocolTests(SimpleTestCase):
+    CHAT_MESSAGE = {
+        'message': 'See you at the station at 6?',
+        'sender': {'id': 42, 'username': 'alice'},
+        'message_type': 'text',
+        'file_data': None,
+        'message_id': 123456,
+        'timestamp': '2026-10-18T09:30:15.123000+00:00',
+    }
+    NOTIFICATION = {
+        'unseen_count': 7,
+        'notification': {
+            'sender_username': 'alice',
+            'group_id': 3,
+            'group_name': 'friends',
+            'timestamp': '2026-10-18T09:30:15.123000+00:00',
+            'message_preview': 'See you at the station at 6?',
+        },
+    }
+
+    def test_negotiation_prefers_binary_and_falls_back_to_plain_json(self):
+        self.assertEqual(protocol.negotiate([protocol.JSON_V1, protocol.MSGPACK_V1]), protocol.MSGPACK_V1)
+        self.assertEqual(protocol.negotiate([protocol.JSON_V1]), protocol.JSON_V1)
+        self.assertIsNone(protocol.negotiate([]))
+        self.assertIsNone(protocol.negotiate(['chat.unknown.v9']))
+        # Batching is only chosen when the client asks for it
+        self.assertEqual(protocol.negotiate([protocol.JSON_BATCH_V1, protocol.JSON_V1]), protocol.JSON_BATCH_V1)
+        self.assertEqual(protocol.encoding_of(protocol.MSGPACK_BATCH_V1), protocol.MSGPACK_V1)
+
+    def test_joined_frames_are_arrays_of_the_events(self):
+        for count in (1, 20):
+            events = [dict(self.CHAT_MESSAGE, message_id=i) for i in range(count)]
+            joined = protocol.join_frames([protocol.serialize(event, protocol.JSON_V1) for event in events])
+            self.assertEqual(json.loads(joined), events)
+            joined = protocol.join_frames([protocol.serialize(event, protocol.MSGPACK_V1) for event in events])
+            self.assertEqual(protocol.expand(msgpack.unpackb(joined)), events)
+
+    def test_binary_frames_round_trip(self):
+        for event in (self.CHAT_MESSAGE, self.NOTIFICATION):
+            frame = protocol.encode(event, protocol.MSGPACK_V1)
+            self.assertEqual(protocol.decode(None, frame['bytes_data'], protocol.MSGPACK_V1), event)
+
+    def test_json_frames_are_unchanged(self):
+        self.assertEqual(protocol.encode(self.CHAT_MESSAGE, None), {'text_data': json.dumps(self.CHAT_MESSAGE)})
+        self.assertEqual(protocol.encode(self.CHAT_MESSAGE, protocol.JSON_V1), {'text_data': json.dumps(self.CHAT_MESSAGE)})
+
+    def test_prepared_frames_match_per_socket_encoding(self):
+        frames = protocol.prepare_frames(self.CHAT_MESSAGE)
+        self.assertEqual(frames[protocol.JSON_V1], protocol.encode(self.CHAT_MESSAGE, None)['text_data'])
+        self.assertEqual(frames[protocol.MSGPACK_V1], protocol.encode(self.CHAT_MESSAGE, protocol.MSGPACK_V1)['bytes_data'])
+
+    def test_bytes_and_cpu_per_frame(self):
+        """Benchmark: size and encode + decode time of common frames, JSON against the binary encoding"""
+        rounds = 20000
+        report = []
+        for name, event in (('chat_message', self.CHAT_MESSAGE), ('notification', self.NOTIFICATION)):
+            json_frame = protocol.encode(event, protocol.JSON_V1)['text_data']
+            binary_frame = protocol.encode(event, protocol.MSGPACK_V1)['bytes_data']
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                protocol.decode(protocol.encode(event, protocol.JSON_V1)['text_data'], None, protocol.JSON_V1)
+            json_cost = (time.perf_counter() - start) / rounds
+            start = time.perf_counter()
+            for _ in range(rounds):
+                protocol.decode(None, protocol.encode(event, protocol.MSGPACK_V1)['bytes_data'], protocol.MSGPACK_V1)
+            binary_cost = (time.perf_counter() - start) / rounds
+
+            report.append(f'{name}: json {len(json_frame.encode())} B {json_cost * 1e6:.1f} us, '
+                          f'msgpack {len(binary_frame)} B {binary_cost * 1e6:.1f} us')
+            self.assertLess(len(binary_frame), len(json_frame.encode()) * 0.6, '\n'.join(report))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class NegotiatedConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='password')
+        UnreadCounter.objects.create(user=self.alice, count=3)
+
+    def connect(self, subprotocols):
+        communicator = WebsocketCommunicator(
+            NotificationConsumer.as_asgi(), f'/ws/notification/{self.alice.id}/', subprotocols=subprotocols
+        )
+        communicator.scope['user'] = self.alice
+        return communicator
+
+    def test_binary_client_gets_binary_frames(self):
+        async def run():
+            communicator = self.connect([protocol.MSGPACK_V1, protocol.JSON_V1])
+            connected, subprotocol = await communicator.connect()
+            frame = await communicator.receive_output()
+            await communicator.disconnect()
+            return connected, subprotocol, frame
+
+        connected, subprotocol, frame = async_to_sync(run)()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, protocol.MSGPACK_V1)
+        self.assertEqual(msgpack.unpackb(frame['bytes']), {'n': 3})
+
+    def test_client_without_subprotocol_keeps_json(self):
+        async def run():
+            communicator = self.connect([])
+            await communicator.connect()
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        self.assertEqual(async_to_sync(run)(), {'unseen_count': 3})
+
+    def test_broadcast_frames_are_forwarded_verbatim(self):
+        frames = protocol.prepare_frames({'unseen_count': 4})
+
+        async def run():
+            binary, plain = self.connect([protocol.MSGPACK_V1]), self.connect([])
+            for communicator in (binary, plain):
+                await communicator.connect()
+                await communicator.receive_output()
+            await get_channel_layer().group_send(f'{self.alice.id}', {'type': 'send_notification', 'frames': frames})
+            received = await binary.receive_output(), await plain.receive_output()
+            for communicator in (binary, plain):
+                await communicator.disconnect()
+            return received
+
+        binary_frame, plain_frame = async_to_sync(run)()
+        self.assertEqual(binary_frame['bytes'], frames[protocol.MSGPACK_V1])
+        self.assertEqual(plain_frame['text'], frames[protocol.JSON_V1])
+
+    def send_burst(self, subprotocols, count):
+        """Connect, broadcast ``count`` notifications at once and return the frames received"""
+        async def run():
+            communicator = self.connect(subprotocols)
+            await communicator.connect()
+            received = [await communicator.receive_output()]
+            for unseen_count in range(count):
+                await get_channel_layer().group_send(f'{self.alice.id}', {
+                    'type': 'send_notification', 'frames': protocol.prepare_frames({'unseen_count': unseen_count})
+                })
+            while not await communicator.receive_nothing(timeout=0.1):
+                received.append(await communicator.receive_output())
+            await communicator.disconnect()
+            return [json.loads(frame['text']) for frame in received]
+
+        return async_to_sync(run)()
+
+    @override_settings(CHAT_COALESCE_WINDOW=0.05, CHAT_COALESCE_MAX_DELAY=0.2)
+    def test_batching_client_gets_a_burst_in_one_array_frame(self):
+        frames = self.send_burst([protocol.JSON_BATCH_V1], 5)
+        self.assertEqual(frames, [
+            [{'unseen_count': 3}],
+            [{'unseen_count': unseen_count} for unseen_count in range(5)],
+        ])
+
+    @override_settings(CHAT_COALESCE_WINDOW=0.05, CHAT_COALESCE_MAX_DELAY=0.2, CHAT_COALESCE_MAX_FRAMES=2)
+    def test_batches_are_capped_in_size(self):
+        frames = self.send_burst([protocol.JSON_BATCH_V1], 5)
+        self.assertEqual([len(frame) for frame in frames], [1, 2, 2, 1])
+
+    def test_client_without_batching_gets_one_frame_per_event(self):
+        frames = self.send_burst([protocol.JSON_V1], 5)
+        self.assertEqual(frames, [{'unseen_count': 3}] + [{'unseen_count': n} for n in range(5)])
+
+    @override_settings(CHAT_COALESCE_WINDOW=10, CHAT_COALESCE_MAX_DELAY=0.05)
+    def test_buffering_never_adds_more_than_the_max_delay(self):
+        async def run():
+            communicator = self.connect([protocol.JSON_BATCH_V1])
+            await communicator.connect()
+            start = time.monotonic()
+            frame = await communicator.receive_output(timeout=1)
+            elapsed = time.monotonic() - start
+            await communicator.disconnect()
+            return frame, elapsed
+
+        frame, elapsed = async_to_sync(run)()
+        self.assertEqual(json.loads(frame['text']), [{'unseen_count': 3}])
+        self.assertLess(elapsed, 0.5)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_RESUME_MAX_GAP=5)
+class ResumeTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='password')
+        self.bob = User.objects.create_user('bob', password='password')
+        self.thread = Thread.between(self.alice.id, self.bob.id)
+        self.thread_name = self.thread.name
+
+    def save_messages(self, count):
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': self.alice, 'url_route': {'kwargs': {'id': self.bob.id}}}
+        consumer.thread_id = self.thread.id
+        for i in range(count):
+            db_method(PersonalChatConsumer, 'save_message')(consumer, 'alice', self.thread_name, f'message {i}', 'bob')
+
+    def resume(self, last_seq):
+        """Reconnect as bob, resume after ``last_seq`` and return the frames received"""
+        async def run():
+            communicator = WebsocketCommunicator(PersonalChatConsumer.as_asgi(), f'/ws/{self.alice.id}/')
+            communicator.scope['user'] = self.bob
+            communicator.scope['url_route'] = {'kwargs': {'id': self.alice.id}}
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'resume', 'last_seq': last_seq})
+            frames = []
+            while not await communicator.receive_nothing(timeout=0.1):
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        return async_to_sync(run)()
+
+    def test_sequence_numbers_are_per_conversation(self):
+        self.save_messages(3)
+        self.assertEqual(list(ChatModel.objects.order_by('id').values_list('seq', flat=True)), [1, 2, 3])
+        self.assertEqual(MessageSequence.reserve('group_1', 10), 1)
+        self.assertEqual(MessageSequence.reserve('group_1'), 11)
+        self.assertEqual(MessageSequence.reserve(self.thread_name), 4)
+
+    def test_gap_is_one_range_scan_of_the_index(self):
+        self.save_messages(4)
+        queryset = ChatModel.objects.filter(thread=self.thread)
+        with self.assertNumQueries(1):
+            messages = messages_after_seq(queryset, 1)
+        self.assertEqual([message.seq for message in messages], [2, 3, 4])
+        plan = explain(*queryset.filter(seq__gt=1).order_by('seq').query.sql_with_params())
+        self.assertIn('(thread_id=? AND seq>?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_reconnecting_client_gets_only_the_missed_messages(self):
+        self.save_messages(4)
+        frames = self.resume(2)
+        self.assertEqual([(frame['seq'], frame['message']) for frame in frames], [(3, 'message 2'), (4, 'message 3')])
+        self.assertEqual([frame['message_id'] for frame in frames],
+                         list(ChatModel.objects.filter(seq__gt=2).order_by('seq').values_list('id', flat=True)))
+        self.assertEqual(self.resume(4), [])
+
+    def test_file_messages_are_replayed_with_their_file_data(self):
+        saved = ChatFile.objects.create(file='chat_files/notes.txt', filename='notes.txt', file_type='.txt',
+                                        uploader=self.alice, thread=self.thread, thread_name=self.thread_name, size=5)
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': self.alice, 'url_route': {'kwargs': {'id': self.bob.id}}}
+        consumer.thread_id = self.thread.id
+        db_method(PersonalChatConsumer, 'save_message')(
+            consumer, 'alice', self.thread_name, f'Sent a file: notes.txt [file_id:{saved.id}]', 'bob'
+        )
+
+        frame, = self.resume(0)
+        self.assertEqual(frame['message_type'], 'file')
+        self.assertEqual(frame['file_data'], {
+            'file_id': saved.id, 'filename': 'notes.txt', 'file_url': saved.file.url, 'file_type': '.txt',
+            'file_size': 5
+        })
+
+    def test_client_too_far_behind_falls_back_to_history(self):
+        self.save_messages(7)
+        self.assertEqual(self.resume(1), [{'type': 'resync'}])
+
+
+class GeneratedStream:
+    """A readable stream of ``size`` bytes that never holds more than one read in memory"""
+
+    def __init__(self, size, stop_after=None):
+        self.remaining = size if stop_after is None else min(size, stop_after)
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return b'x' * size
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), CHAT_UPLOAD_TEMP_DIR=tempfile.mkdtemp(),
+                   CHAT_UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(TestCase):
+    DATA = b'hello chunked world'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def start(self, checksum=None, **target):
+        target = target or {'thread_name': self.thread_name}
+        return self.client.post(reverse('start_chunked_upload'), json.dumps({
+            'filename': 'notes.txt',
+            'size': len(self.DATA),
+            'checksum': hashlib.sha256(self.DATA).hexdigest() if checksum is None else checksum,
+            **target
+        }), content_type='application/json')
+
+    def put_chunk(self, upload_id, offset, data):
+        return self.client.put(f"{reverse('upload_chunk', kwargs={'upload_id': upload_id})}?offset={offset}",
+                               data, content_type='application/octet-stream')
+
+    def send_all(self, upload_id, offset=0):
+        while offset < len(self.DATA):
+            response = self.put_chunk(upload_id, offset, self.DATA[offset:offset + 4])
+            self.assertEqual(response.status_code, 200)
+            offset = response.json()['offset']
+
+    def complete(self, upload_id):
+        return self.client.post(reverse('complete_chunked_upload', kwargs={'upload_id': upload_id}))
+
+    def test_chunks_become_a_chat_file(self):
+        upload_id = self.start().json()['upload_id']
+        self.send_all(upload_id)
+        response = self.complete(upload_id)
+
+        self.assertEqual(response.json()['status'], 'success')
+        chat_file = ChatFile.objects.get(id=response.json()['file_id'])
+        self.assertEqual((chat_file.thread_name, chat_file.file_type), (self.thread_name, '.txt'))
+        with chat_file.file.open('rb') as f:
+            self.assertEqual(f.read(), self.DATA)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(os.listdir(settings.CHAT_UPLOAD_TEMP_DIR))
+
+    def test_upload_resumes_after_a_dropped_connection(self):
+        upload_id = self.start().json()['upload_id']
+        upload = ChunkedUpload.objects.get(id=upload_id)
+        # The connection drops 6 bytes into a 10 bytes chunk, those 6 bytes are kept
+        uploads.append_chunk(upload, io.BytesIO(self.DATA[:6]), 0, 10)
+
+        status = self.client.get(reverse('upload_chunk', kwargs={'upload_id': upload_id})).json()
+        self.assertEqual(status['offset'], 6)
+        # A chunk sent again from the old offset is refused with the offset to resume from
+        response = self.put_chunk(upload_id, 0, self.DATA[:4])
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 6))
+
+        self.send_all(upload_id, status['offset'])
+        self.assertEqual(self.complete(upload_id).json()['status'], 'success')
+
+    def test_incomplete_or_corrupt_uploads_are_refused(self):
+        upload_id = self.start(checksum='0' * 64).json()['upload_id']
+        self.assertEqual(self.complete(upload_id).status_code, 409)
+
+        self.send_all(upload_id)
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ChatFile.objects.exists())
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_uploads_are_limited_to_own_threads_and_groups(self):
+        group = Group.objects.create(name='friends', created_by=self.alice)
+        group.members.add(self.alice, self.bob)
+        self.assertEqual(self.start(thread_name=get_thread_name(self.bob.id, self.carol.id)).status_code, 403)
+        self.client.force_login(self.carol)
+        self.assertEqual(self.start(group_id=group.id).status_code, 403)
+
+        self.client.force_login(self.bob)
+        upload_id = self.start(group_id=group.id).json()['upload_id']
+        self.send_all(upload_id)
+        group_file = GroupFile.objects.get(id=self.complete(upload_id).json()['file_id'])
+        self.assertEqual((group_file.group, group_file.uploader), (group, self.bob))
+
+        # Someone else's upload does not exist for the others
+        self.client.force_login(self.alice)
+        self.assertEqual(self.put_chunk(self.start().json()['upload_id'], 0, b'data').status_code, 200)
+        self.client.force_login(self.carol)
+        self.assertEqual(self.put_chunk(ChunkedUpload.objects.get().id, 4, b'data').status_code, 404)
+
+    @override_settings(CHAT_UPLOAD_MAX_OPEN=2, CHAT_UPLOAD_EXPIRE_AFTER_HOURS=24)
+    def test_open_uploads_are_capped_and_abandoned_ones_expire(self):
+        first, second = [self.start().json()['upload_id'] for _ in range(2)]
+        self.assertEqual(self.start().status_code, 429)
+        # Another user has their own allowance
+        self.client.force_login(self.bob)
+        self.assertEqual(self.start().status_code, 201)
+        self.client.force_login(self.alice)
+
+        ChunkedUpload.objects.filter(id=first).update(updated_at=timezone.now() - timedelta(hours=25))
+        self.assertEqual(self.put_chunk(second, 0, b'hell').status_code, 200)
+        orphan = os.path.join(settings.CHAT_UPLOAD_TEMP_DIR, 'orphan.part')
+        open(orphan, 'wb').close()
+        os.utime(orphan, (0, 0))
+
+        out = io.StringIO()
+        call_command('expire_uploads', '--sleep', '0', stdout=out)
+        self.assertIn('1 uploads idle since', out.getvalue())
+        self.assertFalse(ChunkedUpload.objects.filter(id=first).exists())
+        self.assertFalse(os.path.exists(os.path.join(settings.CHAT_UPLOAD_TEMP_DIR, f'{first}.part')))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(os.path.join(settings.CHAT_UPLOAD_TEMP_DIR, f'{second}.part')))
+
+        # An abandoned upload never blocks a new one
+        self.assertEqual(self.start().status_code, 201)
+        self.assertEqual(self.start().status_code, 429)
+        ChunkedUpload.objects.filter(id=second).update(updated_at=timezone.now() - timedelta(hours=25))
+        self.assertEqual(self.start().status_code, 201)
+        self.assertFalse(ChunkedUpload.objects.filter(id=second).exists())
+
+    def test_memory_stays_flat_whatever_the_chunk_size(self):
+        """Peak Python memory while streaming an 8 MiB chunk to disk stays far below its size"""
+        size = 8 * 1024 * 1024
+        upload = uploads.start_upload(self.alice, 'big.bin', size, thread=self.thread)
+
+        tracemalloc.start()
+        try:
+            uploads.append_chunk(upload, GeneratedStream(size), 0, size)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        os.remove(uploads.partial_path(upload))
+
+        self.assertEqual(upload.received, size)
+        self.assertLess(peak, 1024 * 1024, f'{peak / 1024:.0f} KiB peak')
+
+
+class ContentAddressedStorageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=media_root)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.media_root = media_root
+
+    def media_files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.media_root)
+                      for root, _, names in os.walk(self.media_root) for name in names)
+
+    def upload(self, filename, data):
+        return ChatFile.objects.create(file=SimpleUploadedFile(filename, data), filename=filename,
+                                       file_type=os.path.splitext(filename)[1], uploader=self.alice,
+                                       thread=self.thread, thread_name=self.thread_name)
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload('BigTable.pdf', b'%PDF big table')
+        second = self.upload('BigTable.pdf', b'%PDF big table')
+        other = self.upload('notes.txt', b'other content')
+
+        sha256 = hashlib.sha256(b'%PDF big table').hexdigest()
+        self.assertEqual(first.file.name, f'blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}.pdf')
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertNotEqual(other.file.name, first.file.name)
+        self.assertEqual(len(self.media_files()), 2)
+        self.assertEqual(Blob.objects.get(sha256=sha256).refcount, 2)
+
+    def test_deleting_a_file_only_drops_a_reference(self):
+        first = self.upload('a.pdf', b'shared')
+        second = self.upload('b.pdf', b'shared')
+        blob = Blob.objects.get()
+
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.refcount, 1)
+        with second.file.open('rb') as f:
+            self.assertEqual(f.read(), b'shared')
+
+        second.delete()
+        call_command('dedupe_media', '--gc', stdout=io.StringIO())
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.media_files(), [])
+
+    def test_upload_during_the_purge_keeps_its_file(self):
+        self.upload('a.pdf', b'shared').delete()
+        real_replace = os.replace
+        uploaded = []
+
+        def replace_then_upload(src, dst):
+            real_replace(src, dst)
+            if dst.endswith('.purge'):
+                # Same content sent while the collector holds the file aside
+                uploaded.append(self.upload('b.pdf', b'shared'))
+
+        with patch('chats.storage.os.replace', replace_then_upload):
+            call_command('dedupe_media', '--gc', stdout=io.StringIO())
+
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        with uploaded[0].file.open('rb') as f:
+            self.assertEqual(f.read(), b'shared')
+        self.assertEqual(self.media_files(), [uploaded[0].file.name])
+
+    def test_command_deduplicates_existing_media_in_place(self):
+        legacy = []
+        for name in ('chat_files/BigTable.pdf', 'chat_files/BigTable_4m1ETAA.pdf', 'chat_files/BigTable_GruDOfl.pdf'):
+            path = os.path.join(self.media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'%PDF big table')
+            legacy.append(ChatFile.objects.create(file=name, filename='BigTable.pdf', file_type='.pdf',
+                                                  uploader=self.alice,
+                                                  thread=self.thread, thread_name=self.thread_name))
+        # A row pointing at another one's file by URL, as the consumers save them
+        legacy.append(ChatFile.objects.create(file='http://testserver/chat_files/chat_files/BigTable.pdf',
+                                              filename='BigTable.pdf', file_type='.pdf', uploader=self.alice,
+                                              thread=self.thread, thread_name=self.thread_name))
+
+        out = io.StringIO()
+        call_command('dedupe_media', stdout=out)
+
+        self.assertIn('4 rows moved to 1 blobs, 2 duplicate files', out.getvalue())
+        blob = Blob.objects.get()
+        self.assertEqual(blob.refcount, 4)
+        self.assertEqual(self.media_files(), [blob.name])
+        self.assertEqual(set(ChatFile.objects.values_list('file', flat=True)), {blob.name})
+
+    def test_consumer_file_rows_share_the_uploaded_blob(self):
+        uploaded = self.upload('photo.jpg', b'jpeg bytes')
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': self.alice}
+        consumer.thread_id = self.thread.id
+        file_id = db_method(PersonalChatConsumer, 'save_file')(
+            consumer, 'alice', self.thread_name, {'file_url': f'http://testserver{uploaded.file.url}', 'filename': 'photo.jpg'}
+        )
+        chat_file = ChatFile.objects.get(id=file_id)
+        self.assertEqual(chat_file.file.name, uploaded.file.name)
+        self.assertEqual((chat_file.size, chat_file.content_type), (10, 'image/jpeg'))
+        self.assertEqual(Blob.objects.get().refcount, 2)
+
+    def test_a_blob_url_only_grants_access_to_who_could_see_it(self):
+        uploaded = self.upload('photo.jpg', b'jpeg bytes')
+        carol = User.objects.create_user('carol', password='password')
+        consumer = PersonalChatConsumer()
+        consumer.scope = {'user': carol}
+        consumer.thread_id = Thread.between(carol.id, self.bob.id).id
+        file_id = db_method(PersonalChatConsumer, 'save_file')(
+            consumer, 'carol', get_thread_name(carol.id, self.bob.id), {'file_url': uploaded.file.url}
+        )
+        self.assertEqual(ChatFile.objects.get(id=file_id).file.name, '')
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        self.client.force_login(carol)
+        self.assertEqual(self.client.get(uploaded.file.url).status_code, 404)
+
+
+@override_settings(CHAT_THUMBNAIL_WORKERS=0)
+class ThumbnailTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+    def setUp(self):
+        self.settings_override = override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.client.force_login(self.alice)
+
+    def image_upload(self, filename='Untitled_design.jpg', size=(1600, 800)):
+        from PIL import Image
+
+        data = io.BytesIO()
+        Image.new('RGB', size, 'teal').save(data, 'JPEG')
+        return SimpleUploadedFile(filename, data.getvalue(), content_type='image/jpeg')
+
+    def thumbnail_size(self, name, size):
+        from PIL import Image
+
+        with Image.open(default_storage.path(thumbnails.thumbnail_name(name, size))) as image:
+            return image.format, image.size
+
+    def test_upload_renders_thumbnails_served_by_file_details(self):
+        response = self.client.post(reverse('upload_file'), {'file': self.image_upload(), 'thread_name': self.thread_name})
+        chat_file = ChatFile.objects.get(id=response.json()['file_id'])
+
+        self.assertEqual(self.thumbnail_size(chat_file.file.name, 240), ('WEBP', (240, 120)))
+        self.assertEqual(self.thumbnail_size(chat_file.file.name, 720), ('WEBP', (720, 360)))
+
+        details = self.client.get(reverse('get_file_details', kwargs={'file_id': chat_file.id})).json()
+        self.assertEqual(set(details['thumbnails']), {'small', 'large'})
+        self.assertTrue(details['thumbnails']['small'].endswith(thumbnails.thumbnail_name(chat_file.file.name, 240)))
+        self.assertNotEqual(details['thumbnails']['small'], details['file_url'])
+
+    def test_rendered_thumbnails_are_listed_without_looking_at_the_disk(self):
+        response = self.client.post(reverse('upload_file'), {'file': self.image_upload(), 'thread_name': self.thread_name})
+        chat_file = ChatFile.objects.get(id=response.json()['file_id'])
+        self.assertTrue(Blob.objects.get(name=chat_file.file.name).thumbnails_ready)
+
+        with patch('chats.thumbnails.os.path.exists', side_effect=AssertionError('stat')):
+            files = self.client.get(reverse('get_files_details'), {'ids': chat_file.id}).json()['files']
+        self.assertEqual(set(files[str(chat_file.id)]['thumbnails']), {'small', 'large'})
+
+    def test_non_images_have_no_thumbnails(self):
+        pdf = SimpleUploadedFile('BigTable.pdf', b'%PDF-1.4 table', content_type='application/pdf')
+        response = self.client.post(reverse('upload_file'), {'file': pdf, 'thread_name': self.thread_name})
+
+        details = self.client.get(reverse('get_file_details', kwargs={'file_id': response.json()['file_id']}))
+        self.assertEqual(details.json()['thumbnails'], {})
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, thumbnails.THUMBNAIL_DIR)))
+
+    @override_settings(CHAT_THUMBNAIL_WORKERS=1)
+    def test_thumbnails_render_in_a_worker_process(self):
+        chat_file = ChatFile.objects.create(file=self.image_upload('photo.png', (300, 900)), filename='photo.png',
+                                            file_type='.png', uploader=self.alice,
+                                            thread=self.thread, thread_name=self.thread_name)
+        self.addCleanup(self.shutdown_executor)
+
+        future = thumbnails.generate_thumbnails(chat_file.file.name)
+        self.assertIs(thumbnails.generate_thumbnails(chat_file.file.name), future)
+        written = future.result(timeout=60)
+
+        self.assertEqual(len(written), 2)
+        self.assertEqual(self.thumbnail_size(chat_file.file.name, 240), ('WEBP', (80, 240)))
+        # Cached: nothing left to render
+        self.assertIsNone(thumbnails.generate_thumbnails(chat_file.file.name))
+
+    def shutdown_executor(self):
+        thumbnails._executor.shutdown()
+        thumbnails._executor = None
+
+
+@override_settings(CHAT_THUMBNAIL_WORKERS=0)
+class MediaViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+
+    def setUp(self):
+        self.settings_override = override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        # Granted accesses are cached by user id, which the rolled back tests reuse
+        cache.clear()
+        self.data = bytes(range(256)) * 40
+        self.chat_file = ChatFile.objects.create(file=SimpleUploadedFile('clip.mp4', self.data), filename='clip.mp4',
+                                                 file_type='.mp4', uploader=self.alice,
+                                                 thread=self.thread, thread_name=self.thread_name)
+        self.url = self.chat_file.file.url
+        self.client.force_login(self.bob)
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_only_thread_and_group_members_get_the_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+        self.assertEqual(response['ETag'], f'"{hashlib.sha256(self.data).hexdigest()}"')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="clip.mp4"')
+
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        group = Group.objects.create(name='friends', created_by=self.alice)
+        group.members.add(self.carol)
+        GroupFile.objects.create(file=self.chat_file.file.name, filename='clip.mp4', file_type='.mp4',
+                                 uploader=self.alice, group=group)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        self.assertEqual(self.client.get('/chat_files/../db.sqlite3').status_code, 404)
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=1000-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 1000-1999/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(self.body(response), self.data[1000:2000])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(self.body(response), self.data[-10:])
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10000-')
+        self.assertEqual(self.body(response), self.data[10000:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+        # Ranges of another version of the file are ignored
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.body(response)), len(self.data))
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_thumbnails_follow_their_blob(self):
+        from PIL import Image
+
+        image = io.BytesIO()
+        Image.new('RGB', (500, 500), 'teal').save(image, 'PNG')
+        photo = ChatFile.objects.create(file=SimpleUploadedFile('photo.png', image.getvalue()), filename='photo.png',
+                                        file_type='.png', uploader=self.alice,
+                                        thread=self.thread, thread_name=self.thread_name)
+        thumbnails.generate_thumbnails(photo.file.name)
+        url = default_storage.url(thumbnails.thumbnail_name(photo.file.name, 240))
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_proxy_sends_the_bytes(self):
+        with override_settings(CHAT_MEDIA_ACCEL='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected_chat_files/{self.chat_file.file.name}')
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+
+        with override_settings(CHAT_MEDIA_ACCEL='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.chat_file.file.path)
+
+
+class AssetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+
+    def read_static(self, name):
+        with open(os.path.join(settings.BASE_DIR, 'static', name), 'rb') as f:
+            return f.read()
+
+    def test_pages_link_fingerprinted_assets(self):
+        self.client.force_login(self.alice)
+        page = self.client.get(reverse('chat', kwargs={'username': 'bob'})).content.decode()
+        url = re.search(r'src="(/assets/js/chat\.[0-9a-f]{12}\.js)"', page).group(1)
+
+        response = self.client.get(url)
+        self.assertEqual(response.content, self.read_static('js/chat.js'))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['ETag'], f'"{hashlib.sha256(response.content).hexdigest()}"')
+
+        gzipped = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.content), response.content)
+        self.assertNotEqual(gzipped['ETag'], response['ETag'])
+        self.assertEqual(gzipped['Vary'], 'Accept-Encoding')
+
+        # Unfingerprinted names are still served, but revalidated
+        self.assertEqual(self.client.get('/assets/js/chat.js')['Cache-Control'], 'no-cache')
+        self.assertEqual(self.client.get('/assets/js/missing.js').status_code, 404)
+
+    def test_service_worker_from_memory_with_etag(self):
+        response = self.client.get(reverse('sw_file'))
+        self.assertEqual(response.content, self.read_static('js/sw.js'))
+        self.assertEqual(response['Service-Worker-Allowed'], '/')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+        with patch('builtins.open', side_effect=AssertionError('read from disk')):
+            revalidated = self.client.get(reverse('sw_file'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    @override_settings(DEBUG=True)
+    def test_edited_files_are_picked_up_in_debug(self):
+        static_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(static_dir, 'js'))
+        path = os.path.join(static_dir, 'js', 'app.js')
+        with open(path, 'w') as f:
+            f.write('let version = 1;')
+        with override_settings(STATICFILES_DIRS=[static_dir]):
+            first = assets.asset_url('js/app.js')
+            with open(path, 'w') as f:
+                f.write('let version = 2;')
+            os.utime(path, ns=(time.time_ns() + 10 ** 9,) * 2)
+            with patch.object(assets, 'DEBUG_REFRESH_INTERVAL', 0):
+                second = assets.asset_url('js/app.js')
+            self.assertNotEqual(first, second)
+            self.assertEqual(self.client.get(second).content, b'let version = 2;')
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.thread_name = cls.thread.name
+        cls.group = Group.objects.create(name='friends', created_by=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob)
+        cls.other_group = Group.objects.create(name='others', created_by=cls.carol)
+        cls.other_group.members.add(cls.carol)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def search(self, query, **params):
+        response = self.client.get(reverse('search_messages'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_migrations_leave_every_search_trigger_installed(self):
+        # Later migrations rebuild the indexed tables, which drops their triggers
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tbl_name, name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%search%'")
+            triggers = sorted(cursor.fetchall())
+        self.assertEqual(triggers, [
+            ('chats_chatmodel', f'chatmodel_search_{event}') for event in ('delete', 'insert', 'update')
+        ] + [
+            ('groups_groupmessage', f'groupmessage_search_{event}') for event in ('delete', 'insert', 'update')
+        ])
+
+    def test_only_the_callers_conversations_are_searched(self):
+        mine = ChatModel.objects.create(sender=self.bob, message='the budget for <b>Q3</b>', thread=self.thread,
+                                        thread_name=self.thread_name)
+        bob_and_carol = Thread.between(self.bob.id, self.carol.id)
+        ChatModel.objects.create(sender=self.bob, message='secret budget', thread=bob_and_carol,
+                                 thread_name=bob_and_carol.name)
+        group_message = GroupMessage.objects.create(group=self.group, sender=self.bob, content='Budget meeting at noon')
+        GroupMessage.objects.create(group=self.other_group, sender=self.carol, content='our budget')
+
+        with self.assertNumQueries(6):
+            results = self.search('budg')['results']
+
+        found = {(result['kind'], result['message_id']) for result in results}
+        self.assertEqual(found, {('personal', mine.id), ('group', group_message.id)})
+        personal = next(result for result in results if result['kind'] == 'personal')
+        self.assertEqual(personal['snippet'], 'the <mark>budget</mark> for &lt;b&gt;Q3&lt;/b&gt;')
+        self.assertEqual(personal['thread_name'], self.thread_name)
+
+    def test_edits_and_deletes_are_indexed(self):
+        message = ChatModel.objects.create(sender=self.bob, message='lunch on friday',
+                                           thread=self.thread, thread_name=self.thread_name)
+        self.assertEqual(len(self.search('friday')['results']), 1)
+
+        ChatModel.objects.filter(id=message.id).update(message='lunch on monday')
+        self.assertEqual(self.search('friday')['results'], [])
+        self.assertEqual(len(self.search('monday')['results']), 1)
+
+        message.delete()
+        self.assertEqual(self.search('monday')['results'], [])
+
+    def test_keyset_pagination_over_ranked_results(self):
+        for i in range(7):
+            ChatModel.objects.create(sender=self.bob, message='report ' + 'filler ' * i,
+                                     thread=self.thread, thread_name=self.thread_name)
+
+        seen, cursor = [], {}
+        while True:
+            page = self.search('report', limit=3, **cursor)
+            seen.extend(result['message_id'] for result in page['results'])
+            if not page['has_more']:
+                break
+            cursor = page['next_cursor']
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+        # The shortest message is the best match
+        self.assertEqual(seen[0], ChatModel.objects.get(message='report ').id)
+
+    def test_rebuild_command(self):
+        ChatModel.objects.create(sender=self.bob, message='quarterly numbers',
+                                 thread=self.thread, thread_name=self.thread_name)
+        GroupMessage.objects.create(group=self.group, sender=self.bob, content='quarterly plan')
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.SEARCH_TABLE}')
+        self.assertEqual(self.search('quarterly')['results'], [])
+
+        out = io.StringIO()
+        call_command('rebuild_message_search', '--batch-size', '1', stdout=out)
+        self.assertIn('rebuilt with 2 messages', out.getvalue())
+        self.assertEqual(len(self.search('quarterly')['results']), 2)
+
+    def test_query_syntax_is_not_fts(self):
+        ChatModel.objects.create(sender=self.bob, message='a "quoted" word',
+                                 thread=self.thread, thread_name=self.thread_name)
+        self.assertEqual(len(self.search('"quoted')['results']), 1)
+        self.assertEqual(self.search('***')['results'], [])
+
+
+@override_settings(CHAT_ARCHIVE_DIR=tempfile.mkdtemp())
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.thread = Thread.between(cls.alice.id, cls.bob.id)
+        cls.group = Group.objects.create(name='friends', created_by=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def tearDown(self):
+        for name in os.listdir(settings.CHAT_ARCHIVE_DIR):
+            os.remove(os.path.join(settings.CHAT_ARCHIVE_DIR, name))
+
+    def age(self, messages, days):
+        start = timezone.now() - timedelta(days=days)
+        for i, message in enumerate(messages):
+            message.timestamp = start + timedelta(seconds=i)
+        type(messages[0]).objects.bulk_update(messages, ['timestamp'])
+
+    def archive(self):
+        out = io.StringIO()
+        call_command('archive_messages', '--days', '30', '--batch-size', '7', '--sleep', '0', stdout=out)
+        return out.getvalue()
+
+    def test_old_messages_move_to_segments_and_history_reads_through(self):
+        messages = ChatModel.objects.bulk_create(
+            ChatModel(sender=self.bob, message=f'message {i}', thread=self.thread, thread_name=self.thread.name, seq=i)
+            for i in range(30)
+        )
+        ChatNotification.objects.bulk_create(ChatNotification(chat=chat, user=self.alice) for chat in messages)
+        self.age(messages[:20], 90)
+        self.age(messages[20:], 1)
+
+        self.assertIn('20 messages sent before', self.archive())
+        self.assertEqual(ChatModel.objects.count(), 10)
+        self.assertEqual(ChatNotification.objects.count(), 10)
+        segments = list(ArchiveSegment.objects.order_by('id'))
+        self.assertEqual([segment.message_count for segment in segments], [7, 7, 6])
+        # Appended one after the other to the thread's file
+        self.assertEqual([segment.offset for segment in segments[1:]],
+                         [segment.offset + segment.length for segment in segments[:-1]])
+        self.assertIn('0 messages', self.archive())
+
+        url = reverse('chat_messages', kwargs={'username': 'bob'})
+        seen, params = [], {'limit': 8}
+        while True:
+            data = self.client.get(url, params).json()
+            seen = data['messages'] + seen
+            if not data['has_more']:
+                break
+            params = {'limit': 8, **data['next_cursor']}
+        self.assertEqual([m['id'] for m in seen], [m.id for m in messages])
+        self.assertEqual(seen[0], {'id': messages[0].id, 'sender': 'bob', 'message': 'message 0', 'seq': 0,
+                                   'timestamp': seen[0]['timestamp'], 'is_current_user': False})
+
+        with self.settings(CHAT_HISTORY_PAGE_SIZE=50):
+            response = self.client.get(reverse('chat', kwargs={'username': 'bob'}))
+        self.assertTrue(response.context['has_older_messages'])
+
+    def test_a_full_last_hot_page_leads_to_the_archive(self):
+        chats = ChatModel.objects.bulk_create(
+            ChatModel(sender=self.bob, message=f'message {i}', thread=self.thread, thread_name=self.thread.name, seq=i)
+            for i in range(6)
+        )
+        group_messages = GroupMessage.objects.bulk_create(
+            GroupMessage(group=self.group, sender=self.bob, content=f'message {i}') for i in range(6)
+        )
+        self.age(chats[:2], 90)
+        self.age(group_messages[:2], 90)
+        self.archive()
+
+        url = reverse('chat_messages', kwargs={'username': 'bob'})
+        newest = self.client.get(url, {'limit': 4}).json()
+        self.assertTrue(newest['has_more'])
+        older = self.client.get(url, {'limit': 4, **newest['next_cursor']}).json()
+        self.assertEqual([m['id'] for m in older['messages']], [m.id for m in chats[:2]])
+
+        url = reverse('get_group_messages', kwargs={'group_id': self.group.id})
+        newest = self.client.get(url, {'limit': 4}).json()
+        self.assertTrue(newest['has_more'])
+        older = self.client.get(url, {'limit': 4, 'before': newest['messages'][0]['id']}).json()
+        self.assertEqual([m['id'] for m in older['messages']], [m.id for m in group_messages[:2]])
+
+    def test_group_history_reads_through_in_both_directions(self):
+        messages = GroupMessage.objects.bulk_create(
+            GroupMessage(group=self.group, sender=self.bob, content=f'message {i}') for i in range(12)
+        )
+        self.age(messages[:8], 90)
+        self.age(messages[8:], 1)
+        self.archive()
+        self.assertEqual(GroupMessage.objects.count(), 4)
+
+        url = reverse('get_group_messages', kwargs={'group_id': self.group.id})
+        newest = self.client.get(url, {'limit': 6}).json()
+        self.assertEqual([m['id'] for m in newest['messages']], [m.id for m in messages[6:]])
+        self.assertTrue(newest['has_more'])
+        self.assertEqual(newest['messages'][0]['sender'], {'id': self.bob.id, 'username': 'bob'})
+
+        older = self.client.get(url, {'limit': 6, 'before': newest['messages'][0]['id']}).json()
+        self.assertEqual([m['id'] for m in older['messages']], [m.id for m in messages[:6]])
+        self.assertFalse(older['has_more'])
+
+        delta = self.client.get(url, {'limit': 5, 'after': messages[4].id}).json()
+        self.assertEqual([m['id'] for m in delta['messages']], [m.id for m in messages[5:10]])
+        self.assertTrue(delta['has_more'])
@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from chats.storage import BLOB_DIR
+
+# Directory of the thumbnails inside the media root, laid out like the blobs
+THUMBNAIL_DIR = 'thumbnails'
+# What Pillow can decode.  PDFs would need a renderer such as poppler, they keep their icon.
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+
+_executor = None
+# Blob name -> future of the thumbnails being rendered, so a blob is only queued once
+_pending = {}
+# Blobs Pillow failed on, not retried until the process restarts
+_failed = set()
+
+
+def thumbnail_sizes():
+    """Label -> longest side in pixels of the thumbnails made for every image"""
+    return getattr(settings, 'CHAT_THUMBNAIL_SIZES', {'small': 240, 'large': 720})
+
+
+def thumbnail_name(blob, size):
+    """``blobs/ab/cd/<sha256>.jpg`` -> ``thumbnails/ab/cd/<sha256>_240.webp``"""
+    stem = os.path.splitext(blob[len(BLOB_DIR) + 1:])[0]
+    return f'{THUMBNAIL_DIR}/{stem}_{size}.webp'
+
+
+def has_thumbnails(name):
+    """Only blobs get thumbnails, since they are cached under the blob's hash"""
+    return name.startswith(f'{BLOB_DIR}/') and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def render_thumbnails(source, targets):
+    """
+    Write a WebP thumbnail of the image at ``source`` for every ``(size, path)``
+    of ``targets``.  Runs in a worker process.
+
+    The image is decoded once, JPEGs straight at the smallest scale still
+    covering the largest size, and shrunk from the largest size down.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        largest = max(size for size, _ in targets)
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+        for size, path in sorted(targets, reverse=True):
+            image.thumbnail((size, size))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+            os.close(fd)
+            try:
+                image.save(temp_path, 'WEBP', quality=80)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+    return [path for _, path in targets]
+
+
+def mark_ready(name):
+    # Imported here, the worker processes load this module without Django set up
+    from chats.models import Blob
+
+    Blob.objects.filter(name=name).update(thumbnails_ready=True)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: forking a server with running threads can deadlock the child.
+        # Workers are recycled so memory Pillow keeps after big images is given back.
+        _executor = ProcessPoolExecutor(max_workers=getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2),
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        max_tasks_per_child=100)
+    return _executor
+
+
+def generate_thumbnails(name):
+    """
+    Queue the thumbnails of blob ``name`` that are not on disk yet.  Returns
+    the future of the job, None when there is nothing to do.  With
+    CHAT_THUMBNAIL_WORKERS = 0 they are rendered right away instead.
+    Blobs found with every thumbnail rendered are marked ready.
+    """
+    if not has_thumbnails(name) or name in _failed:
+        return None
+    if name in _pending:
+        return _pending[name]
+
+    targets = []
+    for size in thumbnail_sizes().values():
+        path = default_storage.path(thumbnail_name(name, size))
+        if not os.path.exists(path):
+            targets.append((size, path))
+    if not targets:
+        mark_ready(name)
+        return None
+
+    source = default_storage.path(name)
+    if getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2) == 0:
+        try:
+            render_thumbnails(source, targets)
+        except Exception as e:
+            _failed.add(name)
+            print(f"Error generating thumbnails: {str(e)}")
+        else:
+            mark_ready(name)
+        return None
+
+    future = _get_executor().submit(render_thumbnails, source, targets)
+    _pending[name] = future
+    future.add_done_callback(lambda done: _thumbnails_done(name, done))
+    return future
+
+
+def _thumbnails_done(name, future):
+    _pending.pop(name, None)
+    if not future.cancelled() and future.exception() is not None:
+        _failed.add(name)
+        print(f"Error generating thumbnails: {str(future.exception())}")
+
+
+def thumbnail_urls(name, ready):
+    """
+    Label -> URL of the thumbnails of ``name``, ``ready`` being its blob's
+    ``thumbnails_ready``.  Ready blobs cost no look at the disk.  The others
+    have their missing thumbnails queued and get them on a later request.
+    """
+    if not has_thumbnails(name):
+        return {}
+    # Nothing was queued and nothing failed: they were all on disk already
+    if not ready and (generate_thumbnails(name) is not None or name in _failed):
+        return {}
+    return {label: default_storage.url(thumbnail_name(name, size)) for label, size in thumbnail_sizes().items()}
+
+
+def delete_thumbnails(name):
+    for size in thumbnail_sizes().values():
+        try:
+            os.remove(default_storage.path(thumbnail_name(name, size)))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from chats.fanout import run_in_background, send_to_groups
+from chats.protocol import prepare_frames
+
+
+class TypingAggregator:
+    """
+    Who is typing in each room (a personal thread or group channel group).
+
+    Clients report typing on every keystroke; the aggregator drops reports
+    arriving within CHAT_TYPING_MIN_INTERVAL seconds of the sender's last
+    accepted one, forgets a typist CHAT_TYPING_TTL seconds after their last
+    report, and only marks a room as changed when its set of typists does.
+    ``pop_changes`` hands out the new set of every changed room, which is
+    sent as one frame per room and tick.  Like the presence registry it is
+    only used from the event loop thread and needs no lock.
+    """
+
+    def __init__(self):
+        # room -> {username: time the typing state expires}
+        self._rooms = {}
+        # (room, username) -> time of the last accepted report
+        self._last_report = {}
+        self._changed = set()
+
+    def report(self, room, username, is_typing, now=None):
+        """Record a typing report, return False when it was rate-limited"""
+        now = time.monotonic() if now is None else now
+        typists = self._rooms.setdefault(room, {})
+        if not is_typing:
+            self._last_report.pop((room, username), None)
+            if typists.pop(username, None) is not None:
+                self._changed.add(room)
+            return True
+
+        last_report = self._last_report.get((room, username))
+        if last_report is not None and now - last_report < getattr(settings, 'CHAT_TYPING_MIN_INTERVAL', 1):
+            return False
+        self._last_report[(room, username)] = now
+        if username not in typists:
+            self._changed.add(room)
+        typists[username] = now + getattr(settings, 'CHAT_TYPING_TTL', 5)
+        return True
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        for room, typists in list(self._rooms.items()):
+            for username, expires_at in list(typists.items()):
+                if expires_at <= now:
+                    del typists[username]
+                    self._last_report.pop((room, username), None)
+                    self._changed.add(room)
+            if not typists:
+                del self._rooms[room]
+
+    def typists(self, room):
+        return sorted(self._rooms.get(room, ()))
+
+    def pop_changes(self):
+        """Return ``{room: [usernames typing]}`` for the rooms changed since the last call"""
+        changed, self._changed = self._changed, set()
+        return {room: self.typists(room) for room in changed}
+
+
+aggregator = TypingAggregator()
+_runner = None
+
+
+async def publish(channel_layer, now=None):
+    """Expire stale typists and send each changed room its typists in one frame"""
+    aggregator.expire(now)
+    await send_to_groups(channel_layer, [
+        (room, {'type': 'typing_status', 'frames': prepare_frames({'type': 'typing', 'usernames': usernames})})
+        for room, usernames in aggregator.pop_changes().items()
+    ])
+
+
+def user_typing(channel_layer, room, user, is_typing):
+    if user.is_authenticated:
+        _ensure_runner(channel_layer)
+        aggregator.report(room, user.username, is_typing)
+
+
+async def _run_forever(channel_layer):
+    while True:
+        await asyncio.sleep(getattr(settings, 'CHAT_TYPING_BATCH_INTERVAL', 0.5))
+        await publish(channel_layer)
+
+
+def _ensure_runner(channel_layer):
+    global _runner
+    if _runner is None or _runner.done() or _runner.get_loop() is not asyncio.get_running_loop():
+        _runner = run_in_background(_run_forever(channel_layer))
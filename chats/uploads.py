@@ -0,0 +1,169 @@
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from chats.models import ChatFile, ChunkedUpload
+from chats.storage import file_sha256, guess_content_type
+from chats.thumbnails import generate_thumbnails
+from groups.models import GroupFile
+
+# Bytes copied from the request to the disk, or hashed, at once
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """A chunked upload request that cannot be applied, with the HTTP status to answer"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def temp_dir():
+    return getattr(settings, 'CHAT_UPLOAD_TEMP_DIR', os.path.join(settings.BASE_DIR, 'partial_uploads'))
+
+
+def partial_path(upload):
+    return os.path.join(temp_dir(), f'{upload.id}.part')
+
+
+def expiry_cutoff():
+    """Uploads without a chunk since this moment are abandoned"""
+    return timezone.now() - timedelta(hours=getattr(settings, 'CHAT_UPLOAD_EXPIRE_AFTER_HOURS', 24))
+
+
+def start_upload(uploader, filename, size, checksum='', thread=None, group=None):
+    """
+    Create the upload and its empty partial file.  A user has at most
+    CHAT_UPLOAD_MAX_OPEN uploads in progress, not counting abandoned ones,
+    which are dropped here.
+    """
+    for upload in ChunkedUpload.objects.filter(uploader=uploader, updated_at__lt=expiry_cutoff()):
+        discard_upload(upload)
+    if ChunkedUpload.objects.filter(uploader=uploader).count() >= getattr(settings, 'CHAT_UPLOAD_MAX_OPEN', 5):
+        raise UploadError('Too many uploads in progress, finish or wait for one first', status=429)
+
+    upload = ChunkedUpload.objects.create(uploader=uploader, filename=filename, size=size, checksum=checksum.lower(),
+                                          thread=thread, thread_name=thread.name if thread else None, group=group)
+    path = partial_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+def append_chunk(upload, stream, offset, length):
+    """
+    Copy ``length`` bytes of ``stream`` to the partial file at ``offset``,
+    one block at a time so memory stays flat whatever the chunk size.
+
+    The chunk must start where the previous one ended.  The bytes written
+    before a dropped connection are kept, the client resumes after them.
+    Returns the new offset.
+    """
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}', status=409)
+    if offset + length > upload.size:
+        raise UploadError('Chunk goes past the end of the file')
+
+    written = 0
+    try:
+        with open(partial_path(upload), 'r+b') as partial:
+            # Drop whatever an interrupted chunk left after the last recorded byte
+            partial.seek(offset)
+            partial.truncate()
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                partial.write(block)
+                written += len(block)
+    finally:
+        if written:
+            # Guarded by the old offset, so of two concurrent chunks only one is recorded
+            ChunkedUpload.objects.filter(pk=upload.pk, received=offset).update(received=offset + written,
+                                                                               updated_at=timezone.now())
+            upload.received = offset + written
+    return upload.received
+
+
+def complete_upload(upload):
+    """
+    Check the size and checksum of a fully received upload and turn it into
+    a ChatFile or GroupFile.  The partial file is moved into the
+    content-addressed media storage, not copied, and dropped if that content
+    is already stored.  A checksum mismatch discards the upload.
+    """
+    if upload.received != upload.size:
+        raise UploadError(f'Only {upload.received} of {upload.size} bytes received', status=409)
+
+    path = partial_path(upload)
+    # Needed by the storage anyway, so checking the client's checksum is free
+    sha256 = file_sha256(path, BLOCK_SIZE)
+    if upload.checksum and sha256 != upload.checksum:
+        discard_upload(upload)
+        raise UploadError('Checksum mismatch, upload the file again')
+
+    model = GroupFile if upload.group_id else ChatFile
+    # The blob's reference is counted with the row holding it
+    with transaction.atomic():
+        name = model._meta.get_field('file').storage.save_local_file(path, upload.filename, sha256)
+        fields = {
+            'file': name,
+            'filename': upload.filename,
+            'file_type': os.path.splitext(upload.filename)[1],
+            'uploader_id': upload.uploader_id,
+        }
+        if upload.group_id:
+            file_obj = GroupFile.objects.create(group_id=upload.group_id, **fields)
+        else:
+            file_obj = ChatFile.objects.create(thread_id=upload.thread_id, thread_name=upload.thread_name, size=upload.size,
+                                               content_type=guess_content_type(upload.filename), **fields)
+        upload.delete()
+    generate_thumbnails(name)
+    return file_obj
+
+
+def discard_upload(upload):
+    try:
+        os.remove(partial_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+
+def expire_uploads(cutoff, batch_size=500, sleep=0):
+    """
+    Drop the uploads without a chunk since ``cutoff`` with their partial
+    files, ``batch_size`` at a time.  Partial files older than ``cutoff``
+    left without a row, by a crash between the two, go as well.  Returns
+    the number of uploads dropped.
+    """
+    total = 0
+    while True:
+        expired = list(ChunkedUpload.objects.filter(updated_at__lt=cutoff).order_by('updated_at')[:batch_size])
+        for upload in expired:
+            discard_upload(upload)
+        total += len(expired)
+        if len(expired) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+
+    try:
+        names = os.listdir(temp_dir())
+    except FileNotFoundError:
+        return total
+    partial_ids = {name[:-len('.part')] for name in names if name.endswith('.part')}
+    known = {str(upload_id) for upload_id in ChunkedUpload.objects.values_list('id', flat=True)}
+    for upload_id in partial_ids - known:
+        path = os.path.join(temp_dir(), f'{upload_id}.part')
+        try:
+            if os.path.getmtime(path) < cutoff.timestamp():
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+    return total
@@ -4,5 +4,10 @@ from . import views
 urlpatterns = [
     path('sw.js', views.sw_file, name='sw_file'),
     path('upload-file/', views.upload_file, name='upload_file'),
-    path('get-file-details/<int:file_id>/', views.get_file_details, name='get_file_details')
+    path('uploads/', views.start_chunked_upload, name='start_chunked_upload'),
+    path('uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.complete_chunked_upload, name='complete_chunked_upload'),
+    path('get-file-details/<int:file_id>/', views.get_file_details, name='get_file_details'),
+    path('get-files-details/', views.get_files_details, name='get_files_details'),
+    path('search/', views.search_messages, name='search_messages')
 ]
\ No newline at end of file
@@ -2,17 +2,25 @@ from django.shortcuts import render
 from django.contrib.auth import get_user_model
 from django.views.decorators.csrf import csrf_exempt
 
-from chats.models import ChatModel, ChatFile
+from chats.models import (Blob, ChatModel, ChatFile, ChunkedUpload, ConversationSummary, Thread, get_message_preview,
+                          get_thread_name)
+from chats import archive, assets, media, presence, search, uploads
+from chats.protocol import prepare_frames
+from chats.pagination import get_page_size, keyset_before, newest_page, parse_float, parse_int, parse_timestamp
+from chats.thumbnails import generate_thumbnails, thumbnail_urls
+from chats.storage import guess_content_type
 from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_http_methods, require_POST
 from django.contrib.auth.decorators import login_required
 from chats.models import ChatNotification
-import json
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.http import HttpResponse
+import json
 import os
-from groups.models import Group
+from django.conf import settings
+from django.db.models import Exists, F, OuterRef, Q
+from groups.models import Group, GroupNotification
 # Create your views here.
 
 User = get_user_model()
@@ -24,41 +32,174 @@ def index(request):
 
 
 def chatPage(request, username):
-    user_obj = User.objects.get(username=username)
-    users = User.objects.exclude(username=request.user.username)
+    user_obj = User.objects.select_related('userprofilemodel').get(username=username)
+    users = list(User.objects.exclude(username=request.user.username))
+    groups = list(Group.objects.filter(members=request.user))
 
-    # Get latest messages for ALL users at once
-    latest_messages = {}
-    for user in users:
-        uid1, uid2 = sorted([request.user.id, user.id])
-        if request.user.id > user_obj.id:
-            thread_name = f'chat_{request.user.id}-{user_obj.id}'
+    # The whole sidebar comes from one indexed query over the summaries,
+    # most recently active conversations first
+    summaries = ConversationSummary.objects.filter(user=request.user).order_by(
+        F('last_message_at').desc(nulls_last=True)
+    )
+    personal_summaries = {}
+    group_summaries = {}
+    for summary in summaries:
+        if summary.group_id:
+            group_summaries[summary.group_id] = summary
         else:
-            thread_name = f'chat_{user_obj.id}-{request.user.id}'
-        last_message = ChatModel.objects.filter(thread_name=thread_name).order_by('-timestamp').first()
-        latest_messages[user.id] = last_message  # Store message object directly
+            personal_summaries[summary.other_user_id] = summary
 
-    # Attach last message to each user object
+    # Attach the summary to each contact and group, dicts keep the activity order
+    activity_order = {user_id: position for position, user_id in enumerate(personal_summaries)}
     for user in users:
-        user.last_message = latest_messages.get(user.id)
-    message_objs = ChatModel.objects.filter(thread_name=thread_name)
+        user.summary = personal_summaries.get(user.id)
+        user.is_online = presence.registry.is_online(user.id)
+    user_obj.is_online = presence.registry.is_online(user_obj.id)
+    users.sort(key=lambda user: activity_order.get(user.id, len(activity_order)))
+
+    activity_order = {group_id: position for position, group_id in enumerate(group_summaries)}
+    for group in groups:
+        group.summary = group_summaries.get(group.id)
+    groups.sort(key=lambda group: activity_order.get(group.id, len(activity_order)))
+
+    # Only the newest page is rendered, older pages are fetched by "load older"
+    thread_name = get_thread_name(request.user.id, user_obj.id)
+    page_size = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    message_objs, has_older_messages = newest_page(
+        ChatModel.objects.filter(thread__name=thread_name).select_related('sender'), page_size
+    )
+    if not has_older_messages:
+        # "load older" reads the archived messages through get_thread_messages
+        has_older_messages = archive.has_archived(thread_name)
     return render(request, 'main_chat.html', {
         'user': user_obj,
         'users': users,
         # Remove 'latest_messages' from context - no longer needed
         'messages': message_objs,
-        'groups': Group.objects.filter(members=request.user),
+        'oldest_message': message_objs[0] if message_objs else None,
+        'has_older_messages': has_older_messages,
+        'last_seq': message_objs[-1].seq if message_objs else 0,
+        'groups': groups,
         'thread_name': thread_name
     })
 
 
+def serialize_chat_message(message, current_user):
+    return {
+        'id': message.id,
+        'sender': message.sender_username,
+        'message': message.message,
+        'seq': message.seq,
+        'timestamp': message.timestamp.isoformat(),
+        'is_current_user': message.sender_username == current_user.username
+    }
+
+
+def serialize_archived_chat_message(record, current_user):
+    return {
+        'id': record['id'],
+        'sender': record['sender'],
+        'message': record['message'],
+        'seq': record['seq'],
+        'timestamp': record['timestamp'],
+        'is_current_user': record['sender'] == current_user.username
+    }
+
+
+@login_required
+def get_thread_messages(request, username):
+    """
+    Keyset-paginated history of the personal thread with ``username``.
+
+    ``?before=<iso timestamp>&before_id=<message id>`` returns the page just
+    older than that message, without either parameter the newest page is
+    returned.  Messages are always in chronological order, pages past the
+    oldest hot message are read from the archive.
+    """
+    try:
+        other_user = User.objects.get(username=username)
+    except User.DoesNotExist:
+        return JsonResponse({'error': 'User not found'}, status=404)
+
+    thread_name = get_thread_name(request.user.id, other_user.id)
+    before_id = parse_int(request.GET.get('before_id'))
+    before_timestamp = parse_timestamp(request.GET.get('before'))
+
+    # Joined on the unique name, a thread nobody wrote in yet has no row
+    queryset = ChatModel.objects.filter(thread__name=thread_name).select_related('sender')
+    if before_id is not None and before_timestamp is None:
+        # Resolve the timestamp of the cursor row so the keyset stays on the index
+        before_timestamp = queryset.filter(id=before_id).values_list('timestamp', flat=True).first()
+
+    limit = get_page_size(request)
+    messages, has_more = newest_page(keyset_before(queryset, before_timestamp, before_id), limit)
+    messages = [serialize_chat_message(message, request.user) for message in messages]
+    if not has_more and len(messages) < limit:
+        if messages:
+            before_timestamp, before_id = parse_timestamp(messages[0]['timestamp']), messages[0]['id']
+        archived, has_more = archive.archived_before(thread_name, limit - len(messages), before_timestamp, before_id)
+        messages = [serialize_archived_chat_message(record, request.user) for record in archived] + messages
+    elif not has_more:
+        # The page ends with the oldest hot message, the archived ones are all older
+        has_more = archive.has_archived(thread_name)
+
+    next_cursor = None
+    if has_more and messages:
+        next_cursor = {
+            'before': messages[0]['timestamp'],
+            'before_id': messages[0]['id']
+        }
+
+    return JsonResponse({
+        'thread_name': thread_name,
+        'messages': messages,
+        'has_more': has_more,
+        'next_cursor': next_cursor
+    })
+
+
+
+
+@login_required
+def search_messages(request):
+    """
+    Full-text search over the messages of the caller's threads and groups,
+    best matches first, see chats.search.
+
+    ``?q=`` is the query.  The next page is asked with the ``after_rank``
+    and ``after_id`` of ``next_cursor``.
+    """
+    if not search.is_available():
+        return JsonResponse({'error': 'Search is not available'}, status=501)
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'Missing query'}, status=400)
+
+    results, has_more = search.search_messages(
+        request.user, query, get_page_size(request),
+        after_rank=parse_float(request.GET.get('after_rank')),
+        after_id=parse_int(request.GET.get('after_id'))
+    )
+
+    next_cursor = None
+    if has_more and results:
+        next_cursor = {
+            'after_rank': results[-1]['rank'],
+            'after_id': results[-1]['search_id']
+        }
+
+    return JsonResponse({
+        'results': results,
+        'has_more': has_more,
+        'next_cursor': next_cursor
+    })
 
 
 def mark_notifications_seen(request):
     """Mark all notifications as seen for the current user"""
     user = request.user
-    notifications = ChatNotification.objects.filter(user=user, is_seen=False)
-    notifications.update(is_seen=True)
+    GroupNotification.objects.filter(user=user, is_seen=False).update(is_seen=True)
+    ConversationSummary.mark_read(user)
 
     # Notify the user's WebSocket connection that notifications have been seen
     channel_layer = get_channel_layer()
@@ -66,8 +207,7 @@ def mark_notifications_seen(request):
         f'{user.id}',
         {
             'type': 'send_notification',
-            'value': json.dumps({
-                'unseen_notifications': [],
+            'frames': prepare_frames({
                 'unseen_count': 0
             })
         }
@@ -75,19 +215,101 @@ def mark_notifications_seen(request):
 
     return JsonResponse({'success': True})
 
-def sw_file(request):
-    # Define the correct path to your service worker file
-    sw_file_path = 'static/js/sw.js'
-
-    # Check if the file exists
-    if os.path.exists(sw_file_path):
-        with open(sw_file_path, 'r') as sw_file:
-            content = sw_file.read()
-        response = HttpResponse(content, content_type="application/javascript")
-        response['Service-Worker-Allowed'] = '/'  # Allow the service worker to control the entire site
-        return response
+
+@login_required
+def get_notifications(request):
+    """
+    Unseen notifications of the current user, newest first.
+
+    ``?kind=chat`` (default) lists personal messages newer than the read
+    watermark of their thread and ``?kind=group`` group messages.  Pass the
+    ``next_before`` of a response as ``?before=`` to get the next page.
+    """
+    kind = request.GET.get('kind', 'chat')
+    before_id = parse_int(request.GET.get('before'))
+    limit = get_page_size(request)
+
+    if kind == 'group':
+        notifications = GroupNotification.objects.filter(
+            user=request.user, is_seen=False
+        ).select_related('message__sender', 'group')
+        cursor_field = 'id'
     else:
+        notifications = unread_chat_notifications(request.user)
+        cursor_field = 'chat_id'
+    if before_id is not None:
+        notifications = notifications.filter(**{f'{cursor_field}__lt': before_id})
+    notifications = list(notifications.order_by(f'-{cursor_field}')[:limit + 1])
+    has_more = len(notifications) > limit
+    notifications = notifications[:limit]
+
+    unseen_list = []
+    for notification in notifications:
+        if kind == 'group':
+            unseen_list.append({
+                'id': notification.id,
+                'kind': 'group',
+                'sender_username': notification.message.sender.username,
+                'group_id': notification.group.id,
+                'group_name': notification.group.name,
+                'timestamp': notification.message.timestamp.isoformat(),
+                'message_preview': get_message_preview(notification.message.content)
+            })
+        else:
+            unseen_list.append({
+                'id': notification.id,
+                'kind': 'chat',
+                'sender_username': notification.chat.sender_username,
+                'timestamp': notification.chat.timestamp.isoformat(),
+                'message_preview': get_message_preview(notification.chat.message)
+            })
+
+    return JsonResponse({
+        'notifications': unseen_list,
+        'has_more': has_more,
+        'next_before': getattr(notifications[-1], cursor_field) if has_more else None
+    })
+
+
+def unread_chat_notifications(user):
+    """
+    Personal message notifications of ``user`` above the read watermark of
+    their thread.  Only threads with unread messages are looked at and the
+    scan starts at the lowest of their watermarks.
+    """
+    watermarks = list(ConversationSummary.objects.filter(
+        user=user, thread_name__isnull=False, unread_count__gt=0
+    ).values_list('thread_name', 'last_read_message_id'))
+    if not watermarks:
+        return ChatNotification.objects.none()
+
+    above_watermark = Q()
+    for thread_name, last_read_message_id in watermarks:
+        above_watermark |= Q(thread__name=thread_name, chat_id__gt=last_read_message_id)
+    return ChatNotification.objects.filter(
+        above_watermark,
+        user=user,
+        chat_id__gt=min(last_read_message_id for _, last_read_message_id in watermarks)
+    ).select_related('chat__sender')
+
+
+def sw_file(request):
+    # Never fingerprinted, browsers look for service worker updates at a fixed URL
+    sw_asset = assets.get_bundle().get('js/sw.js')
+    if sw_asset is None:
         return HttpResponse('Service Worker file not found', status=404)
+    response = assets.asset_response(request, sw_asset, immutable=False)
+    response['Service-Worker-Allowed'] = '/'  # Allow the service worker to control the entire site
+    return response
+
+
+@require_http_methods(['GET', 'HEAD'])
+def serve_asset(request, name):
+    """Serve a static file from memory, see chats.assets"""
+    asset = assets.get_bundle().get(name)
+    if asset is None:
+        return HttpResponse('Asset not found', status=404)
+    return assets.asset_response(request, asset, immutable=name == asset.hashed_name)
 
 
 @login_required
@@ -95,7 +317,9 @@ def sw_file(request):
 def upload_file(request):
     if request.method == 'POST' and request.FILES.get('file'):
         uploaded_file = request.FILES['file']
-        thread_name = request.POST.get('thread_name')
+        thread = Thread.for_participant(request.user, request.POST.get('thread_name'))
+        if thread is None:
+            return JsonResponse({'status': 'error', 'message': 'Permission denied'}, status=403)
 
         # Create file record
         chat_file = ChatFile.objects.create(
@@ -103,8 +327,13 @@ def upload_file(request):
             filename=uploaded_file.name,
             file_type=os.path.splitext(uploaded_file.name)[1],
             uploader=request.user,
-            thread_name=thread_name
+            thread=thread,
+            thread_name=thread.name,
+            size=uploaded_file.size,
+            content_type=guess_content_type(uploaded_file.name)
         )
+        # Rendered in a worker process, the client polls get_file_details for them
+        generate_thumbnails(chat_file.file.name)
 
         # Return file info as JSON
         return JsonResponse({
@@ -118,39 +347,168 @@ def upload_file(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request'}, status=400)
 
 
+def serialize_chunked_upload(upload):
+    return {
+        'upload_id': str(upload.id),
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+    }
+
+
+@login_required
+@require_POST
+def start_chunked_upload(request):
+    """
+    Begin a chunked upload from JSON ``{"filename", "size", "checksum",
+    "thread_name" or "group_id"}``, ``checksum`` being the hex SHA-256 of
+    the file.  The chunks are then sent with PUT to ``upload_chunk`` and the
+    file is created by ``complete_chunked_upload``.
+    """
+    try:
+        data = json.loads(request.body)
+        filename = os.path.basename(str(data.get('filename') or ''))
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'filename and size are required'}, status=400)
+    if not filename or size < 0:
+        return JsonResponse({'error': 'filename and size are required'}, status=400)
+    if size > getattr(settings, 'CHAT_UPLOAD_MAX_SIZE', 4 * 1024 ** 3):
+        return JsonResponse({'error': 'File too large'}, status=413)
+
+    thread = group = None
+    if data.get('group_id') is not None:
+        group = Group.objects.filter(id=parse_int(data['group_id']), members=request.user).first()
+        if group is None:
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+    else:
+        thread = Thread.for_participant(request.user, data.get('thread_name'))
+        if thread is None:
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+
+    try:
+        upload = uploads.start_upload(request.user, filename, size, str(data.get('checksum') or ''),
+                                      thread=thread, group=group)
+    except uploads.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(serialize_chunked_upload(upload), status=201)
+
+
+@login_required
+@require_http_methods(['GET', 'PUT'])
+def upload_chunk(request, upload_id):
+    """
+    ``GET`` tells where to resume an upload, ``PUT ?offset=<n>`` appends the
+    raw request body at that offset, streamed to disk
+    """
+    upload = ChunkedUpload.objects.filter(id=upload_id, uploader=request.user).first()
+    if upload is None:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    if request.method == 'GET':
+        return JsonResponse(serialize_chunked_upload(upload))
+
+    offset = parse_int(request.GET.get('offset'))
+    length = parse_int(request.META.get('CONTENT_LENGTH'))
+    if offset is None or length is None:
+        return JsonResponse({'error': 'offset and Content-Length are required'}, status=400)
+    if length > getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024):
+        return JsonResponse({'error': 'Chunk too large'}, status=413)
+
+    try:
+        uploads.append_chunk(upload, request, offset, length)
+    except uploads.UploadError as e:
+        return JsonResponse({'error': str(e), **serialize_chunked_upload(upload)}, status=e.status)
+    return JsonResponse(serialize_chunked_upload(upload))
+
+
+@login_required
+@require_POST
+def complete_chunked_upload(request, upload_id):
+    """Verify a fully sent upload and create its file, answering like ``upload_file``"""
+    upload = ChunkedUpload.objects.filter(id=upload_id, uploader=request.user).first()
+    if upload is None:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+
+    try:
+        file_obj = uploads.complete_upload(upload)
+    except uploads.UploadError as e:
+        return JsonResponse({'status': 'error', 'error': str(e)}, status=e.status)
+
+    return JsonResponse({
+        'status': 'success',
+        'file_id': file_obj.id,
+        'filename': file_obj.filename,
+        'file_url': file_obj.file.url,
+        'file_type': file_obj.file_type
+    })
+
+
+def with_thumbnails_ready(queryset):
+    """Annotate whether the thumbnails of each file's blob are rendered, in the same query"""
+    return queryset.annotate(thumbnails_ready=Exists(
+        Blob.objects.filter(name=OuterRef('file'), thumbnails_ready=True)
+    ))
+
+
+def serialize_file_details(request, file_obj):
+    return {
+        'file_id': file_obj.id,
+        'filename': file_obj.filename,
+        'file_type': file_obj.file_type,
+        'content_type': file_obj.content_type,
+        'file_url': request.build_absolute_uri(file_obj.file.url),
+        # Stored at upload, 0 for the rows whose file was already missing when it was added
+        'file_size': file_obj.size or 0,
+        # Shown in the bubble instead of the original, which is only fetched on click
+        'thumbnails': {label: request.build_absolute_uri(url)
+                       for label, url in thumbnail_urls(file_obj.file.name, file_obj.thumbnails_ready).items()}
+    }
+
+
 def get_file_details(request, file_id):
     """
     Get file details by file ID for chat messages
     """
     try:
         # Get the file object
-        file_id = file_id - 1
-        file_obj = ChatFile.objects.get(id=file_id)
-        print(file_obj.filename)
+        file_obj = with_thumbnails_ready(ChatFile.objects).get(id=file_id)
         # Check if user has permission (is part of the chat thread)
-        thread_name = file_obj.thread_name
-        thread_id = thread_name.replace('chat_', '')
-        user_ids = [int(uid) for uid in thread_id.split('-')]
-
-        if request.user.id not in user_ids:
+        if not Thread.has_participant(file_obj.thread_id, request.user):
             return JsonResponse({'error': 'Permission denied'}, status=403)
 
-        # Get file URL
-        file_url = request.build_absolute_uri(file_obj.file.url) if hasattr(file_obj.file, 'url') else str(
-            file_obj.file)
-        print(file_url)
-
-        # Return file details
-        return JsonResponse({
-            'file_id': file_obj.id,
-            'filename': file_obj.filename,
-            'file_type': file_obj.file_type,
-            'file_url': file_url,
-            'file_size': file_obj.file.size if hasattr(file_obj.file, 'size') else 0
-        })
+        return JsonResponse(serialize_file_details(request, file_obj))
     except ChatFile.DoesNotExist:
         return JsonResponse({'error': 'File not found'}, status=404)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+def get_files_details(request):
+    """
+    Details of several files in one query: ``?ids=12,14,20`` with the ids
+    get_file_details takes.  ``files`` maps each id to its details, ids that
+    do not exist or belong to another thread are left out.
+    """
+    ids = {parse_int(file_id) for file_id in request.GET.get('ids', '').split(',')} - {None}
+    max_ids = getattr(settings, 'CHAT_FILE_DETAILS_MAX_IDS', 100)
+    if not ids or len(ids) > max_ids:
+        return JsonResponse({'error': f'Between 1 and {max_ids} ids are required'}, status=400)
+
+    files = with_thumbnails_ready(ChatFile.objects).filter(media.thread_participant(request.user), id__in=ids)
+    return JsonResponse({
+        'files': {str(file_obj.id): serialize_file_details(request, file_obj) for file_obj in files}
+    })
+
+
+@login_required
+@require_http_methods(['GET', 'HEAD'])
+def serve_media(request, name):
+    """
+    Serve an uploaded file to the users of the thread or group it was sent
+    in, with byte ranges and conditional GETs, see chats.media
+    """
+    filename = media.shared_filename(request.user, name)
+    if filename is None:
+        return JsonResponse({'error': 'File not found'}, status=404)
+    return media.media_response(request, name, filename)
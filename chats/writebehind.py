@@ -0,0 +1,119 @@
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from chats.fanout import run_in_background
+from chats.models import ChatModel, ChatNotification, ConversationSummary, MessageSequence, get_group_conversation
+from groups.models import GroupMessage
+
+
+def is_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+class WriteBehindBatcher:
+    """
+    Collects the messages of every consumer of this process and saves them
+    with one ``write_batch`` call per batch.
+
+    A batch is written once CHAT_WRITE_BEHIND_BATCH_SIZE messages are queued
+    or CHAT_WRITE_BEHIND_INTERVAL seconds after its first message, whichever
+    comes first.  ``submit`` returns a future resolved once the batch holding
+    the message is committed.  Only then has the message its id, handed out
+    by the database like for any other insert so ids keep the commit order,
+    and its sequence number.
+    """
+
+    def __init__(self, write_batch):
+        self.write_batch = write_batch
+        self._pending = []
+        self._timer = None
+        self._write_lock = None
+
+    async def submit(self, obj, *extra):
+        """Queue ``obj`` with the ``extra`` arguments ``write_batch`` needs for it"""
+        committed = asyncio.get_running_loop().create_future()
+        self._pending.append((obj, extra, committed))
+
+        if len(self._pending) >= getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100):
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.005),
+                lambda: run_in_background(self.flush())
+            )
+        return committed
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+
+        # One batch is written at a time, SQLite has a single writer anyway
+        async with self._write_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                await database_sync_to_async(self.write_batch)([(obj, *extra) for obj, extra, _ in batch])
+            except Exception as e:
+                print(f"Error writing message batch: {str(e)}")
+                for _, _, committed in batch:
+                    committed.set_exception(e)
+                return
+            for _, _, committed in batch:
+                committed.set_result(True)
+
+
+def assign_seqs(messages, conversation_of):
+    """Number ``messages``, in queue order, with one sequence block per conversation"""
+    by_conversation = {}
+    for message in messages:
+        by_conversation.setdefault(conversation_of(message), []).append(message)
+    for conversation, conversation_messages in by_conversation.items():
+        first_seq = MessageSequence.reserve(conversation, len(conversation_messages))
+        for seq, message in enumerate(conversation_messages, first_seq):
+            message.seq = seq
+
+
+def write_personal_messages(entries):
+    """
+    Save ``(chat, sender, other_user_id, receiver_username)`` entries like
+    ``PersonalChatConsumer.save_message`` does, in one transaction
+    """
+    users = User.objects.in_bulk({other_user_id for _, _, other_user_id, _ in entries})
+    chats = [chat for chat, _, _, _ in entries]
+    with transaction.atomic():
+        assign_seqs(chats, lambda chat: chat.thread_name)
+        # Sets the ids, SQLite returns them from the insert
+        ChatModel.objects.bulk_create(chats)
+        ChatNotification.objects.bulk_create([
+            ChatNotification(chat=chat, user=users[other_user_id], thread_id=chat.thread_id)
+            for chat, _, other_user_id, receiver in entries
+            if other_user_id in users and users[other_user_id].username == receiver
+        ])
+        ConversationSummary.record_personal_messages([
+            (chat, sender, users[other_user_id])
+            for chat, sender, other_user_id, _ in entries if other_user_id in users
+        ])
+
+
+def write_group_messages(entries):
+    """
+    Save ``(message, sender)`` entries like ``GroupChatConsumer.save_group_message``
+    does, in one transaction
+    """
+    messages = [message for message, _ in entries]
+    with transaction.atomic():
+        assign_seqs(messages, lambda message: get_group_conversation(message.group_id))
+        GroupMessage.objects.bulk_create(messages)
+        ConversationSummary.record_group_messages(entries)
+
+
+personal_messages = WriteBehindBatcher(write_personal_messages)
+group_messages = WriteBehindBatcher(write_group_messages)
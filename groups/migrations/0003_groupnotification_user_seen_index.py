@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 01:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0002_groupfile'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupnotification',
+            index=models.Index(fields=['user', 'is_seen', 'group'], name='groupnotif_user_seen_group_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-18 02:09
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_sequences(apps, schema_editor):
+    """Number the messages of every group in id order"""
+    GroupMessage = apps.get_model('groups', 'GroupMessage')
+    MessageSequence = apps.get_model('chats', 'MessageSequence')
+
+    last_seqs = {}
+    group_ids = GroupMessage.objects.order_by().values_list('group_id', flat=True).distinct()
+    for group_id in group_ids:
+        messages = list(GroupMessage.objects.filter(group_id=group_id).order_by('id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        GroupMessage.objects.bulk_update(messages, ['seq'], batch_size=500)
+        last_seqs[f'group_{group_id}'] = len(messages)
+
+    MessageSequence.objects.bulk_create(
+        [MessageSequence(conversation=conversation, last_seq=last_seq) for conversation, last_seq in last_seqs.items()],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0016_message_sequence'),
+        ('groups', '0003_groupnotification_user_seen_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='groupmessage',
+            constraint=models.UniqueConstraint(fields=('group', 'seq'), name='groupmsg_group_seq_uniq'),
+        ),
+    ]
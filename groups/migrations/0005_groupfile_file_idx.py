@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 02:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0004_groupmessage_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupfile',
+            index=models.Index(fields=['file'], name='groupfile_file_idx'),
+        ),
+    ]
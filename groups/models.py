@@ -24,9 +24,15 @@ class GroupMessage(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     # Optional: Add file support similar to your personal chat
     file = models.ForeignKey(ChatFile, on_delete=models.SET_NULL, null=True, blank=True)
+    # Position in the group, see chats.models.MessageSequence
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['timestamp']
+        constraints = [
+            # Also the index of the resume range query
+            models.UniqueConstraint(fields=['group', 'seq'], name='groupmsg_group_seq_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} in {self.group.name}: {self.content[:20]}"
@@ -38,6 +44,12 @@ class GroupNotification(models.Model):
     is_seen = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Unseen notifications of one user, optionally narrowed to one group
+            models.Index(fields=['user', 'is_seen', 'group'], name='groupnotif_user_seen_group_idx'),
+        ]
+
     def __str__(self):
         return f"Notification for {self.user.username} about {self.group.name}"
 
@@ -53,5 +65,11 @@ class GroupFile(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='files')
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Permission check of the media view, see chats.media.shared_file
+            models.Index(fields=['file'], name='groupfile_file_idx'),
+        ]
+
     def __str__(self):
         return f"{self.filename} - {self.group.name if hasattr(self.group, 'name') else f'Group {self.group.id}'}"
\ No newline at end of file
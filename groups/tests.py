@@ -1,3 +1,55 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
 
-# Create your tests here.
+from .models import Group, GroupMessage
+
+
+class GroupMessagesPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password')
+        cls.bob = User.objects.create_user('bob', password='password')
+        cls.carol = User.objects.create_user('carol', password='password')
+        cls.group = Group.objects.create(name='friends', created_by=cls.alice)
+        cls.group.members.add(cls.alice, cls.bob)
+        GroupMessage.objects.bulk_create(
+            GroupMessage(group=cls.group, sender=cls.bob, content=f'message {i}') for i in range(30)
+        )
+        cls.ids = list(GroupMessage.objects.filter(group=cls.group).order_by('id').values_list('id', flat=True))
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.url = reverse('get_group_messages', kwargs={'group_id': self.group.id})
+
+    def test_default_is_newest_page(self):
+        data = self.client.get(self.url, {'limit': 10}).json()
+
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[-10:])
+        self.assertTrue(data['has_more'])
+
+    def test_before_returns_older_page(self):
+        data = self.client.get(self.url, {'limit': 10, 'before': self.ids[-10]}).json()
+
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[-20:-10])
+
+    def test_after_returns_only_the_delta(self):
+        data = self.client.get(self.url, {'after': self.ids[-3]}).json()
+
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[-2:])
+        self.assertFalse(data['has_more'])
+
+    def test_after_is_paged_oldest_first(self):
+        data = self.client.get(self.url, {'after': self.ids[0], 'limit': 5}).json()
+
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[1:6])
+        self.assertTrue(data['has_more'])
+
+    @override_settings(CHAT_HISTORY_MAX_PAGE_SIZE=7)
+    def test_page_size_is_capped(self):
+        data = self.client.get(self.url, {'limit': 500}).json()
+        self.assertEqual(len(data['messages']), 7)
+
+    def test_non_member_is_rejected(self):
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
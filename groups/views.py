@@ -6,6 +6,9 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 import json
+from chats import archive
+from chats.models import ConversationSummary, MessageSequence, get_group_conversation
+from chats.pagination import get_page_size, parse_int
 from .models import Group, GroupMessage, GroupNotification
 
 @login_required
@@ -41,8 +44,10 @@ def create_group(request):
             welcome_message = GroupMessage.objects.create(
                 group=group,
                 sender=request.user,
-                content=f"{request.user.username} created this group"
+                content=f"{request.user.username} created this group",
+                seq=MessageSequence.reserve(get_group_conversation(group.id))
             )
+            ConversationSummary.record_group_message(welcome_message, request.user)
 
             return JsonResponse({
                 'success': True,
@@ -54,8 +59,43 @@ def create_group(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+def serialize_group_message(message, current_user):
+    return {
+        'id': message.id,
+        'sender': {
+            'id': message.sender.id,
+            'username': message.sender.username
+        },
+        'content': message.content,
+        'seq': message.seq,
+        'timestamp': message.timestamp.isoformat(),
+        'is_current_user': message.sender.id == current_user.id
+    }
+
+
+def serialize_archived_group_message(record, current_user):
+    return {
+        'id': record['id'],
+        'sender': record['sender'],
+        'content': record['content'],
+        'seq': record['seq'],
+        'timestamp': record['timestamp'],
+        'is_current_user': record['sender']['id'] == current_user.id
+    }
+
+
 @login_required
 def get_group_messages(request, group_id):
+    """
+    Paginated group history.
+
+    Without cursor the newest page is returned.  ``?before=<id>`` returns the
+    page just older than that message and ``?after=<id>`` only the messages
+    newer than it, so a client re-opening a group downloads just the delta.
+    Messages are always in chronological order and ``has_more`` tells whether
+    another page exists in the requested direction.  Messages older than the
+    hot tables are read from the archive.
+    """
     try:
         group = Group.objects.get(id=group_id)
 
@@ -69,22 +109,41 @@ def get_group_messages(request, group_id):
             user=request.user,
             is_seen=False
         ).update(is_seen=True)
-
-        # Get messages with sender info
-        messages = GroupMessage.objects.filter(group=group).select_related('sender').order_by('timestamp')
-
-        messages_data = []
-        for message in messages:
-            messages_data.append({
-                'id': message.id,
-                'sender': {
-                    'id': message.sender.id,
-                    'username': message.sender.username
-                },
-                'content': message.content,
-                'timestamp': message.timestamp.isoformat(),
-                'is_current_user': message.sender.id == request.user.id
-            })
+        ConversationSummary.mark_read(request.user, group_id=group.id)
+
+        limit = get_page_size(request)
+        before_id = parse_int(request.GET.get('before'))
+        after_id = parse_int(request.GET.get('after'))
+
+        # Get messages with sender info, walking the group_id index in id order
+        conversation = get_group_conversation(group.id)
+        messages = GroupMessage.objects.filter(group=group).select_related('sender')
+        if after_id is not None:
+            # The archived messages come first, the hot ones are all newer
+            archived = archive.archived_after(conversation, after_id, limit + 1)
+            if archived:
+                after_id = archived[-1]['id']
+            messages = list(messages.filter(id__gt=after_id).order_by('id')[:limit + 1 - len(archived)])
+            messages_data = [serialize_archived_group_message(record, request.user) for record in archived] + \
+                [serialize_group_message(message, request.user) for message in messages]
+            has_more = len(messages_data) > limit
+            messages_data = messages_data[:limit]
+        else:
+            if before_id is not None:
+                messages = messages.filter(id__lt=before_id)
+            messages = list(messages.order_by('-id')[:limit + 1])
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            messages.reverse()
+            messages_data = [serialize_group_message(message, request.user) for message in messages]
+            if not has_more and len(messages) < limit:
+                archived, has_more = archive.archived_before(conversation, limit - len(messages),
+                                                             before_id=messages[0].id if messages else before_id)
+                messages_data = [serialize_archived_group_message(record, request.user)
+                                 for record in archived] + messages_data
+            elif not has_more:
+                # The page ends with the oldest hot message, the archived ones are all older
+                has_more = archive.has_archived(conversation)
 
         return JsonResponse({
             'group': {
@@ -92,7 +151,8 @@ def get_group_messages(request, group_id):
                 'name': group.name,
                 'created_at': group.created_at.isoformat()
             },
-            'messages': messages_data
+            'messages': messages_data,
+            'has_more': has_more
         })
 
     except Group.DoesNotExist:
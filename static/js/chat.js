@@ -1,3 +1,10 @@
+// Text as HTML, for the messages and names built into innerHTML here and in groupchat.js
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text == null ? '' : text;
+    return div.innerHTML;
+}
+
 // Enhanced file upload and message handling
 document.addEventListener('DOMContentLoaded', function() {
     // Get necessary elements and setup
@@ -19,28 +26,88 @@ document.addEventListener('DOMContentLoaded', function() {
         roomName = `${id}-${currentUserId}`;
     }
 
+    // Sequence number of the newest message shown, a reconnecting socket
+    // asks the server for the messages after it instead of reloading the thread
+    let lastSeq = JSON.parse(document.getElementById('json-last-seq').textContent) || 0;
+
     // Setup WebSocket
-    const socket = new WebSocket(
-        'ws://' + window.location.host + '/ws/' + id + '/'
-    );
+    let socket;
+
+    function connect() {
+        socket = new WebSocket(
+            'ws://' + window.location.host + '/ws/' + id + '/'
+        );
+
+        socket.onopen = function(e) {
+            console.log("CONNECTION ESTABLISHED");
+            socket.send(JSON.stringify({'type': 'resume', 'last_seq': lastSeq}));
+        };
+
+        socket.onclose = function(e) {
+            console.log("CONNECTION LOST");
+            setTimeout(connect, 3000);
+        };
 
-    socket.onopen = function(e) {
-        console.log("CONNECTION ESTABLISHED");
-    };
+        socket.onerror = function(e) {
+            console.log("ERROR OCCURRED");
+        };
+
+        socket.onmessage = handleMessage;
+    }
 
-    socket.onclose = function(e) {
-        console.log("CONNECTION LOST");
-    };
+    // Typing indicator: keystrokes are reported at most once a second, the
+    // server merges the typists of the room into one "who is typing" frame
+    const typingIndicator = document.getElementById('typing-indicator');
+    const TYPING_REPORT_INTERVAL = 1000;
+    let lastTypingReport = 0;
 
-    socket.onerror = function(e) {
-        console.log("ERROR OCCURRED");
-    };
+    function isPersonalChatOpen() {
+        const chatType = document.getElementById('current-chat-type');
+        return !chatType || chatType.value === 'personal';
+    }
+
+    function reportTyping(isTyping) {
+        if (socket.readyState !== WebSocket.OPEN || !isPersonalChatOpen()) {
+            return;
+        }
+        const now = Date.now();
+        if (isTyping && now - lastTypingReport < TYPING_REPORT_INTERVAL) {
+            return;
+        }
+        lastTypingReport = isTyping ? now : 0;
+        socket.send(JSON.stringify({'type': 'typing', 'is_typing': isTyping}));
+    }
+
+    function showTyping(usernames) {
+        if (!typingIndicator || !isPersonalChatOpen()) {
+            return;
+        }
+        const others = usernames.filter(name => name !== message_username);
+        typingIndicator.textContent = others.length ? 'typing...' : '';
+    }
 
     // Enhanced message receiver
-    socket.onmessage = function(e) {
+    function handleMessage(e) {
         const data = JSON.parse(e.data);
         console.log("Message received:", data);
 
+        if (data.type === 'typing') {
+            showTyping(data.usernames);
+            return;
+        }
+        if (data.type === 'resync') {
+            // Too many messages were missed, the page shows the newest history page
+            location.reload();
+            return;
+        }
+        if (data.seq) {
+            if (data.seq <= lastSeq) {
+                // Already shown, replayed after a reconnect
+                return;
+            }
+            lastSeq = data.seq;
+        }
+
         // Create HTML for message content based on message type
         let messageContent;
 
@@ -116,11 +183,15 @@ document.addEventListener('DOMContentLoaded', function() {
         // Scroll to bottom of chat
         const chatBody = document.querySelector('.message-table-scroll');
         chatBody.scrollTop = chatBody.scrollHeight;
-    };
+    }
+
+    connect();
 
     // Process existing messages on page load to handle file references
     function processExistingMessages() {
         const messageElements = document.querySelectorAll('#chat-body tr p.rounded');
+        // File id -> id of its placeholder, all fetched in one request below
+        const placeholders = {};
 
         messageElements.forEach(element => {
             // Check if this message contains a file reference
@@ -139,21 +210,109 @@ document.addEventListener('DOMContentLoaded', function() {
                         </svg>
                         <div>Loading file...</div>
                     </div>`;
+                    placeholders[fileId] = messageId;
+                }
+            }
+        });
 
-                    // Fetch file details and update
-                    fetchFileDetails(fileId).then(fileData => {
-                        if (fileData) {
-                            const fileElement = document.getElementById(messageId);
-                            if (fileElement) {
-                                fileElement.innerHTML = createFileMessageHTML(fileData);
-                            }
-                        }
-                    });
+        fetchFilesDetails(Object.keys(placeholders)).then(files => {
+            for (const [fileId, fileData] of Object.entries(files)) {
+                const fileElement = document.getElementById(placeholders[fileId]);
+                if (fileElement) {
+                    fileElement.innerHTML = createFileMessageHTML(fileData);
                 }
             }
         });
     }
 
+    // Lazy "load older" for the personal thread history.
+    // The page only renders the newest messages, older ones are fetched page by page.
+    const loadOlderButton = document.getElementById('load-older-btn');
+    const chatBodyElement = document.querySelector('#chat-body');
+    let loadingOlderMessages = false;
+
+    function createHistoryRowHTML(message) {
+        const time = new Date(message.timestamp).toLocaleTimeString([], {hour: '2-digit', minute: '2-digit', hour12: false});
+        if (message.is_current_user) {
+            return `
+                <tr>
+                    <td>
+                        <p class="bg-success p-2 mt-2 mr-5 shadow-sm text-white float-right rounded">
+                            ${escapeHtml(message.message)}
+                        </p>
+                    </td>
+                    <td>
+                        <p><small class="p-1 shadow-sm">${time}</small></p>
+                    </td>
+                </tr>`;
+        }
+        return `
+            <tr>
+                <td>
+                    <p class="bg-primary p-2 mt-2 mr-5 shadow-sm text-white float-left rounded">
+                        ${escapeHtml(message.sender)}: ${escapeHtml(message.message)}
+                    </p>
+                </td>
+                <td>
+                    <p><small class="p-1 shadow-sm">${time}</small></p>
+                </td>
+            </tr>`;
+    }
+
+    async function loadOlderMessages() {
+        const before = chatBodyElement.dataset.before;
+        const beforeId = chatBodyElement.dataset.beforeId;
+        if (loadingOlderMessages || !beforeId) return;
+        loadingOlderMessages = true;
+
+        try {
+            const params = new URLSearchParams({before: before, before_id: beforeId});
+            const response = await fetch(`/chat/${encodeURIComponent(receiver)}/messages/?${params}`, {
+                credentials: 'same-origin'
+            });
+            if (!response.ok) {
+                console.error('Failed to load older messages:', response.status);
+                return;
+            }
+            const data = await response.json();
+
+            // Keep the viewport on the message the user was looking at
+            const scrollArea = document.querySelector('.message-table-scroll');
+            const previousHeight = scrollArea.scrollHeight;
+
+            const loadOlderRow = document.getElementById('load-older-row');
+            loadOlderRow.insertAdjacentHTML('afterend', data.messages.map(createHistoryRowHTML).join(''));
+            scrollArea.scrollTop += scrollArea.scrollHeight - previousHeight;
+
+            if (data.next_cursor) {
+                chatBodyElement.dataset.before = data.next_cursor.before;
+                chatBodyElement.dataset.beforeId = data.next_cursor.before_id;
+            } else {
+                chatBodyElement.dataset.beforeId = '';
+                loadOlderRow.remove();
+            }
+            processExistingMessages();
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            loadingOlderMessages = false;
+        }
+    }
+
+    if (loadOlderButton) {
+        loadOlderButton.addEventListener('click', function(e) {
+            e.preventDefault();
+            loadOlderMessages();
+        });
+
+        // Fetch the next page automatically when the user scrolls to the top
+        document.querySelector('.message-table-scroll').addEventListener('scroll', function() {
+            if (this.scrollTop === 0 && document.getElementById('load-older-row')) {
+                loadOlderMessages();
+            }
+        });
+    }
+
     // Helper function to get current time
     function getCurrentTime() {
         const now = new Date();
@@ -187,7 +346,18 @@ document.addEventListener('DOMContentLoaded', function() {
     function createFileMessageHTML(fileData) {
         if (!fileData) return 'File unavailable';
 
-        if (fileData.file_type && fileData.file_type.toLowerCase().startsWith('image/')) {
+        const thumbnails = fileData.thumbnails || {};
+        if (thumbnails.small) {
+            // Only the thumbnail is downloaded, the original when it is clicked
+            const srcset = thumbnails.large ? `${thumbnails.small} 1x, ${thumbnails.large} 3x` : thumbnails.small;
+            return `
+                <div>
+                    <a href="${fileData.file_url}" target="_blank">
+                        <img src="${thumbnails.small}" srcset="${srcset}" alt="${fileData.filename}" loading="lazy" style="max-width: 200px; max-height: 150px; border-radius: 5px; margin-bottom: 5px;">
+                    </a>
+                    <div><a href="${fileData.file_url}" download style="color: white; text-decoration: underline;">${fileData.filename}</a></div>
+                </div>`;
+        } else if (fileData.file_type && fileData.file_type.toLowerCase().startsWith('image/')) {
             return `
                 <div>
                     <img src="${fileData.file_url}" alt="${fileData.filename}" style="max-width: 200px; max-height: 150px; border-radius: 5px; margin-bottom: 5px;">
@@ -240,9 +410,114 @@ document.addEventListener('DOMContentLoaded', function() {
 
     }
 
+    // Details of many files, as few requests as the server's limit allows
+    const FILE_DETAILS_BATCH_SIZE = 100;
+
+    async function fetchFilesDetails(fileIds) {
+        const files = {};
+        for (let i = 0; i < fileIds.length; i += FILE_DETAILS_BATCH_SIZE) {
+            const ids = fileIds.slice(i, i + FILE_DETAILS_BATCH_SIZE).join(',');
+            try {
+                const response = await fetch(`/service_worker/get-files-details/?ids=${ids}`, {
+                    credentials: 'same-origin'
+                });
+                if (!response.ok) {
+                    console.error('Failed to fetch file details:', response.status);
+                    continue;
+                }
+                Object.assign(files, (await response.json()).files);
+            } catch (error) {
+                console.error('Error fetching file details:', error);
+            }
+        }
+        return files;
+    }
+
     // Get CSRF token
     const csrftoken = getCookie('csrftoken');
 
+    // Chunked uploads: the file is sent chunk by chunk with PUT, after a
+    // failed chunk the server tells where to resume
+    const UPLOAD_MAX_RETRIES = 5;
+    // Hashing needs the whole file in memory, bigger files go without checksum
+    const UPLOAD_CHECKSUM_MAX_SIZE = 512 * 1024 * 1024;
+
+    async function sha256Hex(file) {
+        // crypto.subtle only exists on secure origins
+        if (!window.crypto || !window.crypto.subtle || file.size > UPLOAD_CHECKSUM_MAX_SIZE) {
+            return '';
+        }
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function uploadInChunks(file, threadName) {
+        const startResponse = await fetch('/service_worker/uploads/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrftoken
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({
+                'filename': file.name,
+                'size': file.size,
+                'checksum': await sha256Hex(file),
+                'thread_name': threadName
+            })
+        });
+        let upload = await startResponse.json();
+        if (!startResponse.ok) {
+            throw new Error(upload.error || 'Upload failed: ' + startResponse.status);
+        }
+
+        const uploadUrl = `/service_worker/uploads/${upload.upload_id}/`;
+        let failures = 0;
+        while (upload.offset < upload.size) {
+            const chunk = file.slice(upload.offset, upload.offset + upload.chunk_size);
+            try {
+                const response = await fetch(`${uploadUrl}?offset=${upload.offset}`, {
+                    method: 'PUT',
+                    body: chunk,
+                    headers: {
+                        'Content-Type': 'application/octet-stream',
+                        'X-CSRFToken': csrftoken
+                    },
+                    credentials: 'same-origin'
+                });
+                const data = await response.json();
+                // A 409 carries the offset the server expects
+                if (!response.ok && response.status !== 409) {
+                    throw new Error(data.error || 'Upload failed: ' + response.status);
+                }
+                upload = data;
+                failures = 0;
+            } catch (error) {
+                if (++failures > UPLOAD_MAX_RETRIES) {
+                    throw error;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                try {
+                    const status = await fetch(uploadUrl, {credentials: 'same-origin'});
+                    if (status.ok) {
+                        upload = await status.json();
+                    }
+                } catch (statusError) {
+                    console.error('Error resuming upload:', statusError);
+                }
+            }
+        }
+
+        const completeResponse = await fetch(`${uploadUrl}complete/`, {
+            method: 'POST',
+            headers: {
+                'X-CSRFToken': csrftoken
+            },
+            credentials: 'same-origin'
+        });
+        return await completeResponse.json();
+    }
+
     // Handle file selection
     if (fileInput) {
         fileInput.addEventListener('change', function() {
@@ -294,27 +569,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 const chatBody = document.querySelector('.message-table-scroll');
                 chatBody.scrollTop = chatBody.scrollHeight;
 
-                // Create FormData object for file upload
-                const formData = new FormData();
-                formData.append('file', file);
-                formData.append('thread_name', `chat_${roomName}`);
-
                 try {
-                    // Send file to server
-                    const response = await fetch('/service_worker/upload-file/', {
-                        method: 'POST',
-                        body: formData,
-                        headers: {
-                            'X-CSRFToken': csrftoken
-                        },
-                        credentials: 'same-origin'
-                    });
-
-                    if (!response.ok) {
-                        throw new Error('Upload failed: ' + response.status);
-                    }
-
-                    const result = await response.json();
+                    // Send file to server in chunks, resuming after a dropped connection
+                    const result = await uploadInChunks(file, `chat_${roomName}`);
 
                     if (result.status === 'success') {
                         // Remove loading message
@@ -384,6 +641,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 }));
 
                 messageInput.value = '';
+                reportTyping(false);
             }
         };
     }
@@ -394,6 +652,8 @@ document.addEventListener('DOMContentLoaded', function() {
             if (event.key === 'Enter') {
                 event.preventDefault();
                 chatMessageSubmit.click();
+            } else {
+                reportTyping(messageInput.value.length > 0);
             }
         });
     }
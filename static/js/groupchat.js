@@ -109,73 +109,155 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    // Messages already downloaded per group, so re-opening a group only fetches the delta
+    const groupHistory = {};
+    let loadingOlderGroupMessages = false;
+
+    function createGroupMessageHTML(message) {
+        const isCurrentUser = message.is_current_user;
+        const messageClass = isCurrentUser ? 'bg-success float-right' : 'bg-primary float-left';
+        const senderName = isCurrentUser ? 'You' : message.sender.username;
+
+        return `
+            <tr>
+                <td>
+                    <p class="${messageClass} p-2 mt-2 mr-5 shadow-sm text-white rounded">
+                        ${escapeHtml(senderName)}: ${escapeHtml(message.content)}
+                    </p>
+                </td>
+                <td>
+                    <p><small class="p-1 shadow-sm">${new Date(message.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'})}</small></p>
+                </td>
+            </tr>`;
+    }
+
+    async function fetchGroupMessages(groupId, params) {
+        const query = new URLSearchParams(params).toString();
+        const response = await fetch(`/group/${groupId}/messages/` + (query ? `?${query}` : ''));
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Unknown error');
+        }
+        return data;
+    }
+
+    async function syncGroupHistory(groupId) {
+        const history = groupHistory[groupId];
+
+        if (history) {
+            const lastId = history.messages.length ? history.messages[history.messages.length - 1].id : 0;
+            const delta = await fetchGroupMessages(groupId, {after: lastId});
+            history.messages.push(...delta.messages);
+            if (!delta.has_more) {
+                return history;
+            }
+            // Too far behind, the newest page is cheaper than replaying the whole gap
+        }
+
+        const data = await fetchGroupMessages(groupId, {});
+        groupHistory[groupId] = {
+            group: data.group,
+            messages: data.messages,
+            hasOlder: data.has_more
+        };
+        return groupHistory[groupId];
+    }
+
     // Function to load a group chat
     async function loadGroupChat(groupId) {
         try {
-            // Fetch group details and messages
-            const response = await fetch(`/group/${groupId}/messages/`);
-            const data = await response.json();
-
-            if (response.ok) {
-                // Update UI to show group chat
-                currentChatType.value = 'group';
-                currentChatId.value = groupId;
-                currentChatName.textContent = data.group.name;
-
-                // Clear and populate chat messages
-                chatBody.innerHTML = '';
-                data.messages.forEach(message => {
-                    const isCurrentUser = message.is_current_user;
-                    const messageClass = isCurrentUser ? 'bg-success float-right' : 'bg-primary float-left';
-                    const senderName = isCurrentUser ? 'You' : message.sender.username;
-
-                    chatBody.innerHTML += `
-                        <tr>
-                            <td>
-                                <p class="${messageClass} p-2 mt-2 mr-5 shadow-sm text-white rounded">
-                                    ${senderName}: ${message.content}
-                                </p>
-                            </td>
-                            <td>
-                                <p><small class="p-1 shadow-sm">${new Date(message.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'})}</small></p>
-                            </td>
-                        </tr>`;
-                });
+            // Fetch group details and messages (only the new ones if we have the group cached)
+            const history = await syncGroupHistory(groupId);
 
-                // Scroll to bottom
-                const messageTable = document.querySelector('.message-table-scroll');
-                messageTable.scrollTop = messageTable.scrollHeight;
+            // Update UI to show group chat
+            currentChatType.value = 'group';
+            currentChatId.value = groupId;
+            currentChatName.textContent = history.group.name;
 
-                // Initialize WebSocket for group chat
-                initializeGroupWebSocket(groupId);
+            // Clear and populate chat messages
+            chatBody.innerHTML = history.messages.map(createGroupMessageHTML).join('');
 
-                // Show message box
-                messageBox.style.display = 'flex';
-            } else {
-                console.error('Error loading group chat:', data.error);
-                alert('Error loading group chat: ' + (data.error || 'Unknown error'));
-            }
+            // Scroll to bottom
+            const messageTable = document.querySelector('.message-table-scroll');
+            messageTable.scrollTop = messageTable.scrollHeight;
+
+            // Initialize WebSocket for group chat
+            initializeGroupWebSocket(groupId);
+
+            // Show message box
+            messageBox.style.display = 'flex';
         } catch (error) {
             console.error('Error loading group chat:', error);
-            alert('Error loading group chat. Please try again.');
+            alert('Error loading group chat: ' + (error.message || 'Please try again.'));
+        }
+    }
+
+    // Fetch the previous page of the open group when the user scrolls to the top
+    document.querySelector('.message-table-scroll').addEventListener('scroll', async function() {
+        if (this.scrollTop !== 0 || currentChatType.value !== 'group' || loadingOlderGroupMessages) {
+            return;
+        }
+        const groupId = currentChatId.value;
+        const history = groupHistory[groupId];
+        if (!history || !history.hasOlder || !history.messages.length) {
+            return;
+        }
+
+        loadingOlderGroupMessages = true;
+        try {
+            const data = await fetchGroupMessages(groupId, {before: history.messages[0].id});
+            if (currentChatId.value !== groupId) {
+                return;
+            }
+            history.messages.unshift(...data.messages);
+            history.hasOlder = data.has_more;
+
+            const previousHeight = this.scrollHeight;
+            chatBody.insertAdjacentHTML('afterbegin', data.messages.map(createGroupMessageHTML).join(''));
+            this.scrollTop += this.scrollHeight - previousHeight;
+        } catch (error) {
+            console.error('Error loading older group messages:', error);
+        } finally {
+            loadingOlderGroupMessages = false;
+        }
+    });
+
+    // Reload the newest page of a group when a reconnect missed too many messages
+    async function resyncGroup(groupId) {
+        delete groupHistory[groupId];
+        try {
+            const history = await syncGroupHistory(groupId);
+            if (currentChatId.value === groupId) {
+                chatBody.innerHTML = history.messages.map(createGroupMessageHTML).join('');
+            }
+        } catch (error) {
+            console.error('Error reloading group chat:', error);
         }
     }
 
     // Initialize WebSocket connection for group chat
     function initializeGroupWebSocket(groupId) {
-        // Close existing connection if any
+        // Close existing connection if any, without reconnecting it
         if (groupSocket) {
+            groupSocket.onclose = null;
             groupSocket.close();
         }
 
         // Create new WebSocket connection
         const wsProtocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+        // A burst of messages arrives as one array frame, rendered at once
         groupSocket = new WebSocket(
-            wsProtocol + window.location.host + '/ws/group/' + groupId + '/'
+            wsProtocol + window.location.host + '/ws/group/' + groupId + '/',
+            ['chat.json.batch.v1', 'chat.json.v1']
         );
 
         groupSocket.onopen = function(e) {
             console.log("Group chat connection established");
+            // Ask for the messages sent since the newest one we have, after a
+            // reconnect that is only the gap instead of the whole conversation
+            const history = groupHistory[groupId];
+            const lastMessage = history && history.messages[history.messages.length - 1];
+            groupSocket.send(JSON.stringify({'type': 'resume', 'last_seq': (lastMessage && lastMessage.seq) || 0}));
         };
 
         groupSocket.onclose = function(e) {
@@ -194,24 +276,49 @@ document.addEventListener('DOMContentLoaded', function() {
 
         groupSocket.onmessage = function(e) {
             const data = JSON.parse(e.data);
-            console.log("Group message received:", data);
-
-            // Add new message to chat
-            const isCurrentUser = data.sender.id === parseInt(document.getElementById('json-current-user-id').textContent);
-            const messageClass = isCurrentUser ? 'bg-success float-right' : 'bg-primary float-left';
-            const senderName = isCurrentUser ? 'You' : data.sender.username;
-
-            chatBody.innerHTML += `
-                <tr>
-                    <td>
-                        <p class="${messageClass} p-2 mt-2 mr-5 shadow-sm text-white rounded">
-                            ${senderName}: ${data.message}
-                        </p>
-                    </td>
-                    <td>
-                        <p><small class="p-1 shadow-sm">${new Date(data.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'})}</small></p>
-                    </td>
-                </tr>`;
+            const events = Array.isArray(data) ? data : [data];
+            console.log("Group events received:", events);
+
+            const currentUserId = parseInt(document.getElementById('json-current-user-id').textContent);
+            let html = '';
+            events.forEach(function(event) {
+                if (event.type === 'typing') {
+                    showGroupTyping(event.usernames);
+                    return;
+                }
+                if (event.type === 'resync') {
+                    resyncGroup(groupId);
+                    return;
+                }
+
+                // Add new message to chat
+                const message = {
+                    id: event.message_id,
+                    seq: event.seq,
+                    sender: event.sender,
+                    content: event.message,
+                    timestamp: event.timestamp,
+                    is_current_user: event.sender.id === currentUserId
+                };
+
+                // Keep the cache current so the next delta fetch starts after this message,
+                // messages we already have are replays after a reconnect
+                const history = groupHistory[groupId];
+                if (history) {
+                    const lastMessage = history.messages[history.messages.length - 1];
+                    if (lastMessage && message.id <= lastMessage.id) {
+                        return;
+                    }
+                    history.messages.push(message);
+                }
+
+                html += createGroupMessageHTML(message);
+            });
+
+            if (!html) {
+                return;
+            }
+            chatBody.innerHTML += html;
 
             // Scroll to bottom
             const messageTable = document.querySelector('.message-table-scroll');
@@ -231,9 +338,26 @@ document.addEventListener('DOMContentLoaded', function() {
         messageInput.addEventListener('keyup', function(e) {
             if (e.key === 'Enter') {
                 sendMessage();
+            } else {
+                reportGroupTyping(messageInput.value.length > 0);
             }
         });
 
+        // Typing indicator: keystrokes are reported at most once a second, the
+        // server merges the typists of the group into one "who is typing" frame
+        let lastTypingReport = 0;
+        function reportGroupTyping(isTyping) {
+            if (!groupSocket || groupSocket.readyState !== WebSocket.OPEN || currentChatType.value !== 'group') {
+                return;
+            }
+            const now = Date.now();
+            if (isTyping && now - lastTypingReport < 1000) {
+                return;
+            }
+            lastTypingReport = isTyping ? now : 0;
+            groupSocket.send(JSON.stringify({'type': 'typing', 'is_typing': isTyping}));
+        }
+
         // Function to send messages
         function sendMessage() {
             const message = messageInput.value.trim();
@@ -245,10 +369,27 @@ document.addEventListener('DOMContentLoaded', function() {
                 }));
 
                 messageInput.value = '';
+                reportGroupTyping(false);
             }
         }
     }
 
+    function showGroupTyping(usernames) {
+        const typingIndicator = document.getElementById('typing-indicator');
+        if (!typingIndicator || currentChatType.value !== 'group') {
+            return;
+        }
+        const currentUsername = JSON.parse(document.getElementById('json-message-username').textContent);
+        const others = usernames.filter(name => name !== currentUsername);
+        if (others.length === 0) {
+            typingIndicator.textContent = '';
+        } else if (others.length <= 3) {
+            typingIndicator.textContent = `${others.join(', ')} ${others.length === 1 ? 'is' : 'are'} typing...`;
+        } else {
+            typingIndicator.textContent = `${others.length} people are typing...`;
+        }
+    }
+
     // Helper function to get cookies
     function getCookie(name) {
         let cookieValue = null;
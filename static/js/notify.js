@@ -5,6 +5,10 @@ const notificationSocket = new WebSocket(
 
 let unseenNotifications = [];
 let unseenCount = 0;
+// The unseen list is fetched page by page when the dropdown opens, pushes only carry the count
+let notificationsLoaded = false;
+let notificationCursors = {chat: null, group: null};
+let notificationsHaveMore = {chat: false, group: false};
 
 
 document.addEventListener('DOMContentLoaded', function() {
@@ -38,6 +42,9 @@ document.addEventListener('DOMContentLoaded', function() {
         event.stopPropagation();
         notificationDropdown.style.display =
             notificationDropdown.style.display === 'none' ? 'block' : 'none';
+        if (notificationDropdown.style.display === 'block' && !notificationsLoaded) {
+            loadNotifications(true);
+        }
     });
 
     document.addEventListener('click', function(event) {
@@ -62,15 +69,56 @@ notificationSocket.onmessage = function(e) {
         showBrowserNotification(data.notification);
     }
 
-    if (data.hasOwnProperty('unseen_notifications')) {
-        unseenNotifications = data.unseen_notifications;
+    if (data.hasOwnProperty('unseen_count')) {
         unseenCount = data.unseen_count;
-
         updateNotificationBadge();
-        updateNotificationDropdown();
+
+        // The list is stale now, refresh it if it is on screen or on the next open
+        notificationsLoaded = false;
+        const dropdown = document.getElementById('notification-dropdown');
+        if (unseenCount === 0) {
+            unseenNotifications = [];
+            updateNotificationDropdown();
+        } else if (dropdown && dropdown.style.display === 'block') {
+            loadNotifications(true);
+        }
     }
 };
 
+async function fetchNotificationPage(kind) {
+    const params = new URLSearchParams({kind: kind});
+    if (notificationCursors[kind]) {
+        params.set('before', notificationCursors[kind]);
+    }
+    const response = await fetch(`/notifications/?${params}`, {credentials: 'same-origin'});
+    if (!response.ok) {
+        throw new Error('Failed to load notifications: ' + response.status);
+    }
+    const data = await response.json();
+    notificationCursors[kind] = data.next_before;
+    notificationsHaveMore[kind] = data.has_more;
+    return data.notifications;
+}
+
+async function loadNotifications(reset) {
+    try {
+        if (reset) {
+            unseenNotifications = [];
+            notificationCursors = {chat: null, group: null};
+            notificationsHaveMore = {chat: true, group: true};
+        }
+        const kinds = ['chat', 'group'].filter(kind => notificationsHaveMore[kind]);
+        const pages = await Promise.all(kinds.map(fetchNotificationPage));
+
+        unseenNotifications = unseenNotifications.concat(...pages);
+        unseenNotifications.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
+        notificationsLoaded = true;
+        updateNotificationDropdown();
+    } catch (error) {
+        console.error('Error loading notifications:', error);
+    }
+}
+
 function updateNotificationBadge() {
     const countBadge = document.getElementById('count_badge');
     if (unseenCount > 0) {
@@ -101,9 +149,10 @@ function updateNotificationDropdown() {
             ? `<p style="margin: 0; color: #666; font-size: 12px;">${notification.message_preview}</p>`
             : '';
 
+        const where = notification.kind === 'group' ? ` in ${notification.group_name}` : '';
         notificationItem.innerHTML = `
             <p style="margin: 0; font-weight: bold;">
-                <strong>${notification.sender_username}</strong> messaged you
+                <strong>${notification.sender_username}</strong> messaged you${where}
             </p>
             <p style="margin: 0; font-size: 12px; color: #888;">
                 ${formatTimestamp(notification.timestamp)}
@@ -112,12 +161,26 @@ function updateNotificationDropdown() {
         `;
 
         notificationItem.addEventListener('click', function() {
-            window.location.href = `/chat/${notification.sender_username}/`;
+            if (notification.kind !== 'group') {
+                window.location.href = `/chat/${notification.sender_username}/`;
+            }
         });
 
         dropdown.appendChild(notificationItem);
     });
 
+    if (notificationsHaveMore.chat || notificationsHaveMore.group) {
+        const loadMoreBtn = document.createElement('button');
+        loadMoreBtn.textContent = 'Load more';
+        loadMoreBtn.className = 'btn btn-sm btn-link';
+        loadMoreBtn.style.width = '100%';
+        loadMoreBtn.addEventListener('click', function(event) {
+            event.stopPropagation();
+            loadNotifications(false);
+        });
+        dropdown.appendChild(loadMoreBtn);
+    }
+
     const markAllReadBtn = document.createElement('button');
     markAllReadBtn.textContent = 'Mark all as Read';
     markAllReadBtn.className = 'mark-all-read-btn';
@@ -15,25 +15,66 @@ onlineSocket.onopen = function(e) {
         'username': username,
         'type': 'open'
     }));
+    subscribeToPresence();
 };
 
-// Handle online status messages
+// Usernames of the users on screen by id: the sidebar contacts and the open thread
+function visiblePresenceUsers() {
+    const users = {};
+    document.querySelectorAll('.personal-chat[data-userid]').forEach(function(row) {
+        users[row.dataset.userid] = row.dataset.username;
+    });
+    const openThreadId = document.getElementById('json-username');
+    const openThreadUsername = document.getElementById('json-username-receiver');
+    if (openThreadId && openThreadUsername) {
+        users[JSON.parse(openThreadId.textContent)] = JSON.parse(openThreadUsername.textContent);
+    }
+    return users;
+}
+
+// The server only sends changes of the users we subscribed to
+let presenceUsers = {};
+function subscribeToPresence() {
+    presenceUsers = visiblePresenceUsers();
+    onlineSocket.send(JSON.stringify({
+        'type': 'subscribe',
+        'user_ids': Object.keys(presenceUsers)
+    }));
+}
+
+// Keep the connection alive on the server, it expires after CHAT_PRESENCE_TTL
+// seconds (60 by default) without hearing from us
+const PRESENCE_HEARTBEAT_INTERVAL = 25000;
+const presenceHeartbeat = setInterval(function() {
+    if (onlineSocket.readyState === WebSocket.OPEN) {
+        onlineSocket.send(JSON.stringify({'type': 'heartbeat'}));
+    }
+}, PRESENCE_HEARTBEAT_INTERVAL);
+
+// Handle presence diffs: {type: 'presence', online: {user_id: bool}}
 onlineSocket.onmessage = function(e) {
     const data = JSON.parse(e.data);
-    const username = data.username;
-    const onlineStatus = data.online_status;
-    
-    // Update user status in the contacts list
-    const userStatus = document.getElementById(`${username}_status`);
-    if (userStatus) {
-        userStatus.style.color = onlineStatus ? 'green' : 'grey';
-    }
-    
-    // Update user status in the chat header if applicable
-    const userStatusSmall = document.getElementById(`${username}_small`);
-    if (userStatusSmall) {
-        userStatusSmall.textContent = onlineStatus ? 'Online' : 'Offline';
+    if (data.type !== 'presence') {
+        return;
     }
+    Object.entries(data.online).forEach(function([userId, onlineStatus]) {
+        const username = presenceUsers[userId];
+        if (!username) {
+            return;
+        }
+
+        // Update user status in the contacts list
+        const userStatus = document.getElementById(`${username}_status`);
+        if (userStatus) {
+            userStatus.style.color = onlineStatus ? 'green' : 'grey';
+        }
+
+        // Update user status in the chat header if applicable
+        const userStatusSmall = document.getElementById(`${username}_small`);
+        if (userStatusSmall) {
+            userStatusSmall.textContent = onlineStatus ? 'Online' : 'Offline';
+        }
+    });
 };
 
 // Update status when leaving the page
@@ -46,5 +87,6 @@ window.addEventListener('beforeunload', function() {
 });
 
 onlineSocket.onclose = function(e) {
+    clearInterval(presenceHeartbeat);
     console.log("Online status socket disconnected");
 };
\ No newline at end of file
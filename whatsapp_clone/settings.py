@@ -139,12 +139,91 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/chat_files/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'chat_files')
 
+# Uploads are stored once per distinct content, see chats.storage
+STORAGES = {
+    'default': {
+        'BACKEND': 'chats.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
     # 'content/static',
 ]
 
 STATIC_ROOT = os.path.join(os.path.dirname(BASE_DIR), "static_cdn")
+
+# Chat history pagination
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+# A reconnecting client missing more messages than this reloads the history instead
+CHAT_RESUME_MAX_GAP = 200
+
+# Channel layer sends in flight at once when notifying the members of a group
+CHAT_FANOUT_CONCURRENCY = 50
+
+# Presence: a connection without heartbeat for CHAT_PRESENCE_TTL seconds is dropped,
+# expiry and the batched "last seen" writes run every CHAT_PRESENCE_SWEEP_INTERVAL seconds
+CHAT_PRESENCE_TTL = 60
+CHAT_PRESENCE_SWEEP_INTERVAL = 15
+# Presence changes are sent to their subscribers as one diff every CHAT_PRESENCE_BATCH_INTERVAL seconds
+CHAT_PRESENCE_BATCH_INTERVAL = 1
+CHAT_PRESENCE_MAX_SUBSCRIPTIONS = 500
+
+# Write-behind: queue chat messages and save them with bulk_create, once
+# CHAT_WRITE_BEHIND_BATCH_SIZE are waiting or CHAT_WRITE_BEHIND_INTERVAL seconds
+# after the first one.  Messages still queued are lost if the process dies.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_INTERVAL = 0.005
+
+# Typing indicators: one report per sender per CHAT_TYPING_MIN_INTERVAL seconds is kept,
+# a typist is dropped CHAT_TYPING_TTL seconds after their last report and each room
+# gets at most one "who is typing" frame every CHAT_TYPING_BATCH_INTERVAL seconds
+CHAT_TYPING_MIN_INTERVAL = 1
+CHAT_TYPING_TTL = 5
+CHAT_TYPING_BATCH_INTERVAL = 0.5
+
+# Outbound coalescing for clients negotiating a batch subprotocol: frames are merged
+# into one array frame once none came for CHAT_COALESCE_WINDOW seconds, at most
+# CHAT_COALESCE_MAX_DELAY seconds after the first one or when CHAT_COALESCE_MAX_FRAMES wait
+CHAT_COALESCE_WINDOW = 0.005
+CHAT_COALESCE_MAX_DELAY = 0.02
+CHAT_COALESCE_MAX_FRAMES = 50
+
+# Chunked uploads: partial files live in CHAT_UPLOAD_TEMP_DIR until complete,
+# each PUT carries at most CHAT_UPLOAD_CHUNK_SIZE bytes
+CHAT_UPLOAD_TEMP_DIR = os.path.join(BASE_DIR, 'partial_uploads')
+CHAT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHAT_UPLOAD_MAX_SIZE = 4 * 1024 ** 3
+# Uploads without a chunk for CHAT_UPLOAD_EXPIRE_AFTER_HOURS are dropped by
+# manage.py expire_uploads, a user has at most CHAT_UPLOAD_MAX_OPEN in progress
+CHAT_UPLOAD_EXPIRE_AFTER_HOURS = 24
+CHAT_UPLOAD_MAX_OPEN = 5
+# Thumbnails of uploaded images (label -> longest side in pixels), rendered by
+# CHAT_THUMBNAIL_WORKERS processes, 0 renders them in the request instead
+CHAT_THUMBNAIL_SIZES = {'small': 240, 'large': 720}
+CHAT_THUMBNAIL_WORKERS = 2
+# Media files are served by chats.views.serve_media after a permission check.
+# Set CHAT_MEDIA_ACCEL to 'x-accel-redirect' (nginx, with an internal location
+# at CHAT_MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile' (Apache,
+# lighttpd) to have the proxy send the bytes instead of a Python worker
+CHAT_MEDIA_ACCEL = None
+CHAT_MEDIA_ACCEL_PREFIX = '/protected_chat_files/'
+# How long a granted media access is remembered, see chats.media.shared_filename
+CHAT_MEDIA_PERMISSION_TTL = 300
+# Most files get-files-details resolves in one request
+CHAT_FILE_DETAILS_MAX_IDS = 100
+# The files of STATICFILES_DIRS are served from memory under fingerprinted
+# names at CHAT_ASSET_URL, use {% asset %} from chat_assets in the templates
+CHAT_ASSET_URL = '/assets/'
+# Messages older than CHAT_ARCHIVE_AFTER_DAYS are moved to compressed segment
+# files in CHAT_ARCHIVE_DIR by the archive_messages command
+CHAT_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+CHAT_ARCHIVE_AFTER_DAYS = 365
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
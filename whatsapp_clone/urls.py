@@ -15,9 +15,8 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from chats.views import index, chatPage,mark_notifications_seen
+from chats.views import index, chatPage, get_thread_messages, get_notifications, mark_notifications_seen, serve_asset, serve_media
 from django.views.generic.base import TemplateView
-from django.conf.urls.static import static
 from django.conf import settings
 
 
@@ -27,7 +26,12 @@ urlpatterns = [
     path('accounts/', include(('accounts.urls', 'accounts'), namespace='accounts')),
     path('', index, name='home'),
     path('chat/<str:username>/', chatPage, name='chat'),
+    path('chat/<str:username>/messages/', get_thread_messages, name='chat_messages'),
     path('mark-notifications-seen/', mark_notifications_seen, name='mark_notifications_seen'),
+    path('notifications/', get_notifications, name='notifications'),
     path('service_worker/',include("chats.urls")),
-    path('group/',include("groups.urls"))
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('group/',include("groups.urls")),
+    # Permission checked, unlike django.conf.urls.static which also only works with DEBUG
+    path(f'{settings.MEDIA_URL.strip("/")}/<path:name>', serve_media, name='media'),
+    path(f'{settings.CHAT_ASSET_URL.strip("/")}/<path:name>', serve_asset, name='asset')
+]